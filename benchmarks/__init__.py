@@ -0,0 +1 @@
+# Plow benchmarks
@@ -0,0 +1,48 @@
+""" Benchmark paged searches against the mock server with injected latency,
+with and without the next page read ahead
+
+Usage: python -m benchmarks.bench_search [latency [work]]
+    latency: round trip time of a request, in seconds
+    work: processing time of each entry by the caller, in seconds
+"""
+
+import sys
+import time
+
+from plow.tests.mocks import LdapAdaptor
+
+ENTRIES = 2000
+PAGE_SIZE = 100
+
+
+def make_adaptor(latency):
+    la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+    for i in range(ENTRIES):
+        la._ldap.data["uid=user{0},dc=example,dc=com".format(i)] = {
+            "uid": ["user{0}".format(i)],
+            "objectClass": ["inetOrgPerson"],
+        }
+    la._ldap.latency = latency
+    return la
+
+
+def run(la, read_ahead, work):
+    start = time.time()
+    for res in la.iter_search(page_size=PAGE_SIZE, read_ahead=read_ahead):
+        if work:
+            time.sleep(work)
+    return time.time() - start
+
+
+def main(latency=0.05, work=0.0002):
+    la = make_adaptor(latency)
+    print "{0} entries, {1} per page, latency {2}s, {3}s per entry".format(
+        ENTRIES, PAGE_SIZE, latency, work)
+
+    for read_ahead in (0, 1):
+        print "read_ahead={0}: {1:.3f}s".format(
+            read_ahead, run(la, read_ahead, work))
+
+
+if __name__ == '__main__':
+    main(*[float(a) for a in sys.argv[1:]])
@@ -0,0 +1,63 @@
+""" Compare the results of two runs of the benchmark suite
+
+Usage: python -m benchmarks.compare [-t threshold] old.json new.json
+
+Exits with status 1 when a case got slower by more than the threshold,
+0.1 (10%) by default.
+"""
+
+import json
+import optparse
+import sys
+
+
+def compare(old, new, threshold=0.1, out=sys.stdout):
+    """ Print the best times of the cases of both results, returns the names
+    of the cases which got slower by more than threshold """
+    if old.get("params") != new.get("params"):
+        print >>out, "Warning: the parameters differ, {0} != {1}".format(
+            old.get("params"), new.get("params"))
+
+    print >>out, "{0:24} {1:>10} {2:>10} {3:>8}".format(
+        "", (old.get("commit") or "old")[:10], (new.get("commit") or "new")[:10],
+        "ratio")
+
+    regressions = []
+    for name in sorted(set(old["cases"]) | set(new["cases"])):
+        if name not in old["cases"] or name not in new["cases"]:
+            print >>out, "{0:24} only in {1} results".format(
+                name, "old" if name in old["cases"] else "new")
+            continue
+
+        before = old["cases"][name]["best"]
+        after = new["cases"][name]["best"]
+        ratio = after / before if before else 1.0
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = " slower"
+        elif ratio < 1 - threshold:
+            mark = " faster"
+        print >>out, "{0:24} {1:9.4f}s {2:9.4f}s {3:7.2f}x{4}".format(
+            name, before, after, ratio, mark)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] old.json new.json")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="slowdown reported as a regression [%default]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("Two result files are needed")
+
+    results = []
+    for path in args:
+        with open(path) as f:
+            results.append(json.load(f))
+    return 1 if compare(results[0], results[1], options.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+""" Synthetic directories for the benchmarks
+
+The directory data is generated from a seed, so that every run of the
+benchmarks works on the same entries.
+"""
+
+import random
+
+import ldap
+
+from plow.tests.mocks import FakeLDAPSrv, LdapAdaptor
+
+BASE_DN = "dc=example,dc=com"
+
+
+class SyntheticDirectory(object):
+    """ Users spread in a tree of OUs, and groups of users
+
+        ou=people: a tree of depth levels of fanout OUs, with the users
+            in the leaf OUs
+        ou=groups: a big group with group_size members, and a number of
+            smaller groups of random users
+
+    Member values are written with uppercase attribute types, as some
+    servers return them, so that they need to be normalized.
+    """
+    def __init__(self, users=10000, groups=100, group_size=None, depth=4,
+                 fanout=4, seed=0, base_dn=BASE_DN):
+        self.base_dn = base_dn
+        self.people_dn = "ou=people," + base_dn
+        self.groups_dn = "ou=groups," + base_dn
+        self.big_group_dn = "cn=everyone," + self.groups_dn
+        if group_size is None:
+            group_size = min(users, 500000)
+
+        self.data = {}
+        self.ous = []
+        self.users = []
+        self.groups = []
+        rand = random.Random(seed)
+
+        self._add_ou(base_dn, "people")
+        self._add_ou(base_dn, "groups")
+        leaves = [self.people_dn]
+        for level in range(depth):
+            leaves = [
+                self._add_ou(parent, "l{0}n{1}".format(level, i))
+                for parent in leaves
+                for i in range(fanout)
+            ]
+
+        for i in range(users):
+            self._add_user(leaves[i % len(leaves)], i, rand)
+
+        self._add_group(self.big_group_dn,
+                        rand.sample(self.users, min(group_size, users)))
+        for i in range(groups):
+            size = rand.randint(1, max(users // 10, 1))
+            self._add_group("cn=group{0},{1}".format(i, self.groups_dn),
+                            rand.sample(self.users, min(size, users)))
+
+    def _add_ou(self, parent, name):
+        dn = "ou={0},{1}".format(name, parent)
+        self.data[dn] = {
+            "ou": [name],
+            "objectClass": ["organizationalUnit"],
+        }
+        self.ous.append(dn)
+        return dn
+
+    def _add_user(self, parent, i, rand):
+        uid = "user{0}".format(i)
+        dn = "uid={0},{1}".format(uid, parent)
+        self.data[dn] = {
+            "uid": [uid],
+            "objectClass": ["top", "person", "organizationalPerson",
+                            "inetOrgPerson"],
+            "cn": ["User {0}".format(i)],
+            "sn": ["Number{0}".format(i)],
+            "givenName": ["User"],
+            "mail": ["{0}@example.com".format(uid)],
+            "telephoneNumber": [
+                "+1 555 {0:07d}".format(rand.randint(0, 9999999))],
+        }
+        self.users.append(dn)
+
+    def _add_group(self, dn, members):
+        self.data[dn] = {
+            "cn": [ldap.dn.str2dn(dn)[0][0][1]],
+            "objectClass": ["groupOfNames"],
+            "member": [member_value(member) for member in members],
+        }
+        self.groups.append(dn)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def member_value(dn):
+    """ dn as a server could write it in a member attribute """
+    return ",".join(
+        "{0}={1}".format(name.upper(), value)
+        for name, value in (part.split("=", 1) for part in dn.split(","))
+    )
+
+
+class SyntheticServer(FakeLDAPSrv):
+    """ A fake server which does not look for the entries in scope again for
+    every result page. The data must not change between searches. """
+    def __init__(self, *args, **kwargs):
+        FakeLDAPSrv.__init__(self, *args, **kwargs)
+        self._scopes = {}
+
+    def _entries(self, base, scope):
+        if scope == ldap.SCOPE_BASE:
+            return [(base, self.data[base])]
+        key = (base, scope)
+        if key not in self._scopes:
+            self._scopes[key] = FakeLDAPSrv._entries(self, base, scope)
+        return self._scopes[key]
+
+
+def make_adaptor(directory, max_val_range=0):
+    """ An LdapAdaptor searching the directory """
+    la = LdapAdaptor("ldap://localhost", directory.base_dn)
+    la._ldap = SyntheticServer(data=directory.data,
+                               max_val_range=max_val_range)
+    return la
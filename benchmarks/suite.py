@@ -0,0 +1,336 @@
+""" Benchmark the hot paths of plow on a synthetic directory
+
+Usage: python -m benchmarks.suite [options] [case ...]
+
+Every case runs on the same generated directory, the size of which is set
+with --users, --group-size and --depth. The timings can be saved to a JSON
+file with --output, and compared with the results of another commit with
+--compare, or with python -m benchmarks.compare.
+"""
+
+import gc
+import json
+import optparse
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import ldap
+
+from plow.ldapadaptor import AdaptivePageSize
+from plow.ldapclass import CaseInsensitiveDict, LdapType
+from plow.utils import ModlistCost, modify_modlist
+from benchmarks import compare
+from benchmarks.directory import SyntheticDirectory, make_adaptor
+
+# (name, setup) of the benchmark cases, setup(directory) returns a function
+# running the case once and returning the number of operations it made
+CASES = []
+
+# Number of values of ranged attributes returned at once, as Active Directory
+MAX_VAL_RANGE = 1500
+# Members added and removed by the member view case
+MEMBER_CHANGES = 1000
+
+User = LdapType.from_config("User", {
+    "rdn": "uid",
+    "uid": "uid",
+    "objectClass": "inetOrgPerson",
+    "attributes": {
+        "name": {"attribute": "givenName"},
+        "sn": {},
+        "mail": {},
+    },
+})
+
+Group = LdapType.from_config("Group", {
+    "rdn": "cn",
+    "uid": "cn",
+    "objectClass": "groupOfNames",
+    "attributes": {
+        "members": {
+            "relation": "member",
+            "attribute": "member",
+        },
+    },
+})
+
+
+def case(setup):
+    CASES.append((setup.__name__, setup))
+    return setup
+
+
+@case
+def search_paging(directory):
+    """ Paged subtree search of the people OU """
+    la = make_adaptor(directory)
+
+    def run():
+        return len(la.search(directory.people_dn, ldap.SCOPE_SUBTREE,
+                             page_size=1000))
+    return run
+
+
+@case
+def search_paging_adaptive(directory):
+    """ Paged subtree search of the people OU, with adaptive page sizes """
+    la = make_adaptor(directory)
+    la.page_size = AdaptivePageSize()
+
+    def run():
+        return len(la.search(directory.people_dn, ldap.SCOPE_SUBTREE))
+    return run
+
+
+@case
+def ranged_attributes(directory):
+    """ Read the members of the big group, MAX_VAL_RANGE values at once """
+    la = make_adaptor(directory, max_val_range=MAX_VAL_RANGE)
+
+    def run():
+        res = la.search(directory.big_group_dn, ldap.SCOPE_BASE,
+                        attrs=["member"])
+        # The ranges are returned as member;range=start-end attributes
+        return sum(len(values) for values in res[0][1].itervalues())
+    return run
+
+
+@case
+def hydration(directory):
+    """ Build LdapClass objects from search results """
+    la = make_adaptor(directory)
+    res = [(dn, directory.data[dn]) for dn in directory.users]
+
+    def run():
+        return len([User(la, dn, attrs) for dn, attrs in res])
+    return run
+
+
+@case
+def member_view(directory):
+    """ Add and remove members of the big group """
+    la = make_adaptor(directory)
+    attrs = directory.data[directory.big_group_dn]
+    removed = attrs["member"][:MEMBER_CHANGES]
+    added = ["uid=new{0},{1}".format(i, directory.people_dn)
+             for i in range(MEMBER_CHANGES)]
+
+    def run():
+        group = Group(la, directory.big_group_dn, attrs)
+        for dn in added:
+            group.members.add(dn)
+        for dn in removed:
+            group.members.remove(dn)
+        return len(added) + len(removed)
+    return run
+
+
+@case
+def save_member(directory):
+    """ Save the big group after adding a member """
+    la = make_adaptor(directory)
+    # The saves must not change the generated directory
+    la.modify = lambda dn, mod_attrs: None
+    group = Group(la, directory.big_group_dn,
+                  directory.data[directory.big_group_dn])
+    added = iter(xrange(sys.maxint))
+
+    def run():
+        group.members.add("uid=new{0},{1}".format(next(added),
+                                                  directory.people_dn))
+        group.save()
+        return 1
+    return run
+
+
+@case
+def resolve_members(directory):
+    """ Read the objects of MEMBER_CHANGES members of the big group """
+    la = make_adaptor(directory)
+    attrs = dict(directory.data[directory.big_group_dn])
+    # The synthetic server compares the DNs exactly
+    attrs["member"] = directory.users[:MEMBER_CHANGES]
+    group = Group(la, directory.big_group_dn, attrs)
+
+    def run():
+        return len(group.members.resolve(User, attrs=["sn", "mail"]))
+    return run
+
+
+@case
+def modlist(directory):
+    """ Modlists of changes to the members of the big group """
+    old = directory.data[directory.big_group_dn]
+    members = old["member"]
+    change = max(len(members) // 100, 1)
+    new = dict(old, member=members[change:] + [
+        "uid=new{0},{1}".format(i, directory.people_dn)
+        for i in range(change)
+    ])
+
+    def run():
+        modify_modlist(old, new)
+        modify_modlist(old, new, atomic=True)
+        return 2
+    return run
+
+
+@case
+def modlist_cost(directory):
+    """ Modlists of changes to the members of the big group, picking
+    between replacing them and sending the changes """
+    old = directory.data[directory.big_group_dn]
+    members = old["member"]
+    cost = ModlistCost()
+    changes = [
+        dict(old, member=members[change:] + [
+            "uid=new{0},{1}".format(i, directory.people_dn)
+            for i in range(change)
+        ])
+        for change in (1, max(len(members) // 100, 1), len(members) // 2)
+    ]
+
+    def run():
+        for new in changes:
+            modify_modlist(old, new, cost=cost)
+        return len(changes)
+    return run
+
+
+@case
+def case_insensitive_dict(directory):
+    """ Fill, read and update case insensitive dicts of user attributes """
+    entries = [directory.data[dn] for dn in directory.users]
+
+    def run():
+        for attrs in entries:
+            d = CaseInsensitiveDict(attrs)
+            d["MAIL"]
+            "GivenName" in d
+            d.get("telephonenumber")
+            d["SN"] = ["Changed"]
+        return len(entries) * 5
+    return run
+
+
+@case
+def normalize_dn(directory):
+    """ Normalize the member values of the big group """
+    la = make_adaptor(directory)
+    members = directory.data[directory.big_group_dn]["member"]
+
+    def run():
+        for dn in members:
+            la.normalize_dn(dn)
+        return len(members)
+    return run
+
+
+def measure(run, repeat):
+    """ The durations of repeat runs, and the number of operations """
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        ops = run()
+        times.append(timeit.default_timer() - start)
+    return times, ops
+
+
+def git_commit():
+    """ The commit of the working tree, with a + when it has changes """
+    try:
+        commit = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+        status = subprocess.Popen(["git", "status", "--porcelain",
+                                   "--untracked-files=no"],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    return commit.strip() + ("+" if status.strip() else "") or None
+
+
+def run_suite(names=None, users=10000, group_size=None, depth=4, repeat=3,
+              seed=0, out=sys.stdout):
+    """ Run the cases, all of them by default, returns the results """
+    start = timeit.default_timer()
+    directory = SyntheticDirectory(users=users, group_size=group_size,
+                                   depth=depth, seed=seed)
+    print >>out, "{0} entries generated in {1:.2f}s".format(
+        len(directory), timeit.default_timer() - start)
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {
+            "users": users,
+            "group_size": len(directory.data[directory.big_group_dn]["member"]),
+            "depth": depth,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "cases": {},
+    }
+
+    for name, setup in CASES:
+        if names and name not in names:
+            continue
+        times, ops = measure(setup(directory), repeat)
+        best = min(times)
+        results["cases"][name] = {
+            "times": times,
+            "best": best,
+            "median": sorted(times)[len(times) // 2],
+            "ops": ops,
+            "ops_per_sec": best and ops / best,
+        }
+        print >>out, "{0:24} {1:10.4f}s {2:12.0f} ops/s".format(
+            name, best, best and ops / best)
+
+    return results
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] [case ...]",
+        description="Cases: " + ", ".join(name for name, setup in CASES))
+    parser.add_option("-u", "--users", type="int", default=10000,
+                      help="number of users [%default]")
+    parser.add_option("-g", "--group-size", type="int",
+                      help="members of the big group [users, up to 500000]")
+    parser.add_option("-d", "--depth", type="int", default=4,
+                      help="levels of OUs below ou=people [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each case, the best is kept [%default]")
+    parser.add_option("-s", "--seed", type="int", default=0,
+                      help="seed of the generated directory [%default]")
+    parser.add_option("-o", "--output",
+                      help="save the results to this JSON file")
+    parser.add_option("-c", "--compare",
+                      help="compare with the results of this JSON file")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="slowdown reported as a regression [%default]")
+    options, names = parser.parse_args(argv)
+
+    results = run_suite(names, options.users, options.group_size,
+                        options.depth, options.repeat, options.seed)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        if compare.compare(previous, results, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,425 @@
+""" the asyncadaptor module drives LDAP operations from an event loop """
+
+import select
+import sys
+import time
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+
+from plow.errors import LdapAdaptorError
+from plow.ldapadaptor import (
+    make_page_control,
+    get_page_control,
+    get_new_ranges,
+    PagedCtrl,
+)
+
+
+class LdapFuture(object):
+    """ The eventual result of an asynchronous LDAP operation """
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """ Return the result, or raise the exception of the operation """
+        if not self._done:
+            raise LdapAdaptorError("Operation is not done")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        return self._exc_info and self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) once the operation is done """
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def set_exception(self, exc):
+        self.set_exc_info((type(exc), exc, None))
+
+    def then(self, fn):
+        """ Return a future of fn(result). If fn returns a future, the
+        returned future is done when it is. """
+        future = LdapFuture()
+
+        def chain(done):
+            try:
+                res = fn(done.result())
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                return
+            if isinstance(res, LdapFuture):
+                res.add_done_callback(lambda r: copy_future(r, future))
+            else:
+                future.set_result(res)
+
+        self.add_done_callback(chain)
+        return future
+
+
+def copy_future(src, dest):
+    if src._exc_info is not None:
+        dest.set_exc_info(src._exc_info)
+    else:
+        dest.set_result(src._result)
+
+
+class AsyncPagedSearch(object):
+    """ A paged search, handing out result pages as futures
+
+    next_page() returns a future of the next page of (dn, attrs) results,
+    with ranged attributes completed, or of None when there are no more pages.
+    """
+    def __init__(self, ala, base_dn, scope, filterstr, attrs, page_size):
+        self._ala = ala
+        self.base_dn = base_dn
+        self.scope = scope
+        self.filterstr = filterstr
+        self.attrs = attrs
+        self.page_size = page_size
+        self._cookie = ''
+
+    def _request(self):
+        paging_ctrl = make_page_control(False, self.page_size, self._cookie)
+        return self._ala._submit(
+            lambda l: l.search_ext(self.base_dn, self.scope, self.filterstr,
+                                   self.attrs, serverctrls=[paging_ctrl]),
+            lambda rtype, res, ctrls: (res, ctrls),
+        )
+
+    def next_page(self):
+        if self._cookie is None:
+            future = LdapFuture()
+            future.set_result(None)
+            return future
+
+        return self._request().then(self._got_page)
+
+    def _got_page(self, result):
+        res, ctrls = result
+        # extract cookie if supplied by server
+        page_cookie = ''
+        for ext in ctrls:
+            if isinstance(ext, PagedCtrl):
+                x, page_cookie = get_page_control(ext)
+        # Paging not supported or end of paging
+        self._cookie = page_cookie or None
+
+        return self._ala._complete_ranges(res).then(lambda x: res)
+
+
+class AsyncLdapAdaptor(object):
+    """ Non-blocking front-end to an LdapAdaptor
+
+    Operations are sent right away and return an LdapFuture. Their results
+    are collected by process(), which must be called whenever fileno() is
+    readable, for example with:
+
+        tornado: ioloop.add_handler(ala.fileno(),
+                                    lambda fd, events: ala.process(),
+                                    IOLoop.READ)
+        twisted: a reader whose doRead() calls ala.process()
+
+    run(future) can be used instead to wait on a future with select().
+
+    The LdapAdaptor must not be used for blocking operations while
+    operations are pending on the AsyncLdapAdaptor, since they share the
+    connection. Connecting and binding, when needed, are blocking.
+    """
+    def __init__(self, la):
+        self.la = la
+        # msgid -> (future, handler)
+        self._pending = {}
+
+    def __str__(self):
+        return "<AsyncLdapAdaptor: {0}>".format(self.la._server_url)
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def _ldap(self):
+        if not self.la.is_connected:
+            self.la.connect()
+        return self.la._ldap
+
+    @property
+    def pending(self):
+        """ Number of operations waiting for a result """
+        return len(self._pending)
+
+    def fileno(self):
+        """ The file descriptor of the LDAP connection """
+        return self._ldap.fileno()
+
+    def _submit(self, send, handler):
+        """ Send a request with send(ldapobject), then resolve the returned
+        future with handler(result_type, result_data, controls) """
+        future = LdapFuture()
+        try:
+            msgid = send(self._ldap)
+        except ldap.SERVER_DOWN:
+            # Reconnect on the next operation
+            self.la.is_connected = False
+            future.set_exc_info(sys.exc_info())
+            return future
+        except ldap.LDAPError:
+            future.set_exc_info(sys.exc_info())
+            return future
+
+        self._pending[msgid] = (future, handler)
+        return future
+
+    def _done(self, value=None):
+        future = LdapFuture()
+        future.set_result(value)
+        return future
+
+    def process(self):
+        """ Collect the available results and resolve their futures """
+        ready = True
+        while ready and self._pending:
+            ready = False
+            for msgid in list(self._pending):
+                future, handler = self._pending[msgid]
+                try:
+                    rtype, rdata, y, ctrls = self._ldap.result3(msgid,
+                                                                timeout=0)
+                    if rtype is None:
+                        continue
+                    del self._pending[msgid]
+                    res = handler(rtype, rdata, ctrls)
+                except ldap.SERVER_DOWN:
+                    # Every pending operation is lost with the connection
+                    self.la.is_connected = False
+                    lost, self._pending = self._pending, {}
+                    for future, handler in lost.values():
+                        future.set_exc_info(sys.exc_info())
+                    return
+                except (ldap.LDAPError, LdapAdaptorError):
+                    self._pending.pop(msgid, None)
+                    future.set_exc_info(sys.exc_info())
+                else:
+                    future.set_result(res)
+                ready = True
+
+    def run(self, future, timeout=None):
+        """ Process results until future is done, and return its result """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not future.done():
+            self.process()
+            if future.done():
+                break
+            wait = None
+            if timeout is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise ldap.TIMEOUT("Operation timed out")
+            select.select([self.fileno()], [], [], wait)
+        return future.result()
+
+    def _check_result(self, name, expected, dn=None, args=()):
+        def handler(rtype, rdata, ctrls):
+            if rtype != expected:
+                raise LdapAdaptorError(
+                    "%(op)s: unexpected result %(type)s : %(result)s" %
+                    {"op": name, "type": str(rtype), "result": rdata})
+            self.la._track_write(name, dn, args)
+        return handler
+
+    def _invalidated(self, future, invalidate, *args):
+        """ Invalidate the cached searches with invalidate(*args) once the
+        write of future is done """
+        future.add_done_callback(lambda done: invalidate(*args))
+        return future
+
+    def add(self, dn, add_record):
+        """ See LdapAdaptor.add() """
+        LOG.debug("%sAdding %s: %r", self.la._dry_run_msg(), dn, add_record)
+        if self.la.is_dry_run():
+            return self._done()
+        return self._invalidated(
+            self._submit(lambda l: l.add(dn, add_record),
+                         self._check_result("add", ldap.RES_ADD, dn)),
+            self.la._invalidate, dn)
+
+    def delete(self, dn):
+        """ See LdapAdaptor.delete() """
+        LOG.debug("%sDeleting %s...", self.la._dry_run_msg(), dn)
+        if self.la.is_dry_run():
+            return self._done()
+        return self._invalidated(
+            self._submit(lambda l: l.delete(dn),
+                         self._check_result("delete", ldap.RES_DELETE, dn)),
+            self.la._invalidate, dn, True)
+
+    def modify(self, dn, mod_attrs):
+        """ See LdapAdaptor.modify() """
+        LOG.debug("%sModifying %s: %s", self.la._dry_run_msg(), dn, mod_attrs)
+        if self.la.is_dry_run():
+            return self._done()
+        return self._invalidated(
+            self._submit(lambda l: l.modify(dn, mod_attrs),
+                         self._check_result("modify", ldap.RES_MODIFY)),
+            self.la._invalidate, dn)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        """ See LdapAdaptor.rename() """
+        LOG.debug("%sModifying dn %s to %s%s...", self.la._dry_run_msg(),
+                  dn, newrdn, newsuperior and "," + newsuperior or "")
+        if self.la.is_dry_run():
+            return self._done([True, None])
+        return self._invalidated(
+            self._submit(lambda l: l.rename(dn, newrdn, newsuperior, delold),
+                         self._check_result("rename", ldap.RES_MODRDN, dn,
+                                            (newrdn, newsuperior))),
+            self.la._invalidate_rename, dn, newrdn, newsuperior)
+
+    def compare(self, dn, attr_name, attr_value):
+        """ Future of True if dn has attr_name with attr_value """
+        future = LdapFuture()
+
+        def done(res):
+            exc = res.exception()
+            if isinstance(exc, ldap.COMPARE_TRUE):
+                future.set_result(True)
+            elif isinstance(exc, ldap.COMPARE_FALSE):
+                future.set_result(False)
+            else:
+                copy_future(res, future)
+
+        self._submit(lambda l: l.compare(dn, attr_name, attr_value),
+                     self._check_result("compare", ldap.RES_COMPARE)
+                     ).add_done_callback(done)
+        return future
+
+    def iter_search(self,
+                    base_dn=None,
+                    scope=ldap.SCOPE_SUBTREE,
+                    filterstr='(objectClass=*)',
+                    attrs=None,
+                    page_size=1000):
+        """ Returns an AsyncPagedSearch, see LdapAdaptor.iter_search() """
+        base_dn = base_dn or self.la.base_dn
+        LOG.debug("Searching for %s (%s) on %s ...", filterstr, attrs, base_dn)
+        return AsyncPagedSearch(self, base_dn, scope, filterstr, attrs,
+                                page_size)
+
+    def search(self,
+               base_dn=None,
+               scope=ldap.SCOPE_SUBTREE,
+               filterstr='(objectClass=*)',
+               attrs=None,
+               page_size=1000):
+        """ Future of the list of results, see LdapAdaptor.search() """
+        pages = self.iter_search(base_dn, scope, filterstr, attrs, page_size)
+        all_res = []
+
+        def got_page(res):
+            if res is None:
+                return all_res
+            all_res.extend(res)
+            return pages.next_page().then(got_page)
+
+        return pages.next_page().then(got_page)
+
+    def _complete_ranges(self, res):
+        """ Future completing the ranged attributes of a result page """
+        outstanding = [0]
+        future = LdapFuture()
+
+        def request(dn, obj_attrs, new_ranges):
+            outstanding[0] += 1
+            self._submit(
+                lambda l: l.search_ext(dn, ldap.SCOPE_BASE,
+                                       attrlist=new_ranges),
+                lambda rtype, new_res, ctrls: new_res,
+            ).add_done_callback(lambda r: got_range(dn, obj_attrs, r))
+
+        def got_range(dn, obj_attrs, r):
+            outstanding[0] -= 1
+            if future.done():
+                return
+            if r.exception() is not None:
+                copy_future(r, future)
+                return
+
+            new_res = r.result()
+            if len(new_res) != 1 or new_res[0][0] is None:
+                LOG.warn("get extra attr failed for %s", dn)
+            else:
+                new_attrs = new_res[0][1]
+                obj_attrs.update(new_attrs)
+                new_ranges = get_new_ranges(new_attrs)
+                if new_ranges:
+                    request(dn, obj_attrs, new_ranges)
+
+            if not outstanding[0]:
+                future.set_result(res)
+
+        for dn, obj_attrs in res:
+            if dn is None:
+                continue
+            new_ranges = get_new_ranges(obj_attrs)
+            if new_ranges:
+                request(dn, obj_attrs, new_ranges)
+
+        if not outstanding[0] and not future.done():
+            future.set_result(res)
+        return future
+
+    def run_steps(self, steps):
+        """ Future of the completion of a generator of operations
+
+        steps yields (operation name, args, kwargs) tuples, and receives the
+        result of each operation, or has its exception raised into it.
+        """
+        future = LdapFuture()
+
+        def advance(send, value):
+            try:
+                name, args, kwargs = send(*value)
+            except StopIteration:
+                future.set_result(None)
+                return
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                return
+
+            getattr(self, name)(*args, **kwargs).add_done_callback(step_done)
+
+        def step_done(res):
+            if res._exc_info is not None:
+                advance(steps.throw, res._exc_info)
+            else:
+                advance(steps.send, (res.result(), ))
+
+        advance(steps.send, (None, ))
+        return future
@@ -0,0 +1,145 @@
+""" the batch module pipelines LDAP write operations """
+
+from collections import deque
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+
+from plow.errors import LdapAdaptorError
+
+
+class BatchOperation(object):
+    """ A write operation sent by a WriteBatch, and its outcome """
+    def __init__(self, name, dn, args, expected):
+        self.name = name
+        self.dn = dn
+        self.args = args
+        self.expected = expected
+        self.msgid = None
+        self.done = False
+        # The exception raised by the operation, if it failed
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.done and self.error is None
+
+    def __repr__(self):
+        return "<BatchOperation: {0} {1}>".format(self.name, self.dn)
+
+
+class WriteBatch(object):
+    """ Pipelined add/modify/delete/rename operations
+
+    Operations are sent without waiting for the previous ones to complete,
+    with at most window operations waiting for their result. A failed
+    operation does not stop the others: it is added to failures, with the
+    exception in its error attribute.
+
+    The batch is meant to be used as a context manager, which waits for every
+    operation to complete when leaving the block:
+
+        with la.batch(window=64) as b:
+            for dn in dns:
+                b.delete(dn)
+        for op in b.failures:
+            ...
+    """
+    def __init__(self, la, window=64):
+        self._la = la
+        self.window = window
+        self._inflight = deque()
+        self.count = 0
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def add(self, dn, add_record):
+        """ Queue an add operation, see LdapAdaptor.add() """
+        return self._send(
+            BatchOperation("add", dn, (add_record, ), ldap.RES_ADD))
+
+    def delete(self, dn):
+        """ Queue a delete operation, see LdapAdaptor.delete() """
+        return self._send(
+            BatchOperation("delete", dn, (), ldap.RES_DELETE))
+
+    def modify(self, dn, mod_attrs):
+        """ Queue a modify operation, see LdapAdaptor.modify() """
+        return self._send(
+            BatchOperation("modify", dn, (mod_attrs, ), ldap.RES_MODIFY))
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        """ Queue a modify RDN operation, see LdapAdaptor.rename() """
+        return self._send(
+            BatchOperation("rename", dn, (newrdn, newsuperior, delold),
+                           ldap.RES_MODRDN))
+
+    def _send(self, op):
+        LOG.debug("%sBatch %s %s: %r", self._la._dry_run_msg(),
+                  op.name, op.dn, op.args)
+        self.count += 1
+        if self._la.metrics is not None:
+            self._la.metrics.incr("batch.operations")
+        if self._la.is_dry_run():
+            op.done = True
+            return op
+
+        while len(self._inflight) >= self.window:
+            self._wait(self._inflight.popleft())
+
+        try:
+            op.msgid = getattr(self._la._ldap, op.name)(op.dn, *op.args)
+        except ldap.SERVER_DOWN, down:
+            # The operations in flight are lost, but we can go on with a
+            # new connection
+            LOG.debug("batch -> server down")
+            for lost in self._inflight:
+                lost.error = down
+                lost.done = True
+                self.failures.append(lost)
+                # They may have been applied
+                self._invalidate(lost)
+            self._inflight.clear()
+            self._la.is_connected = False
+            self._la.reconnect()
+            op.msgid = getattr(self._la._ldap, op.name)(op.dn, *op.args)
+
+        self._inflight.append(op)
+        return op
+
+    def _invalidate(self, op):
+        """ Invalidate the cached searches affected by op, once it is done,
+        see LdapAdaptor.add() """
+        if op.name == "rename":
+            self._la._invalidate_rename(op.dn, op.args[0], op.args[1])
+        else:
+            self._la._invalidate(op.dn, subtree=(op.name == "delete"))
+
+    def _wait(self, op):
+        try:
+            result_type, result_data = self._la._ldap.result(op.msgid)
+            if result_type != op.expected:
+                raise LdapAdaptorError(
+                    "%(op)s: unexpected result %(type)s : %(result)s" %
+                    {"op": op.name, "type": str(result_type),
+                     "result": result_data})
+            self._la._track_write(op.name, op.dn, op.args)
+        except (ldap.LDAPError, LdapAdaptorError), e:
+            LOG.error("Batch %s of %s failed: %s", op.name, op.dn, e)
+            if self._la.metrics is not None:
+                self._la.metrics.incr("batch.errors")
+            op.error = e
+            self.failures.append(op)
+        op.done = True
+        self._invalidate(op)
+
+    def flush(self):
+        """ Wait for all the operations in flight to complete """
+        while self._inflight:
+            self._wait(self._inflight.popleft())
@@ -0,0 +1,174 @@
+""" the cache module keeps search results in memory """
+
+import threading
+import time
+
+import ldap.dn
+
+from plow.utils import OrderedDict, parse_dn
+
+
+def copy_results(res):
+    return [
+        (dn, attrs and dict((k, v[:]) for k, v in attrs.iteritems()))
+        for dn, attrs in res
+    ]
+
+
+class SearchCache(object):
+    """ A bounded cache of LdapAdaptor.search() results
+
+    Results are keyed on (base, scope, filter, attributes), base being a
+    normalized DN. The least recently used results are evicted when there
+    are more than max_entries results cached, or when their estimated size
+    goes over max_bytes.
+
+    Results expire after ttl seconds, or negative_ttl seconds for searches
+    which found nothing.
+
+    Writing to a DN invalidates every query whose scope could include it.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 ttl=60, negative_ttl=10):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        # key -> (expiry, size, results or exception)
+        self._entries = OrderedDict()
+        # base -> set of keys
+        self._bases = {}
+        self.size = 0
+        # Incremented by every invalidation
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the cached results for key, or None. A cached
+        ldap.NO_SUCH_OBJECT is raised. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._forget(key, entry)
+                self.misses += 1
+                return None
+
+            # Most recently used go last
+            self._entries[key] = entry
+            self.hits += 1
+
+        value = entry[2]
+        if isinstance(value, Exception):
+            raise value
+
+        # Callers own the results they get
+        return copy_results(value)
+
+    def put(self, key, value, generation=None):
+        """ Cache the results or the ldap.NO_SUCH_OBJECT of a search
+
+        When generation is given, the results are dropped if there was an
+        invalidation since the cache was at this generation, since they could
+        be outdated.
+        """
+        if generation is not None and generation != self.generation:
+            return
+
+        if isinstance(value, Exception) or not value:
+            expiry = time.time() + self.negative_ttl
+            size = 0
+        else:
+            expiry = time.time() + self.ttl
+            size = sum(
+                len(dn or "") + sum(
+                    len(k) + sum(len(val) for val in v)
+                    for k, v in (attrs or {}).iteritems())
+                for dn, attrs in value
+            )
+            if size > self.max_bytes:
+                return
+            value = copy_results(value)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+
+            self._entries[key] = (expiry, size, value)
+            self._bases.setdefault(key[0], set()).add(key)
+            self.size += size
+
+            while (len(self._entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                old_key, old = self._entries.popitem(last=False)
+                self._forget(old_key, old)
+                self.evictions += 1
+
+    def _forget(self, key, entry):
+        """ Cleanup after the removal of key, must hold the lock """
+        self.size -= entry[1]
+        keys = self._bases.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._bases[key[0]]
+
+    def _drop(self, keys):
+        """ Drop keys, must hold the lock """
+        for key in list(keys):
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget(key, entry)
+                self.invalidations += 1
+
+    def invalidate(self, dn, subtree=False):
+        """ Drop the results of searches that could include the normalized
+        dn. With subtree, searches based below dn are dropped too. """
+        parts = parse_dn(dn)
+        with self._lock:
+            self.generation += 1
+            for depth in range(len(parts) + 1):
+                base = ldap.dn.dn2str(parts[depth:])
+                keys = self._bases.get(base)
+                if not keys:
+                    continue
+                self._drop([
+                    key for key in keys
+                    if key[1] == ldap.SCOPE_SUBTREE
+                    or (key[1] == ldap.SCOPE_ONELEVEL and depth == 1)
+                    or depth == 0
+                ])
+
+            if subtree:
+                suffix = "," + dn
+                for base in [b for b in self._bases if b.endswith(suffix)]:
+                    self._drop(self._bases.get(base, ()))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bases.clear()
+            self.size = 0
@@ -0,0 +1,377 @@
+""" the delta module reads the entries changed since a previous run """
+
+import base64
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import threading
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+import ldap.filter
+from ldap.controls import (
+    LDAPControl,
+    RequestControl,
+    ResponseControl,
+    KNOWN_RESPONSE_CONTROLS,
+)
+from ldap.syncrepl import SyncreplConsumer
+from pyasn1.type import univ, namedtype
+from pyasn1.codec.ber import encoder, decoder
+
+from plow.errors import LdapAdaptorError
+from plow.pool import PooledLdapAdaptor
+from plow.replicas import ReplicatedLdapAdaptor
+
+
+# Active Directory controls
+SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+DIRSYNC_OID = "1.2.840.113556.1.4.841"
+
+
+class MemoryMarkStore(object):
+    """ Keeps high-water marks in memory, for the life of the process """
+    def __init__(self):
+        self._marks = {}
+
+    def get(self, key):
+        return self._marks.get(key)
+
+    def set(self, key, mark):
+        self._marks[key] = mark
+
+
+class FileMarkStore(object):
+    """ Keeps high-water marks in a JSON file
+
+    Any object with the same get(key) and set(key, mark) methods can be used
+    instead, to keep marks in a database for example. Marks are strings.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def set(self, key, mark):
+        with self._lock:
+            marks = self._read()
+            marks[key] = mark
+            # Never leave a truncated file behind
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(marks, f)
+            os.rename(tmp, self.path)
+
+
+class Delta(object):
+    """ The entries changed since a mark
+
+    changed is a list of (dn, attrs) results, deleted a list of
+    (dn, attrs) of the deleted entries reported by the server, with the
+    attributes identifying them (objectGUID, entryUUID...): their DN is the
+    tombstone's in Active Directory, or None when the server only sends
+    their entryUUID.
+    """
+    def __init__(self, changed, deleted, mark, previous):
+        self.changed = changed
+        self.deleted = deleted
+        self.mark = mark
+        # The mark the changes were read from, None for a full read
+        self.previous = previous
+
+    @property
+    def full(self):
+        return self.previous is None
+
+    def __repr__(self):
+        return "<Delta: {0} changed, {1} deleted since {2}>".format(
+            len(self.changed), len(self.deleted), self.previous)
+
+
+def max_value(results, attr, mark):
+    """ The greatest value of attr in results, or mark """
+    attr = attr.lower()
+    for dn, attrs in results:
+        for name, values in attrs.iteritems():
+            if name.lower() == attr:
+                for value in values:
+                    if mark is None or value > mark:
+                        mark = value
+    return mark
+
+
+class TimestampSource(object):
+    """ Changes found with an ordered attribute: modifyTimestamp, or
+    entryCSN on OpenLDAP
+
+    Entries changed at the mark itself are read again, since changes
+    could have been made during the same second. Deletes are not reported.
+    """
+    def __init__(self, attr="modifyTimestamp"):
+        self.attr = attr
+        self.name = attr
+
+    def fetch(self, reader, mark):
+        filterstr = reader.filterstr
+        if mark is not None:
+            filterstr = "(&{0}({1}>={2}))".format(
+                filterstr, self.attr, ldap.filter.escape_filter_chars(mark))
+
+        changed = reader.search(filterstr, reader.fetch_attrs(self.attr))
+        return changed, [], max_value(changed, self.attr, mark)
+
+
+class USNSource(object):
+    """ Changes found with the uSNChanged of Active Directory entries
+
+    USNs are local to a domain controller, so the marks are only good for
+    the server they were read from. With deletes, tombstones are read with
+    the show deleted control, which requires base_dn to be the naming
+    context.
+    """
+    name = "uSNChanged"
+
+    def __init__(self, deletes=True):
+        self.deletes = deletes
+
+    def fetch(self, reader, mark):
+        # Changes committed after this are for the next run
+        top = reader.la.root_dse(["highestCommittedUSN"])
+        top = top["highestCommittedUSN"][0]
+
+        window = "(uSNChanged<={0})".format(top)
+        if mark is not None:
+            window = "(&(uSNChanged>={0}){1})".format(int(mark) + 1, window)
+
+        changed = reader.search("(&{0}{1})".format(reader.filterstr, window),
+                                reader.fetch_attrs())
+        deleted = []
+        if self.deletes and mark is not None:
+            deleted = reader.search(
+                "(&(isDeleted=TRUE){0})".format(window),
+                ["objectGUID", "lastKnownParent", "uSNChanged"],
+                serverctrls=[LDAPControl(SHOW_DELETED_OID, True)])
+        return changed, deleted, top
+
+
+class DirSyncValue(univ.Sequence):
+    """ Both the request and response values of the DirSync control:
+    (flags, maxBytes, cookie) and (moreResults, unused, cookie) """
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('flags', univ.Integer()),
+        namedtype.NamedType('maxBytes', univ.Integer()),
+        namedtype.NamedType('cookie', univ.OctetString()),
+    )
+
+
+class DirSyncControl(RequestControl, ResponseControl):
+    """ The Active Directory DirSync control """
+    controlType = DIRSYNC_OID
+
+    def __init__(self, criticality=True, flags=0, max_bytes=0x7fffffff,
+                 cookie=''):
+        self.criticality = criticality
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.cookie = cookie
+        self.more_results = False
+
+    def encodeControlValue(self):
+        value = DirSyncValue()
+        value.setComponentByName('flags', self.flags)
+        value.setComponentByName('maxBytes', self.max_bytes)
+        value.setComponentByName('cookie', self.cookie)
+        return encoder.encode(value)
+
+    def decodeControlValue(self, encoded):
+        value = decoder.decode(encoded, asn1Spec=DirSyncValue())[0]
+        self.more_results = bool(int(value.getComponentByName('flags')))
+        self.cookie = str(value.getComponentByName('cookie'))
+
+KNOWN_RESPONSE_CONTROLS[DIRSYNC_OID] = DirSyncControl
+
+
+class DirSyncSource(object):
+    """ Changes read with the DirSync control of Active Directory
+
+    base_dn must be a naming context, and the account needs the "Replicating
+    Directory Changes" right. Deleted entries are reported with their
+    objectGUID. DirSync results are not paged, but sent in batches of up to
+    max_bytes.
+    """
+    name = "dirsync"
+
+    def __init__(self, flags=0, max_bytes=0x7fffffff):
+        self.flags = flags
+        self.max_bytes = max_bytes
+
+    def fetch(self, reader, mark):
+        la = reader.la
+        if not la.is_connected:
+            la.connect()
+
+        cookie = mark and base64.b64decode(mark) or ''
+        changed = []
+        deleted = []
+        more = True
+        while more:
+            ctrl = DirSyncControl(True, self.flags, self.max_bytes, cookie)
+            msgid = la._ldap.search_ext(reader.base_dn, ldap.SCOPE_SUBTREE,
+                                        reader.filterstr,
+                                        reader.fetch_attrs("isDeleted"),
+                                        serverctrls=[ctrl])
+            x, res, y, ctrls = la._ldap.result3(msgid)
+            more = False
+            for resp in ctrls:
+                if isinstance(resp, DirSyncControl):
+                    cookie, more = resp.cookie, resp.more_results
+
+            for dn, attrs in res:
+                if dn is None:
+                    continue
+                if attrs.get("isDeleted", ["FALSE"])[0].upper() == "TRUE":
+                    deleted.append((dn, attrs))
+                else:
+                    changed.append((dn, attrs))
+
+        return changed, deleted, base64.b64encode(cookie)
+
+
+class RefreshConsumer(SyncreplConsumer):
+    """ Collects the results of a refreshOnly content synchronization """
+    def __init__(self, la, cookie):
+        self.la = la
+        self.cookie = cookie
+        self.changed = []
+        self.deleted = []
+
+    def search_ext(self, *args, **kwargs):
+        return self.la._ldap.search_ext(*args, **kwargs)
+
+    def result4(self, *args, **kwargs):
+        return self.la._ldap.result4(*args, **kwargs)
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self.changed.append((dn, attrs))
+
+    def syncrepl_delete(self, uuids):
+        self.deleted.extend((None, {"entryUUID": [uuid]}) for uuid in uuids)
+
+
+class SyncCookieSource(object):
+    """ Changes read with a refreshOnly content synchronization (RFC 4533)
+    from the cookie of the previous run
+
+    Deletes are reported when the server can tell them, which for OpenLDAP
+    means a session log or the accesslog overlay. Otherwise the server
+    falls back to a present phase, in which deletes can not be known
+    without a local copy of the entries (see plow.mirror).
+    """
+    name = "syncrepl"
+
+    def fetch(self, reader, mark):
+        la = reader.la
+        if not la.is_connected:
+            la.connect()
+        consumer = RefreshConsumer(la, mark)
+        msgid = consumer.syncrepl_search(reader.base_dn, ldap.SCOPE_SUBTREE,
+                                         mode='refreshOnly',
+                                         filterstr=reader.filterstr,
+                                         attrlist=reader.fetch_attrs())
+        while consumer.syncrepl_poll(msgid=msgid, all=1):
+            pass
+        return consumer.changed, consumer.deleted, consumer.cookie
+
+
+class DeltaReader(object):
+    """ Reads the entries below base_dn matching filterstr which changed since
+    the previous run
+
+    source finds the changes from a high-water mark: TimestampSource,
+    USNSource, DirSyncSource or SyncCookieSource. The marks are kept in
+    store under key, which defaults to one made of the server, base, filter
+    and source.
+
+        reader = DeltaReader(la, TimestampSource(), FileMarkStore(path))
+        delta = reader.fetch()
+        for dn, attrs in delta.changed:
+            ...
+        reader.commit(delta)
+
+    The first run, without a mark, reads every entry.
+
+    With a ReplicatedLdapAdaptor, the changes are read from the primary, as
+    the marks of some sources are only good for the server they were read
+    from.
+    """
+    def __init__(self, la, source, store=None, key=None, base_dn=None,
+                 filterstr='(objectClass=*)', attrs=None):
+        if isinstance(la, ReplicatedLdapAdaptor):
+            la = la.primary.la
+        self.la = la
+        self.source = source
+        self.store = store if store is not None else MemoryMarkStore()
+        self.base_dn = base_dn or la.base_dn
+        self.filterstr = filterstr
+        self.attrs = attrs
+        self.key = key or " ".join([la._server_url, self.base_dn, filterstr,
+                                    source.name])
+
+    def fetch_attrs(self, *extra):
+        """ The attributes to request, with the extra ones the source needs """
+        if self.attrs is None:
+            return ["*"] + list(extra)
+        return list(self.attrs) + list(extra)
+
+    def search(self, filterstr, attrs, serverctrls=None):
+        """ Search the server, never the adaptor's cache or mirror """
+        return self.la._search(self.base_dn, ldap.SCOPE_SUBTREE, filterstr,
+                               attrs, 1000, None, serverctrls)
+
+    @contextmanager
+    def _connection(self):
+        """ Hold a connection of a pooled adaptor for the block, as the
+        sources use the connection of the adaptor directly """
+        if isinstance(self.la, PooledLdapAdaptor):
+            with self.la.connection():
+                yield
+        else:
+            yield
+
+    def fetch(self, commit=False):
+        """ Read the changes since the stored mark. The new mark is only
+        stored by commit(), once the changes are processed, unless commit is
+        set. """
+        previous = self.store.get(self.key)
+        LOG.debug("Reading changes of %s since %s", self.base_dn, previous)
+        with self._connection():
+            changed, deleted, mark = self.source.fetch(self, previous)
+        delta = Delta(changed, deleted, mark, previous)
+        LOG.info("%s: %r", self.key, delta)
+        if commit:
+            self.commit(delta)
+        return delta
+
+    def commit(self, delta):
+        """ Store the mark of delta, for the next fetch() to start from """
+        if delta.mark is None:
+            raise LdapAdaptorError("No mark to commit for {0}".format(
+                self.key))
+        self.store.set(self.key, delta.mark)
@@ -0,0 +1,256 @@
+""" the dit module indexes the tree of the DNs of a directory """
+
+import threading
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+import ldap.dn
+
+from plow.utils import parse_dn
+
+
+def is_within(parts, bases):
+    """ Check if the parsed DN parts is one of the parsed DNs bases, or
+    below one """
+    for base in bases:
+        if len(parts) >= len(base) and parts[len(parts) - len(base):] == base:
+            return True
+    return False
+
+
+class DITNode(object):
+    """ An entry of the index, or a DN on the path to one """
+    __slots__ = ("dn", "ndn", "parent", "children", "depth", "entry")
+
+    def __init__(self, dn, ndn, parent):
+        self.dn = dn
+        self.ndn = ndn
+        self.parent = parent
+        # RDN -> child node
+        self.children = {}
+        self.depth = parent.depth + 1 if parent is not None else 0
+        # False for the nodes only known as the parents of entries
+        self.entry = False
+
+    def __repr__(self):
+        return "<DITNode: {0}>".format(self.dn)
+
+
+class DITIndex(object):
+    """ A tree of the DNs of the entries below one or more bases, answering
+    navigation questions without server calls
+
+        dit = DITIndex(la)
+        la.dit = dit  # or LdapAdaptor(dit=...)
+        dit.load("ou=people,dc=example,dc=com")
+        dit.is_under(user_dn, ou_dn)
+        dit.children(ou_dn)
+        dit.ancestors(user_dn)
+
+    DNs are matched in their normalized form (see LdapAdaptor.normalize_dn),
+    and given back as the server returned them. is_under(), children() and
+    ancestors() take a time proportional to the depth of the DNs.
+
+    The adds, deletes and renames made through an adaptor having the index
+    keep it current. Changes made by others are only seen by loading the
+    index again.
+    """
+    def __init__(self, la):
+        self.la = la
+        self._lock = threading.Lock()
+        self._root = DITNode("", "", None)
+        # normalized DN -> node
+        self._nodes = {"": self._root}
+        # Parsed normalized DNs of the subtrees loaded entirely
+        self._bases = []
+        # Parsed normalized DNs of the subtrees moved into them, the entries
+        # of which are not known
+        self._holes = []
+
+    def __len__(self):
+        return sum(1 for node in self._nodes.itervalues() if node.entry)
+
+    def __contains__(self, dn):
+        node = self._node(dn)
+        return node is not None and node.entry
+
+    @property
+    def loaded(self):
+        return bool(self._bases)
+
+    def load(self, base_dn=None, filterstr='(objectClass=*)', page_size=1000):
+        """ Index the DNs of the entries below base_dn matching filterstr
+
+        Only the subtrees loaded with the default filter are known to be
+        complete, which lets covers() tell an entry does not exist.
+        """
+        base_dn = base_dn or self.la.base_dn
+        count = 0
+        # 1.1 asks for no attributes
+        for dn, attrs in self.la.iter_search(base_dn, ldap.SCOPE_SUBTREE,
+                                             filterstr, ["1.1"], page_size):
+            if dn is not None:
+                self.add(dn, check=False)
+                count += 1
+
+        if filterstr == '(objectClass=*)':
+            base = parse_dn(self.la.normalize_dn(base_dn))
+            with self._lock:
+                self._bases.append(base)
+                self._holes = [hole for hole in self._holes
+                               if not is_within(hole, [base])]
+        LOG.info("Indexed %(count)d entries below %(base)s",
+                 {"count": count, "base": base_dn})
+
+    def add_results(self, res):
+        """ Index the DNs of search results """
+        for dn, attrs in res:
+            if dn is not None:
+                self.add(dn, check=False)
+
+    def covers(self, dn):
+        """ Check if dn is in a subtree which was loaded entirely """
+        parts = parse_dn(self.la.normalize_dn(dn))
+        return is_within(parts, self._bases) and not is_within(parts,
+                                                                self._holes)
+
+    def _node(self, dn):
+        return self._nodes.get(self.la.normalize_dn(dn))
+
+    def add(self, dn, check=True):
+        """ Index an entry. With check, it is ignored unless it is in a
+        loaded subtree, so that the index only knows about the parts of the
+        tree it was loaded with. """
+        if check and not self.covers(dn):
+            return
+
+        ndn = self.la.normalize_dn(dn)
+        with self._lock:
+            node = self._nodes.get(ndn)
+            if node is None:
+                node = self._make_node(parse_dn(ndn))
+            node.dn = dn
+            node.entry = True
+
+    def _make_node(self, parts):
+        """ The node of the parsed normalized DN, created with its missing
+        parents, must hold the lock """
+        ndn = ldap.dn.dn2str(parts)
+        node = self._nodes.get(ndn)
+        if node is None:
+            parent = self._make_node(parts[1:])
+            node = DITNode(ndn, ndn, parent)
+            parent.children[parts[0]] = node
+            self._nodes[ndn] = node
+        return node
+
+    def discard(self, dn):
+        """ Forget an entry, and the entries below it """
+        with self._lock:
+            node = self._nodes.get(self.la.normalize_dn(dn))
+            if node is None or node is self._root:
+                return
+            parent = node.parent
+            del parent.children[parse_dn(node.ndn)[0]]
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                self._nodes.pop(node.ndn, None)
+                stack.extend(node.children.itervalues())
+
+            # Drop the parents only kept for the path to the entry
+            while (parent is not self._root and not parent.entry and
+                   not parent.children):
+                del parent.parent.children[parse_dn(parent.ndn)[0]]
+                self._nodes.pop(parent.ndn, None)
+                parent = parent.parent
+
+    def rename(self, dn, newrdn, newsuperior=None):
+        """ Move an entry and the entries below it
+
+        An entry which was not indexed is not added to the index, and when
+        it is moved into a loaded subtree, that subtree is no longer covered
+        below it, as its entries are not known.
+        """
+        parts = parse_dn(dn)
+        newparts = parse_dn(newrdn)[:1] + (
+            parse_dn(newsuperior) if newsuperior is not None else parts[1:])
+        indexed = dn in self
+        moved = [(dn, True)] + list(self._subtree(dn))
+        self.discard(dn)
+
+        newbase = ldap.dn.dn2str(newparts)
+        if not self.covers(newbase):
+            return
+        if not indexed:
+            with self._lock:
+                self._holes.append(parse_dn(self.la.normalize_dn(newbase)))
+            return
+
+        for olddn, entry in moved:
+            tail = parse_dn(olddn)[:len(parse_dn(olddn)) - len(parts)]
+            newdn = ldap.dn.dn2str(tail + newparts)
+            if entry:
+                self.add(newdn, check=False)
+
+    def _subtree(self, dn):
+        """ (dn, entry) of the nodes below dn """
+        node = self._node(dn)
+        stack = node and list(node.children.values()) or []
+        while stack:
+            node = stack.pop()
+            yield node.dn, node.entry
+            stack.extend(node.children.values())
+
+    def subtree(self, dn):
+        """ The DNs of the entries below dn """
+        return [child for child, entry in self._subtree(dn) if entry]
+
+    def children(self, dn):
+        """ The DNs directly below dn: entries, and parents of entries """
+        node = self._node(dn)
+        if node is None:
+            return []
+        return [child.dn for child in node.children.values()]
+
+    def parent(self, dn):
+        """ The DN of the parent of dn, None for a top entry """
+        ancestors = self.ancestors(dn, 1)
+        return ancestors and ancestors[0] or None
+
+    def ancestors(self, dn, limit=None):
+        """ The DNs of the indexed entries above dn, nearest first """
+        node = self._node(dn)
+        if node is None:
+            return []
+        res = []
+        node = node.parent
+        while node is not None and (limit is None or len(res) < limit):
+            if node.entry:
+                res.append(node.dn)
+            node = node.parent
+        return res
+
+    def is_under(self, dn, base):
+        """ Check if dn is strictly below base """
+        node, top = self._node(dn), self._node(base)
+        if node is None or top is None:
+            # Compare the DNs themselves
+            parts = parse_dn(self.la.normalize_dn(dn))
+            baseparts = parse_dn(self.la.normalize_dn(base))
+            return (len(parts) > len(baseparts) and
+                    parts[len(parts) - len(baseparts):] == baseparts)
+
+        if node.depth <= top.depth:
+            return False
+        while node.depth > top.depth:
+            node = node.parent
+        return node is top
+
+    def clear(self):
+        with self._lock:
+            self._root.children.clear()
+            self._nodes = {"": self._root}
+            self._bases = []
+            self._holes = []
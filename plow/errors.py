@@ -4,6 +4,32 @@
 class DNConflict(Exception):
     """ Conflict in LDAP tree """
 
+class UnfetchedAttribute(Exception):
+    """ Access to an attribute which was not requested when reading an
+    object """
+
 class LdapAdaptorError(Exception):
     """ Base class for LdapAdaptor exceptions """
 
+
+class UnsupportedFilter(LdapAdaptorError):
+    """ A search filter which can not be evaluated locally """
+
+
+class PartialModification(LdapAdaptorError):
+    """ A modify sent in chunks which were not all applied
+
+    applied is the list of the modlists which were, failed the list of
+    (modlist, exception) of the ones which failed, and unsent the list of
+    the modlists which were not sent after a failure.
+    """
+    def __init__(self, dn, applied, failed, unsent):
+        LdapAdaptorError.__init__(
+            self, "{0} of {1} chunks of the modification of {2} failed, "
+            "{3} were not sent".format(
+                len(failed), len(applied) + len(failed) + len(unsent), dn,
+                len(unsent)))
+        self.dn = dn
+        self.applied = applied
+        self.failed = failed
+        self.unsent = unsent
@@ -1,8 +1,11 @@
 """ the ldapadaptor module handles low-level LDAP operations """
 
+from collections import deque
 from functools import wraps
 import operator
+import random
 import re
+import time
 import logging
 LOG = logging.getLogger(__name__)
 
@@ -12,7 +15,17 @@ import ldap.dn
 
 from ldap.controls import SimplePagedResultsControl as PagedCtrl
 
-from plow.errors import LdapAdaptorError
+from plow.batch import WriteBatch
+from plow.errors import LdapAdaptorError, PartialModification
+from plow.utils import (
+    BoundedCache,
+    CANONICAL_DN,
+    chunk_modlist,
+    count_values,
+    intern_dn,
+    is_ordered,
+    parse_dn,
+)
 
 try:
     ldap.CONTROL_PAGEDRESULTS
@@ -26,8 +39,40 @@ except AttributeError:
     make_page_control = PCtrlAdapter
     get_page_control = operator.attrgetter("controlValue")
 
+try:
+    from ldap.controls.sss import SSSRequestControl
+    from ldap.controls.vlv import VLVRequestControl, VLVResponseControl
+except ImportError:
+    # < 2.4 version, no server side sorting
+    SSSRequestControl = VLVRequestControl = VLVResponseControl = None
+
 RANGED_ATTR = re.compile("(?P<name>.*);range=(?P<start>\d+)-(?P<end>\*|\d+)$")
 
+def make_sort_control(sort):
+    """ Returns a server side sort control for sort, an attribute name or a
+    list of them, each optionally prefixed with - for a reverse order and
+    suffixed with :orderingRule """
+    if SSSRequestControl is None:
+        raise LdapAdaptorError("Server side sorting needs python-ldap 2.4")
+    if isinstance(sort, basestring):
+        sort = [sort]
+    return SSSRequestControl(True, list(sort))
+
+
+class ResultWindow(list):
+    """ A window of sorted search results, see LdapAdaptor.search()
+
+    offset is the position of the first result in the whole sorted list, and
+    content_count the server's estimate of the size of that list.
+    """
+    def __init__(self, results, offset, content_count, context_id=None):
+        list.__init__(self, results)
+        self.offset = offset
+        self.content_count = content_count
+        # Can be passed back to the server for the next window
+        self.context_id = context_id
+
+
 def get_new_ranges(attrs):
     """ Returns a list of attributes that need to be fetched to complete
     the attribute dict `attrs`. Those are all the attributes in the form
@@ -39,7 +84,9 @@ def get_new_ranges(attrs):
     extra = [
         m.groupdict()
         for m in
-            (RANGED_ATTR.match(attrname) for attrname in attrs)
+            (RANGED_ATTR.match(attrname)
+             for attrname in attrs
+             if ";range=" in attrname)
         if m is not None
     ]
 
@@ -53,25 +100,281 @@ def get_new_ranges(attrs):
     ]
 
 
+class AdaptivePageSize(object):
+    """ Tunes the page size of paged searches from the pages received
+
+    Pass it as the page_size of an LdapAdaptor, or of a search. Each page
+    asked for is as large as the previous pages show can be returned in
+    about target_time seconds, and in less than target_bytes bytes of
+    values, within [min_size, max_size]. Sizes grow by a factor of at most
+    growth from one page to the next, but shrink at once.
+
+    The sizes are learned separately for each list of requested attributes,
+    as fetching DNs only and fetching large multi-valued attributes make
+    for very different pages. When the server returns fewer entries than
+    asked for while having more, like the MaxPageSize of Active Directory,
+    sizes are kept under its limit. A page exceeding a time or
+    administrative limit is requested again with half its size.
+    """
+    def __init__(self, initial=1000, min_size=50, max_size=10000,
+                 target_time=1.0, target_bytes=4 * 1024 * 1024, growth=2):
+        self.initial = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_time = target_time
+        self.target_bytes = target_bytes
+        self.growth = growth
+        # Entries per page returned by the server, when it has a limit
+        self.server_limit = None
+        # attributes -> learned size
+        self._sizes = {}
+
+    @staticmethod
+    def _key(attrs):
+        return attrs and tuple(sorted(attr.lower() for attr in attrs))
+
+    def _bound(self, size):
+        size = min(int(size), self.max_size, self.server_limit or size)
+        return max(size, self.min_size)
+
+    def size(self, attrs):
+        """ The page size to start a search for attrs with """
+        return self._sizes.get(self._key(attrs), self._bound(self.initial))
+
+    def observe(self, attrs, requested, entries, elapsed, size, more):
+        """ Returns the size of the next page, after a page of entries
+        results and size bytes came in elapsed seconds for a request of
+        requested entries. more tells if the server has more pages. """
+        if more and 0 < entries < requested:
+            # The server has its own maximum page size
+            self.server_limit = entries
+
+        wanted = requested * self.growth
+        if entries:
+            if elapsed > 0:
+                wanted = min(wanted, self.target_time * entries / elapsed)
+            if size > 0:
+                wanted = min(wanted, self.target_bytes * entries / size)
+        if not more and entries < requested:
+            # A last, partial page can't tell how much more would fit
+            wanted = min(wanted, requested)
+
+        new = self._bound(wanted)
+        self._sizes[self._key(attrs)] = new
+        return new
+
+    def shrink(self, attrs, requested):
+        """ Returns the size to request a page which exceeded a server limit
+        with, or None when it can't be made smaller """
+        if requested <= self.min_size:
+            return None
+        new = self._bound(requested // 2)
+        self._sizes[self._key(attrs)] = new
+        return new
+
+    def __repr__(self):
+        return "<AdaptivePageSize: {0}>".format(self._sizes)
+
+
+class PagedSearch(object):
+    """ A search using the paged results control
+
+    Iterating over it yields result pages, with ranged attributes completed.
+
+    When read_ahead is set, the next page is requested while the current page
+    is processed, instead of waiting for the caller to ask for it. As the
+    cookie of a page only comes with the page before it, a single request can
+    be in flight and read_ahead is capped to 1.
+
+    serverctrls are sent with every page request, along with the paging
+    control.
+
+    page_size can be an AdaptivePageSize, which then picks the size of
+    every page.
+    """
+    # Entries handed out by iter_entries() between checks for the pages
+    # read ahead
+    poll_interval = 100
+
+    def __init__(self, la, base_dn, scope, filterstr, attrs,
+                 page_size=1000, read_ahead=0, serverctrls=None):
+        self._la = la
+        self.base_dn = base_dn
+        self.scope = scope
+        self.filterstr = filterstr
+        self.attrs = attrs
+        self.sizer = None
+        if isinstance(page_size, AdaptivePageSize):
+            self.sizer = page_size
+            page_size = page_size.size(attrs)
+        self.page_size = page_size
+        # Reading more pages ahead would not have more requests in flight
+        self.read_ahead = min(read_ahead, 1)
+        self.serverctrls = serverctrls or []
+
+        # Pages received but not handed out yet
+        self._pages = deque()
+        self._query_id = None
+        # The cookie of the next page to request, None when there is none
+        self._cookie = ''
+        # The cookie and time of the pending request
+        self._sent_cookie = None
+        self._sent_at = None
+
+    @property
+    def _ldap(self):
+        return self._la._ldap
+
+    def _send(self):
+        # Use?
+        #filterstr = ldap.filter.escape_filter_chars(filterstr)
+        paging_ctrl = make_page_control(False, self.page_size, self._cookie)
+        self._sent_at = time.time()
+        self._query_id = self._ldap.search_ext(self.base_dn,
+                                               self.scope,
+                                               self.filterstr,
+                                               self.attrs,
+                                               serverctrls=[paging_ctrl] +
+                                                   self.serverctrls)
+        self._sent_cookie = self._cookie
+        self._cookie = None
+
+    def _result(self, block):
+        try:
+            if block:
+                return self._ldap.result3(self._query_id)
+            return self._ldap.result3(self._query_id, timeout=0)
+        except (ldap.TIMELIMIT_EXCEEDED, ldap.ADMINLIMIT_EXCEEDED), e:
+            size = self.sizer and self.sizer.shrink(self.attrs, self.page_size)
+            if size is None:
+                raise
+            LOG.info("Page of %(size)d entries failed with %(error)s, "
+                     "retrying with %(new)d", {
+                         "size": self.page_size, "error": e, "new": size})
+            self._query_id = None
+            self.page_size = size
+            self._cookie = self._sent_cookie
+            self._send()
+            return self._result(block)
+
+    def poll(self, block=False):
+        """ Collect the requested page if it is available, and request the
+        next one if read_ahead allows it. """
+        if self._query_id is not None:
+            rtype, res, y, ctrls = self._result(block)
+            if rtype is None:
+                # Still waiting for the server
+                return
+
+            self._query_id = None
+            self._pages.append(res)
+            self._la._record_results(res)
+
+            # extract cookie if supplied by server
+            page_cookie = ''
+            for ext in ctrls:
+                if isinstance(ext, PagedCtrl):
+                    x, page_cookie = get_page_control(ext)
+
+            # Paging not supported or end of paging
+            self._cookie = page_cookie or None
+            if self.sizer is not None:
+                self._adapt(res, bool(self._cookie))
+
+        if (self._query_id is None and self._cookie is not None
+            and len(self._pages) < self.read_ahead):
+            self._send()
+
+    def _adapt(self, res, more):
+        """ Pick the size of the next page from the one just received """
+        elapsed = time.time() - self._sent_at
+        size = 0
+        for dn, attrs in res:
+            for vals in (attrs or {}).itervalues():
+                size += sum(len(val) for val in vals)
+
+        new = self.sizer.observe(self.attrs, self.page_size, len(res),
+                                 elapsed, size, more)
+        if new != self.page_size:
+            LOG.debug("Page size %(old)d -> %(new)d after %(entries)d "
+                      "entries, %(size)d bytes in %(elapsed).3fs", {
+                          "old": self.page_size, "new": new,
+                          "entries": len(res), "size": size,
+                          "elapsed": elapsed})
+        self.page_size = new
+        if self._la.metrics is not None:
+            self._la.metrics.gauge("search.page_size", new)
+
+    def __iter__(self):
+        try:
+            self._send()
+            while True:
+                if not self._pages:
+                    if self._query_id is None:
+                        if self._cookie is None:
+                            break
+                        self._send()
+                    self.poll(block=True)
+                    continue
+
+                res = self._pages.popleft()
+                # We have room for one more page
+                self.poll()
+                self._la._complete_ranges(res)
+                yield res
+
+        finally:
+            if self._query_id is not None:
+                # The caller gave up on the search
+                self._ldap.abandon(self._query_id)
+                self._query_id = None
+
+    def iter_entries(self):
+        """ Generator of all the (dn, attrs) results """
+        for page in self:
+            for i, res in enumerate(page, 1):
+                yield res
+                if not i % self.poll_interval:
+                    self.poll()
+
+
 def check_connected(f):
     """ Utility decorator to retry connection on ldap.SERVER_DOWN """
     @wraps(f)
     def _newcall_(self, *args, **kwargs):
         if not self.is_connected:
             LOG.debug("check_connected -> not connected")
-            self.initialize(self._server_url)
-            self.bind(self._binduser, self._bindpw)
+            self.connect()
         try:
             return f(self, *args, **kwargs)
         except ldap.SERVER_DOWN, down:
             LOG.debug("check_connected -> server down")
             #Make a reconnect attempt
             self.is_connected = False
-            self.initialize(self._server_url)
-            self.bind(self._binduser, self._bindpw)
+            self.reconnect()
         return f(self, *args, **kwargs)
     return _newcall_
 
+def timed(f):
+    """ Utility decorator recording the duration of an operation, and its
+    failures, in the adaptor's metrics """
+    name = f.__name__
+    @wraps(f)
+    def _timed_(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is None:
+            return f(self, *args, **kwargs)
+
+        start = time.time()
+        try:
+            return f(self, *args, **kwargs)
+        except Exception:
+            metrics.incr(name + ".errors")
+            raise
+        finally:
+            metrics.timing(name, time.time() - start)
+    return _timed_
+
 class LdapAdaptor(object):
     def __init__ (self,
                   server_uri,
@@ -83,10 +386,59 @@ class LdapAdaptor(object):
                   case_insensitive_dn=False,
                   dry_run=False,
                   require_delold=False,
+                  read_ahead=0,
+                  page_size=1000,
+                  lazy=False,
+                  reconnect_tries=3,
+                  reconnect_delay=0.5,
+                  reconnect_max_delay=30,
+                  cache=None,
+                  mirror=None,
+                  metrics=None,
+                  dn_cache_size=100000,
+                  dit=None,
+                  modlist_cost=None,
+                  modify_chunk_size=None,
+                  modify_window=8,
                  ):
         """
         Creates the instance, initializing a connection and binding to the LDAP
-        server.
+        server, unless lazy is set, in which case this is done by the first
+        operation.
+
+        read_ahead is the default number of result pages to request ahead of
+        the page being processed by paged searches, 0 disables it and values
+        above 1 are handled as 1, see PagedSearch.
+
+        page_size is the default number of entries per page of searches, or
+        an AdaptivePageSize to have it tuned from the pages received.
+
+        When the server goes down, up to reconnect_tries connection attempts
+        are made, each preceded by a random delay of up to reconnect_delay
+        seconds, doubled at each attempt and capped at reconnect_max_delay.
+
+        cache can be a plow.cache.SearchCache, to keep search() results. It
+        is invalidated by the writes made through this adaptor.
+
+        mirror can be a plow.mirror.DirectoryMirror, to answer the searches
+        it can from its local copy of the directory.
+
+        metrics can be a plow.metrics.MetricsCollector, to record the
+        duration of operations and the volume of search results.
+
+        dn_cache_size is the number of normalized DNs to keep.
+
+        dit can be a plow.dit.DITIndex, to answer tree navigation questions
+        without server calls. It is updated by the writes made through this
+        adaptor.
+
+        modlist_cost can be a plow.utils.ModlistCost, to have LdapClass
+        objects saved with whichever of replacing or adding and removing
+        values is smaller, for each attribute, when not saved atomically.
+
+        modify_chunk_size is the maximum number of values sent by one modify,
+        larger modifications being split in chunks. Up to modify_window
+        chunks are sent without waiting for the previous ones to complete.
         """
         self._connected = False
         self._bound = False
@@ -98,12 +450,27 @@ class LdapAdaptor(object):
         self._case_insensitive_dn = case_insensitive_dn
         self._referrals = referrals
         self.require_delold = require_delold
-
-        # FIXME : Defer initialization until connection is needed
-        self.initialize (self._server_url)
-        self.bind(self._binduser, self._bindpw)
+        self.read_ahead = read_ahead
+        self.page_size = page_size
+        self.reconnect_tries = reconnect_tries
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.cache = cache
+        self.mirror = mirror
+        self.metrics = metrics
+        self.dit = dit
+        self.modlist_cost = modlist_cost
+        self.modify_chunk_size = modify_chunk_size
+        self.modify_window = modify_window
+        self._normalized_dns = BoundedCache(dn_cache_size)
+        # Time spent connecting and binding, in seconds, and number of times
+        self.connect_time = 0.0
+        self.connect_count = 0
         self._dry_run = dry_run
 
+        if not lazy:
+            self.connect()
+
     def is_dry_run(self):
         if hasattr(self._dry_run, "__call__"):
             return self._dry_run()
@@ -136,7 +503,7 @@ class LdapAdaptor(object):
         ldap.VERSION is 3, but can be changed passing the desired version
         as a parameter.
         """
-        LOG.info("Initializing connection with server %s ..." % server)
+        LOG.info("Initializing connection with server %s ...", server)
         try:
             ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
             if self._referrals is None:
@@ -152,6 +519,43 @@ class LdapAdaptor(object):
             raise
         self._ldap.protocol_version = p_version
 
+    def connect(self):
+        """
+        Initializes the connection and binds with the adaptor's credentials.
+        """
+        start = time.time()
+        try:
+            self.initialize(self._server_url)
+            self.bind(self._binduser, self._bindpw)
+        finally:
+            elapsed = time.time() - start
+            self.connect_time += elapsed
+            self.connect_count += 1
+            if self.metrics is not None:
+                self.metrics.timing("connect", elapsed)
+            LOG.debug("Connection to %s took %.3fs", self._server_url, elapsed)
+
+    def reconnect(self):
+        """
+        Connects again, with exponential backoff and jitter between the
+        attempts while the server is down.
+        """
+        if self.metrics is not None:
+            self.metrics.incr("reconnects")
+        attempt = 0
+        while True:
+            delay = min(self.reconnect_max_delay,
+                        self.reconnect_delay * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+            try:
+                return self.connect()
+            except ldap.SERVER_DOWN:
+                if attempt >= self.reconnect_tries:
+                    raise
+                LOG.info("Reconnect attempt %d to %s failed",
+                         attempt, self._server_url)
+
     # FIXME: the client of the interface doesn't care to bind and unbind :
     # should be managed internaly If the client code tries to do a
     # client.add() call without a client.bind(), it will fail and it's bad.
@@ -162,7 +566,7 @@ class LdapAdaptor(object):
         Once we have an LDAPObject instance, we need to bind to the LDAP server. The
         python-ldap API supports both simple and SASL binding methods.
         """
-        LOG.info("Binding to the server with user %s ..." % user_dn)
+        LOG.info("Binding to the server with user %s ...", user_dn)
 
         if not self.is_connected:
             self.initialize(self._server_url)
@@ -196,6 +600,7 @@ class LdapAdaptor(object):
             # or a successful unbind
             self.is_connected = False
 
+    @timed
     @check_connected
     def add (self, dn, add_record):
         """
@@ -208,9 +613,9 @@ class LdapAdaptor(object):
         structure in the format of a dictionnary in the format used here by
         add_record.
         """
-        LOG.debug("%(dry_run_msg)sAdding %(dn)s:  %(data)s..." %
+        LOG.debug("%(dry_run_msg)sAdding %(dn)s:  %(data)r...",
             {"dry_run_msg": self._dry_run_msg(),
-             "dn": dn, "data": repr(add_record)})
+             "dn": dn, "data": add_record})
         if self.is_dry_run():
             return
         try:
@@ -219,17 +624,22 @@ class LdapAdaptor(object):
                 raise LdapAdaptorError(
                     "add: unexpected result %(type)s : %(result)s" %
                     {"type": str(result_type), "result": result_data})
+            self._track_write("add", dn)
         except ldap.ALREADY_EXISTS, e:
             LOG.error("Record already exists")
             raise
+        finally:
+            # Once the server has it, so that a search made meanwhile on
+            # another connection does not cache the entry as it was
+            self._invalidate(dn)
 
+    @timed
     @check_connected
     def delete (self, dn):
         """
         Delete an ldap entry.
         """
-        LOG.debug("{dryrunmsg}Deleting {dn}..."
-                        .format(dryrunmsg = self._dry_run_msg(), dn = dn))
+        LOG.debug("%sDeleting %s...", self._dry_run_msg(), dn)
         if self.is_dry_run():
             return
         try:
@@ -239,17 +649,27 @@ class LdapAdaptor(object):
                 raise LdapAdaptorError(
                     "delete : unexpected result %(type)s : %(result)s" %
                      {"type": str(result_type), "result": result_data})
+            self._track_write("delete", dn)
         except ldap.LDAPError, e:
             LOG.error("Caught ldap error: %s", str(e))
             raise
+        finally:
+            self._invalidate(dn, subtree=True)
 
+    @timed
     @check_connected
-    def modify (self, dn, mod_attrs):
+    def modify (self, dn, mod_attrs, progress=None):
         """ Modify ldap attributes
 
         mod_attrs is a list of modification three-tuples
         (modification type, attribute name, value)
 
+        With modify_chunk_size set, modifications carrying more values are
+        sent as a pipeline of modifies of at most modify_chunk_size values,
+        progress being called with (chunks completed, number of chunks) as
+        they complete. PartialModification is raised when some chunks are
+        not applied, telling which ones were.
+
         The modification type can be one of the followings:
         - ldap.MOD_ADD : add the value to an attribute, if the schema allows
         - ldap.MOD_DELETE : remove the value from the attribute, if it exists
@@ -259,11 +679,16 @@ class LdapAdaptor(object):
         strucutre in the format of a dictionnary in the format used here by
         mod_attrs.
         """
-        LOG.debug("%(dry_run_msg)sModifying %(dn)s: %(attrs)s" %
+        LOG.debug("%(dry_run_msg)sModifying %(dn)s: %(attrs)s",
             {"dry_run_msg": self._dry_run_msg(),
-             "dn": dn, "attrs": str(mod_attrs)})
+             "dn": dn, "attrs": mod_attrs})
         if self.is_dry_run():
             return
+        if (self.modify_chunk_size and
+                count_values(mod_attrs) > self.modify_chunk_size):
+            return self._modify_chunks(
+                dn, chunk_modlist(mod_attrs, self.modify_chunk_size), progress)
+
         try:
             res = self._ldap.modify_s (dn, mod_attrs)
             result_type, result_data = res[0], res[1]
@@ -274,14 +699,72 @@ class LdapAdaptor(object):
         except ldap.LDAPError, e:
             LOG.error("Caught ldap error: %s", str(e))
             raise
+        finally:
+            self._invalidate(dn)
+
+    def _modify_chunks(self, dn, chunks, progress=None):
+        """ Send the chunks of a modification through a WriteBatch, see
+        modify() """
+        LOG.info("Modifying %(dn)s in %(count)d chunks",
+                 {"dn": dn, "count": len(chunks)})
+        ops = []
+        completed = [0]
 
+        def report():
+            # The batch completes the operations in order
+            while completed[0] < len(ops) and ops[completed[0]].done:
+                completed[0] += 1
+                if progress is not None:
+                    progress(completed[0], len(chunks))
+
+        # The chunk which could not be sent, with the error
+        lost = []
+        try:
+            # The batch of a PooledLdapAdaptor is only a context manager
+            with self.batch(self.modify_window) as batch:
+                for chunk in chunks:
+                    if not is_ordered(chunk):
+                        ops.append(batch.modify(dn, chunk))
+                        report()
+                        continue
+
+                    # Replaces must be applied after the chunks before them,
+                    # and before the ones after them, which are not sent when
+                    # they can't be
+                    batch.flush()
+                    if batch.failures:
+                        break
+                    ops.append(batch.modify(dn, chunk))
+                    batch.flush()
+                    report()
+                    if batch.failures:
+                        break
+        except ldap.SERVER_DOWN, down:
+            # The batch could not reconnect. This must not reach
+            # check_connected, which would send the applied chunks again.
+            LOG.error("Modifying %(dn)s in chunks failed: %(error)s",
+                      {"dn": dn, "error": str(down)})
+            lost.append((chunks[len(ops)], down))
+        report()
+
+        if self.metrics is not None:
+            self.metrics.incr("modify.chunks", len(ops))
+        failed = [(op.args[0], op.error) for op in ops if op.error] + lost
+        if failed:
+            raise PartialModification(
+                dn,
+                [op.args[0] for op in ops if op.ok],
+                failed,
+                chunks[len(ops) + len(lost):])
+
+    @timed
     @check_connected
     def rename (self, dn, newrdn, newsuperior=None, delold=1):
         """
         Perform a modify RDN operation.
         """
         LOG.debug(
-            "%(dry_run)sModifying dn %(dn)s to %(newrdn)s%(newsuperior)s..." %
+            "%(dry_run)sModifying dn %(dn)s to %(newrdn)s%(newsuperior)s...",
             {"dry_run": self._dry_run_msg(),
              "dn": dn, "newrdn": newrdn,
              "newsuperior": newsuperior and "," + newsuperior or "" })
@@ -297,77 +780,341 @@ class LdapAdaptor(object):
                 raise LdapAdaptorError(
                     "rename: unexpected result %(type)s : %(result)s" %
                     {"type": str(result_type), "result": result_data})
+            self._track_write("rename", dn, (newrdn, newsuperior))
         except ldap.LDAPError, e:
             LOG.error("Caught ldap error: %s", str(e))
             raise
+        finally:
+            self._invalidate_rename(dn, newrdn, newsuperior)
+
+    def _invalidate(self, dn, subtree=False):
+        """ Invalidate the cached searches which could include dn """
+        if self.cache is not None:
+            self.cache.invalidate(self.normalize_dn(dn), subtree)
+
+    def _invalidate_rename(self, dn, newrdn, newsuperior=None):
+        """ Invalidate the cached searches affected by a rename """
+        if self.cache is not None:
+            self._invalidate(dn, subtree=True)
+            newdn = parse_dn(newrdn)[:1]
+            if newsuperior is None:
+                newdn += parse_dn(dn)[1:]
+            else:
+                newdn += parse_dn(newsuperior)
+            self._invalidate(ldap.dn.dn2str(newdn), subtree=True)
+
+    def _track_write(self, name, dn, args=()):
+        """ Update the DIT index after a successful write """
+        if self.dit is None:
+            return
+        if name == "add":
+            self.dit.add(dn)
+        elif name == "delete":
+            self.dit.discard(dn)
+        elif name == "rename":
+            self.dit.rename(dn, args[0], args[1])
 
     @check_connected
+    def batch(self, window=64):
+        """
+        Returns a WriteBatch, to send add, delete, modify and rename
+        operations without waiting for each result. At most window operations
+        are waiting for their result at any time.
+        """
+        return WriteBatch(self, window)
+
+    @timed
     def search (self,
                 base_dn=None,
                 scope=ldap.SCOPE_SUBTREE,
                 filterstr='(objectClass=*)',
                 attrs=None,
-                page_size=1000):
+                page_size=None,
+                read_ahead=None,
+                serverctrls=None,
+                sort=None,
+                window=None):
         """
-        search([base_dn [, scope [, filterstr [, attrs [, page_size]]]]])
+        search([base_dn [, scope [, filterstr [, attrs [, page_size
+                [, read_ahead [, serverctrls [, sort [, window]]]]]]]]])
         Search for entries
 
         Scope can be one of the followings:
         - SCOPE_BASE (to search the object itself);
         - SCOPE_ONELEVEL (to search the object's immediate children);
         - SCOPE_SUBTREE (to search the object and all its descendants).
+        page_size and read_ahead override the adaptor's page size and number
+        of pages to request ahead.
+        serverctrls are extra controls to send with the search, whose results
+        are then neither cached nor looked up in the mirror.
+
+        sort has the results sorted by the server: it is an attribute name or
+        a list of them, prefixed with - for a reverse order ("-sn"). With
+        window, an (offset, count) tuple, only count results starting at
+        offset (from 0) in the sorted list are returned, using the virtual
+        list view control instead of paging. The results are then a
+        ResultWindow, giving the estimated number of results in
+        content_count.
         Return list of results
         """
+        if window is not None:
+            return self._search_window(base_dn, scope, filterstr, attrs, sort,
+                                       window, serverctrls)
+        if sort:
+            serverctrls = [make_sort_control(sort)] + (serverctrls or [])
+
+        if serverctrls:
+            return self._search(base_dn, scope, filterstr, attrs, page_size,
+                                read_ahead, serverctrls)
+
+        if self.mirror is not None:
+            res = self.mirror.lookup(base_dn or self._base_dn, scope,
+                                     filterstr, attrs)
+            if res is not None:
+                return res
+
+        if self.cache is None:
+            return self._search(base_dn, scope, filterstr, attrs, page_size,
+                                read_ahead)
+
+        key = (
+            self.normalize_dn(base_dn or self._base_dn),
+            scope,
+            filterstr,
+            attrs and tuple(attrs),
+        )
+        res = self.cache.get(key)
+        if res is not None:
+            return res
+
+        generation = self.cache.generation
+        try:
+            res = self._search(base_dn, scope, filterstr, attrs, page_size,
+                               read_ahead)
+        except ldap.NO_SUCH_OBJECT, e:
+            self.cache.put(key, e, generation)
+            raise
+
+        self.cache.put(key, res, generation)
+        return res
+
+    @check_connected
+    def _search(self, base_dn, scope, filterstr, attrs, page_size,
+                read_ahead, serverctrls=None):
+        return list(self._iter_search(base_dn, scope, filterstr, attrs,
+                                      page_size, read_ahead, serverctrls))
+
+    def iter_search (self,
+                     base_dn=None,
+                     scope=ldap.SCOPE_SUBTREE,
+                     filterstr='(objectClass=*)',
+                     attrs=None,
+                     page_size=None,
+                     read_ahead=None,
+                     serverctrls=None,
+                     sort=None):
+        """
+        iter_search([base_dn [, scope [, filterstr [, attrs [, page_size
+                     [, read_ahead [, serverctrls [, sort]]]]]]]])
+        Search for entries, yielding them one page at a time
+
+        Takes the same arguments as search(), but returns a generator of
+        (dn, attrs) results. Ranged attributes are completed before the page
+        is handed out, and only one page is held in memory at a time, plus
+        the page read ahead.
+
+        Nothing is sent before the first result is asked for, and nothing
+        is retried: the adaptor connects if it is not connected when
+        iter_search() is called, but a server going away once iterating,
+        on the first page as well, raises ldap.SERVER_DOWN.
+        """
+        if sort:
+            serverctrls = [make_sort_control(sort)] + (serverctrls or [])
+
+        if self.mirror is not None and not serverctrls:
+            res = self.mirror.lookup(base_dn or self._base_dn, scope,
+                                     filterstr, attrs)
+            if res is not None:
+                # A generator like the one of a search, which can be closed
+                return (entry for entry in res)
+
+        return self._iter_search(base_dn, scope, filterstr, attrs, page_size,
+                                 read_ahead, serverctrls)
+
+    @check_connected
+    def _iter_search(self, base_dn, scope, filterstr, attrs, page_size,
+                     read_ahead, serverctrls=None):
         base_dn = base_dn or self._base_dn
+        if page_size is None:
+            page_size = self.page_size
+        if read_ahead is None:
+            read_ahead = self.read_ahead
         LOG.debug(
-            "Searching for %(filter)s (%(attrs)s) on %(dn)s ..." %
+            "Searching for %(filter)s (%(attrs)s) on %(dn)s ...",
             {"filter": filterstr, "attrs": attrs, "dn": base_dn})
 
-        all_res = []
-        page_cookie = ''
+        return PagedSearch(self, base_dn, scope, filterstr, attrs,
+                           page_size, read_ahead, serverctrls).iter_entries()
 
-        while True:
+    @check_connected
+    def _search_window(self, base_dn, scope, filterstr, attrs, sort, window,
+                       serverctrls=None):
+        """ Search for a window of sorted results with the virtual list view
+        control """
+        if not sort:
+            raise LdapAdaptorError("A result window needs a sort order")
+        offset, count = window
+        base_dn = base_dn or self._base_dn
+        LOG.debug(
+            "Searching for %(filter)s (%(attrs)s) on %(dn)s sorted by %(sort)s"
+            " [%(offset)d:+%(count)d] ...",
+            {"filter": filterstr, "attrs": attrs, "dn": base_dn, "sort": sort,
+             "offset": offset, "count": count})
+
+        # VLV offsets start at 1, and a content count of 0 lets the server
+        # use its own
+        vlv_ctrl = VLVRequestControl(True, before_count=0,
+                                     after_count=max(count - 1, 0),
+                                     offset=offset + 1, content_count=0)
+        msgid = self._ldap.search_ext(
+            base_dn, scope, filterstr, attrs,
+            serverctrls=[make_sort_control(sort), vlv_ctrl] +
+                (serverctrls or []))
+        x, res, y, ctrls = self._ldap.result3(msgid)
+        res = res[:count]
+        self._record_results(res)
+        self._complete_ranges(res)
+
+        content_count = context_id = None
+        for ctrl in ctrls:
+            if isinstance(ctrl, VLVResponseControl):
+                offset = ctrl.target_position - 1
+                content_count = ctrl.content_count
+                context_id = ctrl.context_id
+        return ResultWindow(res, offset, content_count, context_id)
+
+    def _record_results(self, res):
+        """ Count a page of search results in the metrics """
+        metrics = self.metrics
+        if metrics is None:
+            return
+
+        values = size = 0
+        for dn, attrs in res:
+            for vals in (attrs or {}).itervalues():
+                values += len(vals)
+                size += sum(len(val) for val in vals)
+        metrics.incr("search.pages")
+        metrics.incr("search.entries", len(res))
+        metrics.incr("search.values", values)
+        metrics.incr("search.bytes", size)
+
+    def _complete_ranges(self, res):
+        """ Fetch the missing values of ranged attributes of a result page
+
+        The requests for every entry of the page are sent at once, and the
+        following ranges are requested as the results come in.
+        """
+        pending = {}
+        order = deque()
 
-            # Use?
-            #filterstr = ldap.filter.escape_filter_chars(filterstr)
-            paging_ctrl = make_page_control(False, page_size, page_cookie)
-            query_id = self._ldap.search_ext(base_dn,
-                                             scope,
-                                             filterstr,
-                                             attrs,
-                                             serverctrls=[paging_ctrl])
-            x, res, y, ctrls = self._ldap.result3(query_id)
+        def request(dn, obj_attrs, new_ranges):
+            if self.metrics is not None:
+                self.metrics.incr("search.range_requests")
+            msgid = self._ldap.search_ext(dn,
+                                          ldap.SCOPE_BASE,
+                                          attrlist=new_ranges)
+            pending[msgid] = (dn, obj_attrs)
+            order.append(msgid)
 
+        try:
             for dn, obj_attrs in res:
                 if dn is None:
                     continue
 
                 # Pesky attributes might be ranges, we need to see about that
                 new_ranges = get_new_ranges(obj_attrs)
-                while new_ranges:
-                    new_res = self._ldap.search_s(dn,
-                                                  ldap.SCOPE_BASE,
-                                                  attrlist=new_ranges)
-                    if len(new_res) != 1 or new_res[0][0] is None:
-                        LOG.warn("get extra attr failed for {0}".format(dn))
-                        break
+                if new_ranges:
+                    request(dn, obj_attrs, new_ranges)
 
-                    new_attrs = new_res[0][1]
-                    obj_attrs.update(new_attrs)
-                    new_ranges = get_new_ranges(new_attrs)
+            while order:
+                # Never wait on RES_ANY, it could pick up a read-ahead page
+                msgid = order.popleft()
+                dn, obj_attrs = pending.pop(msgid)
+                x, new_res, y, ctrls = self._ldap.result3(msgid)
+                if len(new_res) != 1 or new_res[0][0] is None:
+                    LOG.warn("get extra attr failed for %s", dn)
+                    continue
 
-            all_res += res
+                new_attrs = new_res[0][1]
+                obj_attrs.update(new_attrs)
+                new_ranges = get_new_ranges(new_attrs)
+                if new_ranges:
+                    request(dn, obj_attrs, new_ranges)
 
-            # extract cookie if supplied by server
-            page_cookie = ''
-            for ext in ctrls:
-                if isinstance(ext, PagedCtrl):
-                    x, page_cookie = get_page_control(ext)
-            if not page_cookie:
-                break #Paging not supported or end of paging
+        finally:
+            for msgid in order:
+                self._ldap.abandon(msgid)
+
+    @timed
+    @check_connected
+    def read_entries(self, dns, filterstr='(objectClass=*)', attrs=None,
+                     window=64):
+        """ Read a list of entries by their DN
 
-        return all_res
+        A base search of every DN is sent without waiting for the previous
+        ones to complete, up to window searches being in flight.
+        Return the list of the (dn, attrs) results, in the order of dns, with
+        None for the entries which do not exist or do not match filterstr.
+        """
+        dns = list(dns)
+        res = [None] * len(dns)
+        pending = {}
+        order = deque()
+
+        def collect():
+            msgid = order.popleft()
+            i = pending.pop(msgid)
+            try:
+                x, entries, y, ctrls = self._ldap.result3(msgid)
+            except ldap.NO_SUCH_OBJECT:
+                return
+            for entry in entries:
+                if entry[0] is not None:
+                    res[i] = entry
+
+        try:
+            for i, dn in enumerate(dns):
+                if self.mirror is not None:
+                    try:
+                        entries = self.mirror.lookup(dn, ldap.SCOPE_BASE,
+                                                     filterstr, attrs)
+                    except ldap.NO_SUCH_OBJECT:
+                        continue
+                    if entries is not None:
+                        res[i] = entries and entries[0] or None
+                        continue
+
+                while len(order) >= window:
+                    collect()
+                msgid = self._ldap.search_ext(dn, ldap.SCOPE_BASE, filterstr,
+                                              attrs)
+                pending[msgid] = i
+                order.append(msgid)
+
+            while order:
+                collect()
 
+        finally:
+            for msgid in order:
+                self._ldap.abandon(msgid)
+
+        found = [entry for entry in res if entry is not None]
+        self._record_results(found)
+        self._complete_ranges(found)
+        return res
+
+    @timed
     @check_connected
     def compare (self, dn, attr_name, attr_value):
         """
@@ -377,8 +1124,8 @@ class LdapAdaptor(object):
         the given attribute name, and the given attribute value.
         """
         LOG.debug(
-            "Verifying if %(dn)s has attribute %(attr_name)s=%(attr_val)s ..."
-             % {"dn": dn, "attr_name": attr_name, "attr_val": attr_value}
+            "Verifying if %(dn)s has attribute %(attr_name)s=%(attr_val)s ...",
+            {"dn": dn, "attr_name": attr_name, "attr_val": attr_value}
         )
         try:
             return self._ldap.compare_s (dn, attr_name, attr_value)
@@ -386,6 +1133,7 @@ class LdapAdaptor(object):
             LOG.error("Caught ldap error: %s", str(e))
             raise
 
+    @timed
     @check_connected
     def passwd(self, dn, newpass, oldpass=None):
         try:
@@ -394,6 +1142,25 @@ class LdapAdaptor(object):
             LOG.error("Caught ldap error: %s", str(e))
             raise
 
+    @timed
+    @check_connected
+    def ping(self):
+        """
+        Returns the round trip time of a root DSE search, in seconds.
+        """
+        start = time.time()
+        self._ldap.search_s("", ldap.SCOPE_BASE, "(objectClass=*)", ["1.1"])
+        return time.time() - start
+
+    @check_connected
+    def root_dse(self, attrs=None):
+        """
+        Returns the attributes of the root DSE.
+        """
+        res = self._ldap.search_s("", ldap.SCOPE_BASE, "(objectClass=*)",
+                                  attrs)
+        return res and res[0][1] or {}
+
     def get_error (self, e):
         """Try to identify error description from exception and return it."""
         raise DeprecationWarning("get_error is deprecated")
@@ -424,14 +1191,30 @@ class LdapAdaptor(object):
             return val
 
     def normalize_dn(self, dn):
-        attr = lambda name:name.lower()
+        """ The canonical form of dn, with lowercase attribute types, and
+        lowercase values when case_insensitive_dn is set
 
-        handle_parts = lambda l: [
-            (attr(a), self.normalize_value(v), t) for a, v, t in l
-        ]
-        return ldap.dn.dn2str(
-            handle_parts(part) for part in ldap.dn.str2dn(dn)
-        )
+        Results are cached, and shared: normalizing equal DNs returns the
+        same string.
+        """
+        ndn = self._normalized_dns.get(dn)
+        if ndn is not None:
+            return ndn
+
+        if CANONICAL_DN.match(dn) and (not self.is_case_insensitive
+                                       or dn == dn.lower()):
+            ndn = dn
+        else:
+            attr = lambda name:name.lower()
+
+            handle_parts = lambda l: [
+                (attr(a), self.normalize_value(v), t) for a, v, t in l
+            ]
+            ndn = ldap.dn.dn2str(
+                handle_parts(part) for part in parse_dn(dn)
+            )
+        ndn = self._normalized_dns[dn] = intern_dn(ndn)
+        return ndn
 
     def compare_dn(self, dn, other):
         # Normalize dn's to standard
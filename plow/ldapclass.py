@@ -1,17 +1,41 @@
+import sys
 import logging
 LOG = logging.getLogger(__name__)
 
 import ldap
+import ldap.filter
 
-from plow.errors import DNConflict
+from plow.asyncadaptor import LdapFuture
+from plow.errors import DNConflict, UnfetchedAttribute
+from plow.ldapadaptor import ResultWindow
 from plow.utils import (
     smart_str_to_unicode,
     prepare_str_for_ldap,
     modify_modlist,
     dict_diff,
+    parse_dn,
 )
 
 
+def run_steps(la, steps):
+    """ Run a generator of LdapAdaptor operations
+
+    steps yields (operation name, args, kwargs) tuples, and receives the
+    result of each operation, or has its exception raised into it.
+    """
+    send, value = steps.send, (None, )
+    while True:
+        try:
+            name, args, kwargs = send(*value)
+        except StopIteration:
+            return
+
+        try:
+            send, value = steps.send, (getattr(la, name)(*args, **kwargs), )
+        except Exception:
+            send, value = steps.throw, sys.exc_info()
+
+
 class LdapClassConfig(object):
     def __init__(self, attrs):
         self._attrs = attrs
@@ -26,18 +50,30 @@ class LdapClassConfig(object):
 
 class StructuralObjectMixIn(object):
     def __contains__(self, other):
-        other_dn = ldap.dn.str2dn(getattr(other, "dn", other))
-        test_len = len(ldap.dn.str2dn(self.dn))
+        if self._ldap.dit is not None:
+            return self._ldap.dit.is_under(getattr(other, "dn", other), self.dn)
+
+        normalize_dn = self._ldap.normalize_dn
+        other_dn = parse_dn(normalize_dn(getattr(other, "dn", other)))
+        own_dn = parse_dn(normalize_dn(self.dn))
+        test_len = len(own_dn)
         if len(other_dn) <= test_len:
             # The other must have at least one more element, otherwise
             # it cannot be *in* this one
             return False
 
         else:
-            return self._ldap.compare_dn(
-                self.dn,
-                ldap.dn.dn2str(other_dn[-test_len:])
-                )
+            return other_dn[-test_len:] == own_dn
+
+class ResolvedMembers(list):
+    """ The objects of the members of a MemberView, see MemberView.resolve()
+
+    missing is the list of the member values which did not match an object.
+    """
+    def __init__(self, objects, missing):
+        list.__init__(self, objects)
+        self.missing = missing
+
 
 class MemberView(object):
     @classmethod
@@ -56,32 +92,32 @@ class MemberView(object):
     @classmethod
     def get_property(cls):
         def getter(self):
-            attr = "_{0}_view".format(cls._managed_attr)
-            if hasattr(self, attr):
-                return getattr(self, attr)
-            
-            view = cls(self)
-            setattr(self, attr, view)
+            view = self._views.get(cls._managed_attr)
+            if view is None:
+                view = cls(self)
+                self._views[cls._managed_attr] = view
             return view
 
         def setter(self, member_list):
-            attr = cls._managed_attr + "_view"
-            self.set_attr(cls._managed_attr, member_list)
-            setattr(self, attr, cls(self))
-
+            getter(self).replace_with(member_list)
 
         return property(getter, setter)
 
 
     def __init__(self, ldapobject):
         self._obj = ldapobject
+        normalize = self._normalize_attrvalue
+        # normalized value -> value
         self._map = dict(
-            (self._normalize_attrvalue(value), value)
+            (normalize(value), value)
             for value in self._obj.get_attr(self._managed_attr, [])
         )
+        # Values removed, but still in the attribute, which keeps the order
+        # of the members. They are taken out of it at once when it is read.
+        self._removed = set()
 
     def __iter__(self):
-        return self._map.itervalues()
+        return iter(self._obj.get_attr(self._managed_attr, []))
 
     def __len__(self):
         return len(self._map)
@@ -126,45 +162,146 @@ class MemberView(object):
         dn, ndn = self._get_member_attr(member)
         return ndn in self._map
 
-    def add(self, member):
+    def _add(self, member):
+        dn, ndn = self._get_member_attr(member)
+        if ndn in self._map:
+            return
+
+        dn = prepare_str_for_ldap(dn)
+        self._map[ndn] = dn
+        if dn in self._removed:
+            # Still in its place
+            self._removed.discard(dn)
+        elif self._managed_attr in self._obj._attrs:
+            self._obj._attrs[self._managed_attr].append(dn)
+        else:
+            self._obj._attrs[self._managed_attr] = [dn]
+        self._obj._record_value(self._managed_attr, dn, added=True)
+
+        # If we need to manually set a reverse relation, do it.
+        if self._reverse_relation and isinstance(member, LdapClass):
+            attr = member.get_attr(self._reverse_relation, [])
+            rval, nrval = self._get_reverse_attr()
+            if nrval not in [self._normalize_rvalue(a) for a in attr]:
+                member.set_attr(self._reverse_relation, attr + [rval])
+
+    def _remove(self, member):
         dn, ndn = self._get_member_attr(member)
         if ndn not in self._map:
-            self._map[ndn] = dn
-            members = self._obj.get_attr(self._managed_attr, [])
-            self._obj.set_attr(self._managed_attr, members + [dn])
-
-            # If we need to manually set a reverse relation, do it.
-            if self._reverse_relation:
-                attr = member.get_attr(self._reverse_relation, [])
-                rval, nrval = self._get_reverse_attr()
-                if nrval not in [self._normalize_rvalue(a) for a in attr]:
-                    attr.append(rval)
-                    member.set_attr(self._reverse_relation, attr)
+            return
+
+        curdn = self._map.pop(ndn)
+        self._removed.add(curdn)
+        self._obj._record_value(self._managed_attr, curdn, added=False)
+
+        # If we need to manually unset a reverse relation, do it.
+        if self._reverse_relation and isinstance(member, LdapClass):
+            attr = member.get_attr(self._reverse_relation, [])
+            rval, nrval = self._get_reverse_attr()
+            kept = [a for a in attr if self._normalize_rvalue(a) != nrval]
+            if len(kept) != len(attr):
+                member.set_attr(self._reverse_relation, kept)
+
+    def _changed(self):
+        """ Have the removed values taken out of the attribute when it is
+        next read """
+        if self._removed:
+            self._obj._pending[self._managed_attr] = self
+
+    def _flush(self):
+        removed, self._removed = self._removed, set()
+        values = self._obj._attrs.get(self._managed_attr, [])
+        self._obj._attrs[self._managed_attr] = [
+            value for value in values if value not in removed]
 
-    def clear(self):
-        self._map = dict()
-        self._obj.set_attr(self._managed_attr, [])
+    def add(self, member):
+        self._add(member)
+        self._changed()
 
     def remove(self, member):
-        dn, ndn = self._get_member_attr(member)
-        if ndn in self._map:
-            curdn = self._map.pop(ndn)
-            members = self._obj.get_attr(self._managed_attr, [])
-            members.remove(curdn)
-            self._obj.set_attr(self._managed_attr, members)
-
-            # If we need to manually unset a reverse relation, do it.
-            if self._reverse_relation:
-                attr = member.get_attr(self._reverse_relation, [])
-                rval, nrval = self._get_reverse_attr()
-                try:
-                    attrs = [self._normalize_rvalue(a) for a in attr]
-                    valpos = attrs.index(nrval)
-                    attr.pop(valpos)
-                    member.set_attr(self._reverse_relation, attr)
-                except ValueError:
-                    # Not in there
-                    pass
+        self._remove(member)
+        self._changed()
+
+    def update(self, members):
+        """ Add members, which can be objects or attribute values """
+        for member in members:
+            self._add(member)
+        self._changed()
+
+    def difference_update(self, members):
+        """ Remove members, which can be objects or attribute values """
+        for member in members:
+            self._remove(member)
+        self._changed()
+
+    def replace_with(self, members):
+        """ Make members the only members, keeping the ones which already
+        are in their current place """
+        members = list(members)
+        kept = set(self._get_member_attr(member)[1] for member in members)
+        for ndn, dn in self._map.items():
+            if ndn not in kept:
+                self._remove(dn)
+        for member in members:
+            self._add(member)
+        self._changed()
+
+    def clear(self):
+        self.difference_update(self._map.values())
+
+    def resolve(self, cls, la=None, attrs=None, extra_attrs=None,
+                chunk_size=100, window=64):
+        """ Fetch the objects of class cls of all the members
+
+        Members referenced by DN are read with base searches, up to window
+        of them in flight, the others are searched for chunk_size at a
+        time, with a filter matching any of their values.
+
+        @return a ResolvedMembers list of the objects, in the order of the
+        members
+        """
+        la = la or self._obj._ldap
+        members = list(self)
+        fetch_attrs = cls._get_fetch_attrs(attrs, extra_attrs)
+        if self._remote_attr == "dn":
+            results = la.read_entries(members, cls.get_objectClass_filter(),
+                                      fetch_attrs, window)
+            fetched = cls._get_fetched(fetch_attrs)
+            objects = [res and cls._from_result(la, res[0], res[1], fetched)
+                       for res in results]
+        else:
+            objects = self._search_members(cls, la, members, fetch_attrs,
+                                           chunk_size)
+
+        missing = [member for member, obj in zip(members, objects)
+                   if obj is None]
+        if missing:
+            LOG.debug("%(count)d members of %(dn)s not found: %(missing)s",
+                      {"count": len(missing), "dn": self._obj.dn,
+                       "missing": missing})
+        return ResolvedMembers([obj for obj in objects if obj is not None],
+                               missing)
+
+    def _search_members(self, cls, la, members, fetch_attrs, chunk_size):
+        """ Search for the objects of members, by their remote attribute """
+        attr = self._remote_attr
+        if (fetch_attrs is not None and "*" not in fetch_attrs and
+                lower(attr) not in [lower(a) for a in fetch_attrs]):
+            # Needed to match the objects to the members
+            fetch_attrs = list(fetch_attrs) + [attr]
+
+        normalize = self._normalize_attrvalue
+        found = {}
+        for start in xrange(0, len(members), chunk_size):
+            filterstr = "(|{0})".format("".join(
+                "({0}={1})".format(attr, ldap.filter.escape_filter_chars(value))
+                for value in members[start:start + chunk_size]))
+            for obj in cls.search(filterstr=filterstr, la=la,
+                                  attrs=fetch_attrs):
+                for value in obj.get_attr(attr, []):
+                    found.setdefault(normalize(value), obj)
+
+        return [found.get(normalize(member)) for member in members]
 
 class LdapAttribute(object):
     def __init__(self, attribute, multi_valued=False):
@@ -290,38 +427,96 @@ class CaseInsensitiveDict(dict):
             for (k, v) in obj.iteritems()
         )
 
+class ValueChanges(object):
+    """ The values added to and removed from an attribute since it was saved
+
+    key gives what is compared of the values, see LdapClass._get_equality(),
+    so that removing a value and adding it back with another case does not
+    change anything.
+    """
+    __slots__ = ("added", "removed", "key")
+
+    def __init__(self, key=None):
+        # compared value -> value, to find values in constant time
+        self.added = {}
+        self.removed = {}
+        self.key = key
+
+    def add(self, value):
+        k = self.key(value) if self.key is not None else value
+        if k in self.removed:
+            del self.removed[k]
+        else:
+            self.added[k] = value
+
+    def remove(self, value):
+        k = self.key(value) if self.key is not None else value
+        if k in self.added:
+            del self.added[k]
+        else:
+            self.removed[k] = value
+
+    def modlist(self, attrname):
+        return [
+            (ldap.MOD_DELETE, attrname, value)
+            for value in sorted(self.removed.itervalues())
+        ] + [
+            (ldap.MOD_ADD, attrname, value)
+            for value in sorted(self.added.itervalues())
+        ]
+
 class LdapClass(object):
     __metaclass__ = LdapType
     cfg = LdapClassConfig({})
+    # Lowercase names of the attributes requested when the object was read,
+    # None when all of them were
+    _fetched = None
 
     def __init__ (self, la, dn, attributes=None, **kwattrs):
         """Initialize instance."""
         self._ldap = la
         self._dn = dn
         self._attrs = CaseInsensitiveDict()
+        self._changes = CaseInsensitiveDict()
+        # Attribute name -> MemberView
+        self._views = CaseInsensitiveDict()
+        # Attribute name -> MemberView with values to take out of _attrs
+        self._pending = CaseInsensitiveDict()
 
         range_attributes = []
         if attributes:
             for k, v in attributes.iteritems():
                 if ";range=" in k:
-                    range_attributes.append((k.split(";range=")[0], v))
+                    range_attributes.append(self._split_range(k, v))
                 else:
                     self.set_attr(k, v)
 
         for k, v in kwattrs.iteritems():
             if ";range=" in k:
-                range_attributes.append((k.split(";range=")[0], v))
+                range_attributes.append(self._split_range(k, v))
             else:
                 self.set_attr(k, v)
 
-        for k, v in range_attributes:
-            self.set_attr(k, self.get_attr(k) + v)
+        # Ranges must be appended in order
+        range_attributes.sort()
+        for k, start, v in range_attributes:
+            self.set_attr(k, self.get_attr(k, []) + v)
 
         for attrname in self._attrs:
             if isinstance(self._attrs[attrname], list): 
                 self._attrs[attrname] = self._attrs[attrname][:]
 
         self._origattrs = self._attrs.copy()
+        # Attribute name -> ValueChanges, or None when the attribute must be
+        # compared with its original values. None instead of the dict when
+        # every attribute must be.
+        self._changes = CaseInsensitiveDict()
+
+    @staticmethod
+    def _split_range(key, value):
+        """ Split attr;range=start-end into (attr, start, value) """
+        name, attr_range = key.split(";range=")
+        return name, int(attr_range.split("-")[0]), value
 
     @property
     def dn(self):
@@ -330,7 +525,7 @@ class LdapClass(object):
     def _get_rdn(self, orig=True):
         if orig:
             return ldap.dn.dn2str(
-                ldap.dn.str2dn(self.dn)[:1]
+                parse_dn(self.dn)[:1]
                 )
 
         else:
@@ -341,7 +536,7 @@ class LdapClass(object):
         rdn_field = self.cfg.rdn or self.cfg.uid
         if not rdn_field:
             # Attempt to guess from dn
-            rdn_field = ldap.dn.str2dn(self.dn)[0][0]
+            rdn_field = parse_dn(self.dn)[0][0]
 
         return rdn_field
 
@@ -353,13 +548,37 @@ class LdapClass(object):
             return None
 
         #Strip the first component of the dn, return None if result is empty
-        return ldap.dn.dn2str(ldap.dn.str2dn(self.dn)[1:]) or None
+        return ldap.dn.dn2str(parse_dn(self.dn)[1:]) or None
 
     @property
     def parentdnObj(self):
-        if self.parentdn is None:
+        parentdn = self.parentdn
+        if parentdn is None:
             return None
-        return LdapClass.get(self.parentdn, la=self._ldap)
+        dit = self._ldap.dit
+        if dit is not None and dit.covers(parentdn) and parentdn not in dit:
+            # The whole subtree is indexed, there is no such entry
+            return None
+        return LdapClass.get(parentdn, la=self._ldap)
+
+    @property
+    def childdns(self):
+        """ The DNs of the entries directly below this one, from the DIT
+        index of the adaptor when it covers this entry """
+        dit = self._ldap.dit
+        if dit is not None and dit.covers(self.dn):
+            return dit.children(self.dn)
+        return [dn for dn, attrs in self._ldap.search(
+            self.dn, ldap.SCOPE_ONELEVEL, attrs=["1.1"]) if dn is not None]
+
+    @property
+    def ancestordns(self):
+        """ The DNs above this one down to the base DN of the adaptor,
+        nearest first, taken from the DN as parentdn is """
+        base = parse_dn(self._ldap.normalize_dn(self._ldap.base_dn))
+        parts = parse_dn(self.dn)
+        return [ldap.dn.dn2str(parts[i:])
+                for i in range(1, len(parts) - len(base) + 1)]
 
     @classmethod
     def get_base_dn(cls, la):
@@ -379,8 +598,20 @@ class LdapClass(object):
         @param attr Attribute name to retrieve
         @param default Default value to return if the key does not exist
 
+        Raises UnfetchedAttribute for an attribute that was not requested when
+        the object was read, and has not been set since.
+
+        The list returned must not be changed in place, unless mark_changed()
+        is called after that.
+
         @return tuple containing the values of the attribute for this key
         """
+        if (self._fetched is not None and attr not in self._attrs
+                and lower(attr) not in self._fetched):
+            raise UnfetchedAttribute(
+                "{0} was not fetched for {1}".format(attr, self._dn))
+        if self._pending:
+            self._flush_views()
         return self._attrs.get(attr, default)
 
     def get_unicode_attr(self, attr, default=None):
@@ -393,16 +624,88 @@ class LdapClass(object):
         @param key Attribute name to set
         @param value value to which the attribute will be set
         """
+        self._forget_view(key)
         #All attributes are stored as lists, so convert as necessary
         if isinstance(value, (list, tuple)):
             self._attrs[key] = [prepare_str_for_ldap(l) for l in value]
         else:
             self._attrs[key] =  [prepare_str_for_ldap(value),]
+        self.mark_changed(key)
 
     def del_attr(self, key):
+        self._forget_view(key)
         del self._attrs[key]
+        self.mark_changed(key)
+
+    def _forget_view(self, key):
+        """ Drop the member view of an attribute changed by other means """
+        if key in self._pending:
+            self._flush_views()
+        self._views.pop(key, None)
+
+    def _flush_views(self):
+        """ Take the values removed through member views out of _attrs """
+        pending, self._pending = self._pending, CaseInsensitiveDict()
+        for view in pending.itervalues():
+            view._flush()
+
+    def add_attr_value(self, key, value):
+        """ Add a value to an attribute, which must not have it already
+        @param key Attribute name
+        @param value value to add
+
+        Unlike with set_attr(), saving the object only sends the values added
+        and removed since it was last saved.
+        """
+        value = prepare_str_for_ldap(value)
+        self._forget_view(key)
+        if key in self._attrs:
+            self._attrs[key].append(value)
+        else:
+            self._attrs[key] = [value]
+        self._record_value(key, value, added=True)
+
+    def remove_attr_value(self, key, value):
+        """ Remove a value of an attribute, raises ValueError when it does
+        not have it
+        @param key Attribute name
+        @param value value to remove
+        """
+        value = prepare_str_for_ldap(value)
+        self._forget_view(key)
+        self._attrs[key].remove(value)
+        self._record_value(key, value, added=False)
+
+    def _record_value(self, key, value, added):
+        """ Journal a value added to or removed from an attribute """
+        changes = self._value_changes(key)
+        if changes is not None:
+            if added:
+                changes.add(value)
+            else:
+                changes.remove(value)
+
+    def _value_changes(self, key):
+        """ The ValueChanges of an attribute, None when it is compared with
+        its original values instead """
+        if self._changes is None:
+            return None
+        if key not in self._changes:
+            self._changes[key] = ValueChanges(
+                self._get_equality().get(lower(key)))
+        return self._changes[key]
+
+    def mark_changed(self, key=None):
+        """ Have the next save compare an attribute with its original values,
+        or every attribute when key is None """
+        if key is None:
+            self._changes = None
+        elif self._changes is not None:
+            self._changes[key] = None
 
     def has_attr(self, key):
+        if self._pending:
+            self._flush_views()
         return self._attrs.has_key(key)
 
     def get_named_attr(self, attr, default=None):
@@ -479,8 +782,17 @@ class LdapClass(object):
                   if the data has changed on the server.
         - preserve_rdn: attempt to keep the rdn format
         """
-        new = self._attrs.copy()
-        old = self._origattrs.copy()
+        run_steps(self._ldap, self._save_steps(atomic, preserve_rdn))
+
+    def save_async(self, la, atomic=False, preserve_rdn=False):
+        """ Same as save(), using the AsyncLdapAdaptor la
+        @return LdapFuture of the completion of the save
+        """
+        return la.run_steps(self._save_steps(atomic, preserve_rdn))
+
+    def _save_steps(self, atomic, preserve_rdn):
+        """ Generator of the operations saving this object, see run_steps() """
+        self._flush_views()
 
         # Generate new rdn
         rdn_field = self._get_rdn_field()
@@ -488,6 +800,27 @@ class LdapClass(object):
         dn_parts = ldap.dn.str2dn(self.dn)
         cur_rdn = ldap.dn.str2dn(self.dn)[0]
 
+        changes = self._changes
+        if changes is None:
+            new = self._attrs.copy()
+            old = self._origattrs.copy()
+        else:
+            # Only compare the attributes which were set, and the ones of the
+            # rdn, the values added and removed are sent as they are
+            compared = set(lower(key) for key, value in changes.iteritems()
+                           if value is None)
+            compared.add(lower(rdn_field))
+            compared.update(lower(attr) for attr, value, atype in cur_rdn)
+            for key in list(compared):
+                if key in changes:
+                    changes[key] = None
+            new = CaseInsensitiveDict(
+                (key, value[:]) for key, value in self._attrs.iteritems()
+                if lower(key) in compared)
+            old = CaseInsensitiveDict(
+                (key, value[:]) for key, value in self._origattrs.iteritems()
+                if lower(key) in compared)
+
         new_rdn = []
         if preserve_rdn:
             for attr, value, atype in cur_rdn:
@@ -512,10 +845,9 @@ class LdapClass(object):
         if cur_rdn != new_rdn:
             delold = int(self._ldap.require_delold)
             try:
-                self._ldap.rename(self.dn,
-                                  ldap.dn.dn2str([new_rdn]),
-                                  newsuperior=None,
-                                  delold=delold)
+                yield ("rename",
+                       (self.dn, ldap.dn.dn2str([new_rdn])),
+                       {"newsuperior": None, "delold": delold})
             except ldap.ALREADY_EXISTS:
                 raise DNConflict("DNConflict when changing rdn of {0} to {1}"
                                  .format(self.dn, new_rdn))
@@ -536,14 +868,34 @@ class LdapClass(object):
                             attrval.append(val)
 
         #Update values on the server if we changed other attributes
+        cost = None if atomic else self._ldap.modlist_cost
+        mod = []
         if new != old:
-            mod = modify_modlist(old, new, atomic)
+            mod = modify_modlist(old, new, atomic, self._get_equality(), cost)
+        if changes is not None:
+            for key, values in changes.iteritems():
+                if values is None or not (values.added or values.removed):
+                    continue
+                if cost is not None and cost.choose(
+                        self._attrs[key], values.removed.values(),
+                        values.added.values()) == "replace":
+                    mod.append((ldap.MOD_REPLACE, key, self._attrs[key][:]))
+                else:
+                    mod.extend(values.modlist(key))
 
-            if mod:
-                self._ldap.modify(self._dn, mod)
+        if mod:
+            yield ("modify", (self._dn, mod), {})
 
         #Save the changed attributes as being "clean"
-        self._origattrs = self._attrs.copy()
+        if changes is None:
+            self._origattrs = self._attrs.copy()
+        else:
+            for key in changes:
+                if key in self._attrs:
+                    self._origattrs[key] = self._attrs[key][:]
+                else:
+                    self._origattrs.pop(key, None)
+        self._changes = CaseInsensitiveDict()
 
     def move(self, parent_dn, addbase=False):
         """ Move this object to a new parent """
@@ -561,20 +913,65 @@ class LdapClass(object):
         return self._ldap.delete(self._dn)
 
     @classmethod
-    def get(cls, dn=None, uid=None, la=None, addbase=False, attrs=None):
+    def get(cls, dn=None, uid=None, la=None, addbase=False, attrs=None,
+            extra_attrs=None):
         """
             Retrieve a LdapObject by dn or uid
             @param dn object's dn
             @param uid object's unique identifier
             @param la LdapAdaptor to use
             @param addbase if True, the base is added to the dn
-            @param attrs list of attributes to fetch
+            @param attrs list of attributes to fetch, defaults to all of them,
+                or to get_default_attrs() when the class has projection set
+            @param extra_attrs list of attributes to fetch in addition to
+                attrs, like operational attributes
 
 
             You must provide either dn or uid.
             @return LdapObject or None
         """
         la = cls.get_ldap_adapator(la)
+        base, params = cls._get_get_params(la, dn, uid, addbase, attrs,
+                                           extra_attrs)
+
+        try:
+            res = la.search(base, **params)
+        except ldap.NO_SUCH_OBJECT, e:
+            LOG.warn("Get failed for '%s' with error: %s",
+                dn or uid, e)
+            return None
+
+        return cls._get_from_results(la, res, base, params)
+
+    @classmethod
+    def get_async(cls, dn=None, uid=None, la=None, addbase=False, attrs=None,
+                  extra_attrs=None):
+        """ Same as get(), using the AsyncLdapAdaptor la
+        @return LdapFuture of the LdapObject or None
+        """
+        base, params = cls._get_get_params(la.la, dn, uid, addbase, attrs,
+                                           extra_attrs)
+        future = LdapFuture()
+
+        def done(res):
+            if isinstance(res.exception(), ldap.NO_SUCH_OBJECT):
+                LOG.warn("Get failed for '%s' with error: %s",
+                    dn or uid, res.exception())
+                future.set_result(None)
+                return
+
+            try:
+                future.set_result(
+                    cls._get_from_results(la.la, res.result(), base, params))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+
+        la.search(base, **params).add_done_callback(done)
+        return future
+
+    @classmethod
+    def _get_get_params(cls, la, dn, uid, addbase, attrs, extra_attrs=None):
+        """ Build the base and LdapAdaptor.search() arguments for get() """
         dn = prepare_str_for_ldap(dn)
         uid = prepare_str_for_ldap(uid)
         if dn:
@@ -601,25 +998,23 @@ class LdapClass(object):
             raise TypeError("You must provide either a uid or dn.")
         #print "Searching", params, "in", base
 
+        attrs = cls._get_fetch_attrs(attrs, extra_attrs)
         if attrs is not None:
             params["attrs"] = attrs
 
-        try:
-            res = la.search(base, **params)
-        except ldap.NO_SUCH_OBJECT, e:
-            LOG.warn("Get failed for '{0}' with error: {1}".format(
-                dn or uid,
-                unicode(e),
-                ))
-            return None
+        return base, params
 
+    @classmethod
+    def _get_from_results(cls, la, res, base, params):
+        """ Build the result of get() from the search results """
         # Remove referals
         res = filter(lambda r: r[0] is not None, res)
         if len(res) < 1:
             #print "get", uid, dn, "result is none; params=", params, 'base=', base
             return None
         if len(res) == 1:
-            return cls(la, res[0][0], res[0][1])
+            return cls._from_result(la, res[0][0], res[0][1],
+                                    cls._get_fetched(params.get("attrs")))
         if len(res) > 1:
             #Should not happen
             raise RuntimeError("More than one %s returned with %s in %s" % (cls.__name__, params["filterstr"], base ))
@@ -703,7 +1098,8 @@ class LdapClass(object):
             return cls.create(dn, attrs, la=la, addbase=addbase), True
 
     @classmethod
-    def search(cls, base=None, scope=None, filterstr=None, la=None, attrs=None): #left out attrsonly
+    def search(cls, base=None, scope=None, filterstr=None, la=None, attrs=None,
+               sort=None, window=None, extra_attrs=None): #left out attrsonly
         """ Search for objects in the server
         @param base Base DN to search in (defaults to the base dn for the class)
         @param scope Search scope. Must be one of ldap.SCOPE_BASE (0), 
@@ -712,18 +1108,182 @@ class LdapClass(object):
         @param filterstr Filter string, defaults to filtering objects of this
             class's objectClass
         @param la LdapAdaptor to use
+        @param attrs list of attributes to fetch, see get()
+        @param sort Attribute, or list of attributes, to have the server sort
+            the objects by, prefixed with - for a reverse order
+        @param window (offset, count) of the sorted objects to return
+        @param extra_attrs list of attributes to fetch in addition to attrs
+
+        @return list of LdapObject instances, a ResultWindow with window
+        """
+        if window is None:
+            return list(cls.iter_search(base, scope, filterstr, la, attrs,
+                                        sort, extra_attrs))
+
+        la = cls.get_ldap_adapator(la)
+        base, params = cls._get_search_params(la, base, scope, filterstr, attrs,
+                                              sort, extra_attrs)
+        res = la.search(base, window=window, **params)
+        fetched = cls._get_fetched(params.get("attrs"))
+        return ResultWindow(
+            [cls._from_result(la, dn, entry_attrs, fetched)
+             for dn, entry_attrs in res if dn],
+            res.offset, res.content_count, res.context_id)
+
+    @classmethod
+    def iter_search(cls, base=None, scope=None, filterstr=None, la=None, attrs=None,
+                    sort=None, extra_attrs=None):
+        """ Search for objects in the server, one result page at a time
+        Takes the same parameters as search(), but window
 
-        @return list of LdapObject instances
+        @return generator of LdapObject instances
         """
         la = cls.get_ldap_adapator(la)
+        base, params = cls._get_search_params(la, base, scope, filterstr, attrs,
+                                              sort, extra_attrs)
+        fetched = cls._get_fetched(params.get("attrs"))
+
+        # The "if res[0]" part avoids returning referals
+        return (cls._from_result(la, res[0], res[1], fetched)
+                for res in la.iter_search(base, **params) if res[0])
+
+    @classmethod
+    def search_async(cls, base=None, scope=None, filterstr=None, la=None, attrs=None,
+                     extra_attrs=None):
+        """ Same as search(), using the AsyncLdapAdaptor la
+        @return LdapFuture of the list of LdapObject instances
+        """
+        base, params = cls._get_search_params(la.la, base, scope, filterstr, attrs,
+                                              extra_attrs=extra_attrs)
+        fetched = cls._get_fetched(params.get("attrs"))
+
+        # The "if res[0]" part avoids returning referals
+        return la.search(base, **params).then(
+            lambda results: [cls._from_result(la.la, res[0], res[1], fetched)
+                             for res in results if res[0]]
+        )
+
+    @classmethod
+    def _get_sort_rules(cls, sort):
+        """ Map the class attribute names of sort to their LDAP attributes """
+        if isinstance(sort, basestring):
+            sort = [sort]
+
+        rules = []
+        for rule in sort:
+            prefix = rule.startswith("-") and "-" or ""
+            name, sep, ordering = rule[len(prefix):].partition(":")
+            attrcfg = cls.cfg.attributes.get(name)
+            if attrcfg is not None:
+                name = attrcfg.get("attribute", name)
+            rules.append(prefix + name + sep + ordering)
+        return rules
+
+    @classmethod
+    def get_default_attrs(cls):
+        """ The attributes used by this class: its objectClass, rdn, uid,
+        configured attributes and the extra_attributes of its configuration
+
+        With projection set in the configuration, get() and search() only
+        fetch those by default.
+        """
+        default = cls.__dict__.get("_default_attrs")
+        if default is None:
+            cfg = cls.cfg
+            names = ["objectClass", cfg.rdn, cfg.uid] + [
+                attrcfg.get("attribute", name)
+                for name, attrcfg in sorted(cfg.attributes.items())
+            ] + list(cfg.extra_attributes or [])
+
+            default, seen = [], set()
+            for name in names:
+                if name and lower(name) not in seen:
+                    seen.add(lower(name))
+                    default.append(name)
+            cls._default_attrs = default
+        return default[:]
+
+    @classmethod
+    def get_equality_rules(cls):
+        """ The lowercase names of the attributes whose values are not
+        compared as they are when saving, with their equality rule:
+
+        - "dn": DNs, compared with LdapAdaptor.normalize_dn()
+        - "case_ignore": strings compared ignoring their case
+
+        The rule of an attribute is set with "equality" in its configuration,
+        "exact" disabling the default ones: "dn" for member relations, and
+        "case_ignore" for objectClass.
+        """
+        rules = cls.__dict__.get("_equality_rules")
+        if rules is None:
+            rules = {"objectclass": "case_ignore"}
+            for name, attrcfg in cls.cfg.attributes.items():
+                rule = attrcfg.get("equality")
+                if (rule is None and attrcfg.get("relation") == "member"
+                        and attrcfg.get("remote_attribute", "dn") == "dn"):
+                    rule = "dn"
+                if rule is None:
+                    continue
+                if rule not in ("dn", "case_ignore", "exact"):
+                    raise ValueError("Unknown equality rule {0} of {1}"
+                                     .format(rule, name))
+                rules[lower(attrcfg.get("attribute", name))] = rule
+
+            rules = dict((attr, rule) for attr, rule in rules.iteritems()
+                         if rule != "exact")
+            cls._equality_rules = rules
+        return rules
+
+    def _get_equality(self):
+        """ The equality argument of modify_modlist() for this object """
+        functions = {
+            "dn": self._ldap.normalize_dn,
+            "case_ignore": lower,
+        }
+        return dict((attr, functions[rule])
+                    for attr, rule in self.get_equality_rules().iteritems())
+
+    @classmethod
+    def _get_fetch_attrs(cls, attrs, extra_attrs):
+        """ The attributes to fetch for attrs and extra_attrs, None for all
+        of them """
+        if attrs is None and cls.cfg.projection:
+            attrs = cls.get_default_attrs()
+        if extra_attrs:
+            # Every user attribute, plus the extra ones
+            attrs = list(attrs or ["*"]) + list(extra_attrs)
+        return attrs
+
+    @staticmethod
+    def _get_fetched(attrs):
+        """ The lowercase names of the fetched attrs, None for all of them """
+        if not attrs or "*" in attrs:
+            return None
+        return frozenset(lower(attr) for attr in attrs)
+
+    @classmethod
+    def _from_result(cls, la, dn, attrs, fetched):
+        obj = cls(la, dn, attrs)
+        obj._fetched = fetched
+        return obj
+
+    @classmethod
+    def _get_search_params(cls, la, base, scope, filterstr, attrs, sort=None,
+                           extra_attrs=None):
+        """ Build the base and LdapAdaptor.search() arguments for a search """
         params = {}
         base = base or cls.get_base_dn(la)
         if not scope is None:
             params["scope"] = scope
 
+        attrs = cls._get_fetch_attrs(attrs, extra_attrs)
         if attrs:
             params["attrs"] = attrs
 
+        if sort:
+            params["sort"] = cls._get_sort_rules(sort)
+
         if filterstr:
             if not filterstr.strip().startswith("("):
                 filterstr = "(%s)" % (filterstr.strip(), )
@@ -738,8 +1298,7 @@ class LdapClass(object):
         if hasattr(base, "dn"):
             base = base.dn
 
-        # The "if res[0]" part avoids returning referals
-        return [cls(la,res[0],res[1]) for res in la.search(base, **params) if res[0]]
+        return base, params
 
 
     def get_diff(self):
@@ -747,7 +1306,8 @@ class LdapClass(object):
         Return a diff of the attributes of this object in a tuple of 3 sets:
         added, changed, removed
         """
-        return dict_diff(self._origattrs, self._attrs)
+        self._flush_views()
+        return dict_diff(self._origattrs, self._attrs, self._get_equality())
 
 
 LdapObject = LdapType.from_config("LdapObject", {
@@ -0,0 +1,167 @@
+""" the ldapfilter module evaluates LDAP search filters locally """
+
+import re
+
+from plow.errors import UnsupportedFilter
+
+
+ESCAPE = re.compile(r"\\([0-9a-fA-F]{2})")
+# Operators of simple filter items, longest first
+ITEM_OPS = ("~=", ">=", "<=", "=")
+
+
+def unescape(value):
+    """ Decode the \\XX escapes of a filter value """
+    return ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+def parse_filter(filterstr):
+    """ Parse an RFC 4515 filter into a tree of tuples:
+
+        ("&", [filters]), ("|", [filters]), ("!", filter),
+        ("=", attr, value), ("~=", attr, value), (">=", attr, value),
+        ("<=", attr, value), ("present", attr),
+        ("substrings", attr, initial, [any], final)
+
+    Attribute names are lowercased, values are unescaped. Extensible matches
+    raise UnsupportedFilter.
+    """
+    filterstr = filterstr.strip()
+    tree, pos = _parse(filterstr, 0)
+    if pos != len(filterstr):
+        raise UnsupportedFilter("Trailing characters in filter %r" %
+                                filterstr)
+    return tree
+
+
+def _parse(s, pos):
+    """ Parse the filter starting at s[pos], returns (tree, end) """
+    if s[pos:pos + 1] != "(":
+        raise UnsupportedFilter("Expected ( at %d in filter %r" % (pos, s))
+    pos += 1
+    op = s[pos:pos + 1]
+
+    if op in ("&", "|"):
+        pos += 1
+        children = []
+        while s[pos:pos + 1] == "(":
+            child, pos = _parse(s, pos)
+            children.append(child)
+        tree = (op, children)
+    elif op == "!":
+        child, pos = _parse(s, pos + 1)
+        tree = (op, child)
+    else:
+        end = s.find(")", pos)
+        if end < 0:
+            raise UnsupportedFilter("Unbalanced filter %r" % s)
+        tree = _parse_item(s[pos:end])
+        pos = end
+
+    if s[pos:pos + 1] != ")":
+        raise UnsupportedFilter("Expected ) at %d in filter %r" % (pos, s))
+    return tree, pos + 1
+
+
+def _parse_item(item):
+    eq = item.find("=")
+    if eq <= 0:
+        raise UnsupportedFilter("Invalid filter item %r" % item)
+
+    for op in ITEM_OPS:
+        if item[eq - len(op) + 1:eq + 1] == op:
+            break
+    attr = item[:eq - len(op) + 1].strip().lower()
+    value = item[eq + 1:]
+    if ":" in attr:
+        raise UnsupportedFilter("Extensible match %r" % item)
+
+    if op != "=" or "*" not in value:
+        return (op, attr, unescape(value))
+    if value == "*":
+        return ("present", attr)
+
+    parts = [unescape(part) for part in value.split("*")]
+    return ("substrings", attr, parts[0], parts[1:-1], parts[-1])
+
+
+def filter_attributes(tree):
+    """ The set of attribute names used by a filter tree """
+    op = tree[0]
+    if op in ("&", "|"):
+        return set().union(*[filter_attributes(t) for t in tree[1]])
+    elif op == "!":
+        return filter_attributes(tree[1])
+    return set([tree[1]])
+
+
+def implies(tree, other):
+    """ Check whether every entry matching tree matches other, as far as
+    can be told without evaluating them """
+    if tree == other or other == ("present", "objectclass"):
+        # Every entry has an objectClass
+        return True
+    if tree[0] == "&":
+        return any(implies(child, other) for child in tree[1])
+    if other[0] == "&":
+        return all(implies(tree, child) for child in other[1])
+    if other[0] == "|":
+        return any(implies(tree, child) for child in other[1])
+    return False
+
+
+def _compare(value, other):
+    """ Compare two values, numerically if they both are integers """
+    try:
+        return cmp(int(value), int(other))
+    except ValueError:
+        return cmp(value, other)
+
+
+def match_filter(tree, entry, normalize=lambda attr, value: value.lower()):
+    """ Check whether entry matches a filter tree
+
+    entry maps lowercase attribute names to the lists of their values
+    normalized with normalize(attr, value), which is applied to the values
+    of the filter too.
+    """
+    op = tree[0]
+    if op == "&":
+        return all(match_filter(t, entry, normalize) for t in tree[1])
+    elif op == "|":
+        return any(match_filter(t, entry, normalize) for t in tree[1])
+    elif op == "!":
+        return not match_filter(tree[1], entry, normalize)
+
+    attr = tree[1]
+    values = entry.get(attr)
+    if not values:
+        return False
+
+    if op == "present":
+        return True
+    elif op == "substrings":
+        initial = tree[2] and normalize(attr, tree[2])
+        final = tree[4] and normalize(attr, tree[4])
+        middle = [normalize(attr, part) for part in tree[3]]
+        for value in values:
+            if not value.startswith(initial):
+                continue
+            pos = len(initial)
+            for part in middle:
+                pos = value.find(part, pos)
+                if pos < 0:
+                    break
+                pos += len(part)
+            else:
+                if value.endswith(final) and len(value) - len(final) >= pos:
+                    return True
+        return False
+
+    wanted = normalize(attr, tree[2])
+    if op in ("=", "~="):
+        return wanted in values
+    elif op == ">=":
+        return any(_compare(value, wanted) >= 0 for value in values)
+    else:
+        return any(_compare(value, wanted) <= 0 for value in values)
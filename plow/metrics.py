@@ -0,0 +1,133 @@
+""" the metrics module collects timings and counters of LDAP operations """
+
+import bisect
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """ Counts of the values falling in each bucket, with their sum, minimum
+    and maximum """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last count is for the values over the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.count and self.sum / self.count
+
+    def percentile(self, p):
+        """ The upper bound of the bucket holding the p-th percentile
+        (0 < p <= 100), or the maximum when it is over the last bucket """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+    def __repr__(self):
+        return "<Histogram: count={0} mean={1}>".format(self.count, self.mean)
+
+
+class MetricsCollector(object):
+    """ An in-process collector of the metrics of LdapAdaptor operations
+
+    Pass it as LdapAdaptor(metrics=...). Any object with the same timing(),
+    incr() and gauge() methods can be used instead, to feed another metrics
+    system. The collector can also forward what it records to hooks, called
+    with (kind, name, value), kind being "timing", "count" or "gauge".
+
+    Timings, in seconds, are named after the operations: add, delete,
+    modify, rename, compare, passwd, search, connect... A ".errors" count
+    is kept for the operations which failed. Counters include:
+
+        search.pages, search.entries, search.values, search.bytes:
+            result pages, entries, attribute values and bytes of values
+            returned by searches
+        search.range_requests: requests made to complete ranged attributes
+        reconnects: reconnections after the server went down
+        batch.operations, batch.errors: operations sent by write batches
+        modify.chunks: modifies sent for the chunks of large modifications
+        modlist.replace, modlist.delta: attributes saved by replacing their
+            values, or by removing and adding values, with a ModlistCost
+        pool.checkout: time waiting for a pooled connection (a timing)
+        search.page_size: the last page size picked by an AdaptivePageSize
+            (a gauge, keeping the last value)
+    """
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            hist = self.timings.get(name)
+            if hist is None:
+                hist = self.timings[name] = Histogram()
+            hist.add(seconds)
+        for hook in self.hooks:
+            hook("timing", name, seconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        for hook in self.hooks:
+            hook("count", name, count)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+        for hook in self.hooks:
+            hook("gauge", name, value)
+
+    def stats(self):
+        """ A snapshot of the counters and gauges, and the summaries of the
+        timings """
+        with self._lock:
+            res = dict(self.counters)
+            res.update(self.gauges)
+            for name, hist in self.timings.iteritems():
+                res[name] = hist.summary()
+        return res
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+            self.gauges.clear()
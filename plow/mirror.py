@@ -0,0 +1,410 @@
+""" the mirror module keeps a local copy of a subtree, kept current with
+LDAP content synchronization (RFC 4533) """
+
+import threading
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+from ldap.syncrepl import SyncreplConsumer
+
+from plow.errors import UnsupportedFilter
+from plow.ldapfilter import (
+    parse_filter,
+    filter_attributes,
+    implies,
+    match_filter,
+)
+from plow.utils import parse_dn
+
+
+# Attributes which are not returned with the user attributes ("*"), so
+# filters on them can not be evaluated unless they are mirrored explicitly
+OPERATIONAL_ATTRS = frozenset([
+    "createtimestamp", "modifytimestamp", "creatorsname", "modifiersname",
+    "entryuuid", "entrycsn", "entrydn", "hassubordinates", "memberof",
+    "structuralobjectclass", "subschemasubentry", "pwdchangedtime",
+])
+
+
+class MirrorEntry(object):
+    """ An entry of a DirectoryMirror """
+    __slots__ = ("dn", "attrs", "values", "uuid", "parent")
+
+    def __init__(self, dn, attrs, values, uuid, parent):
+        self.dn = dn
+        self.attrs = attrs
+        # lowercase attribute name -> normalized values, to match filters
+        self.values = values
+        self.uuid = uuid
+        self.parent = parent
+
+
+class SyncConsumer(SyncreplConsumer):
+    """ Runs the content synchronization search of a DirectoryMirror on the
+    connection of its LdapAdaptor """
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def search_ext(self, *args, **kwargs):
+        return self.mirror.la._ldap.search_ext(*args, **kwargs)
+
+    def result4(self, *args, **kwargs):
+        return self.mirror.la._ldap.result4(*args, **kwargs)
+
+    def syncrepl_get_cookie(self):
+        return self.mirror.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.mirror.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self.mirror.sync_entry(dn, attrs, uuid)
+
+    def syncrepl_delete(self, uuids):
+        self.mirror.sync_delete(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self.mirror.sync_present(uuids, refreshDeletes)
+
+    def syncrepl_refreshdone(self):
+        self.mirror.sync_refreshdone()
+
+
+class DirectoryMirror(object):
+    """ An in-memory copy of the entries below base_dn matching filterstr
+
+    load() fills the mirror with a paged search, then start() begins a
+    refreshAndPersist content synchronization search, which is processed
+    by poll() (when fileno() is readable, for event loops) or run() (in a
+    thread of its own). The synchronization cookie is kept, so that only
+    the changes are requested again after a reconnection.
+
+    search() answers base, one level and subtree searches from the mirror,
+    and falls back to the server for searches it can not answer: outside of
+    base_dn, with filters which can not be evaluated locally, on attributes
+    which are not mirrored, or before load() is done. Passing the mirror
+    to an LdapAdaptor with mirror= makes its searches, and those of the
+    LdapClass instances using it, go through the mirror.
+
+    Values are compared ignoring case, except for the attributes listed in
+    case_exact. Since the persistent search holds the connection, la should
+    be an LdapAdaptor dedicated to the mirror when run() is used.
+    """
+    def __init__(self,
+                 la,
+                 base_dn=None,
+                 filterstr='(objectClass=*)',
+                 attrs=None,
+                 case_exact=(),
+                 cookie=None):
+        self.la = la
+        self.base_dn = base_dn or la.base_dn
+        self.filterstr = filterstr
+        self.attrs = attrs
+        self.case_exact = frozenset(a.lower() for a in case_exact)
+        self.cookie = cookie
+
+        self._filter = parse_filter(filterstr)
+        self._base = la.normalize_dn(self.base_dn)
+        self._lock = threading.RLock()
+        # normalized dn -> MirrorEntry
+        self._entries = {}
+        # normalized dn -> set of the normalized dns of its children
+        self._children = {}
+        # entryUUID -> normalized dn
+        self._uuids = {}
+        # entryUUIDs reported present during a refresh
+        self._present = None
+
+        self.loaded = False
+        self.refreshed = False
+        self._consumer = SyncConsumer(self)
+        self._msgid = None
+        self._stopped = False
+
+        # Number of searches answered locally, and sent to the server
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "<DirectoryMirror: {0} {1}>".format(self.base_dn,
+                                                   self.filterstr)
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fetch_attrs(self):
+        """ The attributes to request from the server """
+        if self.attrs is None:
+            return ["*", "entryUUID"]
+        return list(self.attrs) + ["entryUUID"]
+
+    def _normalize(self, attr, value):
+        if attr in self.case_exact:
+            return value
+        return value.lower()
+
+    def _parent(self, ndn):
+        return ldap.dn.dn2str(parse_dn(ndn)[1:])
+
+    def _store(self, dn, attrs, uuid):
+        """ Add or replace an entry, must hold the lock """
+        ndn = self.la.normalize_dn(dn)
+        attrs = dict((k, v) for k, v in attrs.iteritems()
+                     if k.lower() != "entryuuid")
+        if uuid is not None:
+            uuid = uuid.lower()
+            old = self._uuids.get(uuid)
+            if old is not None and old != ndn:
+                # Renamed, or moved
+                self._remove(old)
+            self._uuids[uuid] = ndn
+
+        values = dict(
+            (k.lower(), [self._normalize(k.lower(), val) for val in v])
+            for k, v in attrs.iteritems()
+        )
+        parent = self._parent(ndn)
+        self._entries[ndn] = MirrorEntry(dn, attrs, values, uuid, parent)
+        self._children.setdefault(parent, set()).add(ndn)
+
+    def _remove(self, ndn):
+        """ Remove an entry, must hold the lock """
+        entry = self._entries.pop(ndn, None)
+        if entry is None:
+            return
+        if entry.uuid is not None and self._uuids.get(entry.uuid) == ndn:
+            del self._uuids[entry.uuid]
+        siblings = self._children.get(entry.parent)
+        if siblings is not None:
+            siblings.discard(ndn)
+            if not siblings:
+                del self._children[entry.parent]
+
+    def load(self, page_size=1000):
+        """ Fill the mirror with a paged search """
+        LOG.info("Loading mirror of %s", self.base_dn)
+        # Searches go to the server until it is done, including ours if the
+        # mirror is used by la
+        self.loaded = False
+        entries = self.la.iter_search(self.base_dn, ldap.SCOPE_SUBTREE,
+                                      self.filterstr, self._fetch_attrs(),
+                                      page_size)
+        # Don't hold the lock while waiting for the server
+        entries = [res for res in entries if res[0] is not None]
+        with self._lock:
+            self._entries.clear()
+            self._children.clear()
+            self._uuids.clear()
+            for dn, attrs in entries:
+                uuids = [v for k, v in attrs.iteritems()
+                         if k.lower() == "entryuuid"]
+                self._store(dn, attrs, uuids and uuids[0][0] or None)
+            self.loaded = True
+        LOG.info("Loaded %d entries of %s", len(self._entries), self.base_dn)
+
+    def start(self):
+        """ Start the content synchronization search """
+        if not self.la.is_connected:
+            self.la.connect()
+        with self._lock:
+            self._present = set()
+            self.refreshed = False
+        self._stopped = False
+        self._msgid = self._consumer.syncrepl_search(
+            self.base_dn, ldap.SCOPE_SUBTREE, mode='refreshAndPersist',
+            filterstr=self.filterstr, attrlist=self._fetch_attrs())
+        LOG.debug("Started synchronization of %s", self.base_dn)
+
+    def stop(self):
+        """ Stop the content synchronization search """
+        self._stopped = True
+        if self._msgid is not None and self.la.is_connected:
+            try:
+                self.la._ldap.abandon(self._msgid)
+            except ldap.LDAPError, e:
+                LOG.debug("Error abandoning synchronization: %s", str(e))
+        self._msgid = None
+
+    def fileno(self):
+        """ The file descriptor of the synchronization connection """
+        return self.la._ldap.fileno()
+
+    def poll(self, timeout=0):
+        """ Process the synchronization messages received, waiting up to
+        timeout seconds for one (None waits forever). The search is
+        restarted if the server ended it or went down. """
+        if self._msgid is None:
+            self.start()
+        try:
+            running = self._consumer.syncrepl_poll(msgid=self._msgid,
+                                                   timeout=timeout)
+        except ldap.TIMEOUT:
+            return
+        except ldap.SERVER_DOWN:
+            LOG.info("Synchronization of %s lost, reconnecting",
+                     self.base_dn)
+            self.la.is_connected = False
+            self._msgid = None
+            self.la.reconnect()
+            return
+        except ldap.LDAPError, e:
+            # The server may refuse the cookie, start over with a full
+            # refresh next time
+            LOG.error("Synchronization of %s failed: %s", self.base_dn,
+                      str(e))
+            self.cookie = None
+            self._msgid = None
+            raise
+
+        if not running and not self._stopped:
+            LOG.info("Synchronization of %s ended by the server",
+                     self.base_dn)
+            self._msgid = None
+
+    def run(self, interval=1):
+        """ Process synchronization messages until stop() is called, which
+        is noticed within interval seconds """
+        while not self._stopped:
+            self.poll(interval)
+
+    def sync_entry(self, dn, attrs, uuid):
+        """ An entry was added or modified """
+        with self._lock:
+            self._store(dn, attrs, uuid)
+            if self._present is not None and uuid is not None:
+                self._present.add(uuid.lower())
+
+    def sync_delete(self, uuids):
+        """ Entries were deleted """
+        with self._lock:
+            for uuid in uuids:
+                ndn = self._uuids.get(uuid.lower())
+                if ndn is not None:
+                    self._remove(ndn)
+
+    def sync_present(self, uuids, refresh_deletes=False):
+        """ Entries are unchanged, or with uuids None, the refresh is over
+        and the entries which were not reported present are gone """
+        with self._lock:
+            if uuids is not None:
+                if self._present is not None:
+                    self._present.update(uuid.lower() for uuid in uuids)
+                return
+
+            if not refresh_deletes and self._present is not None:
+                for ndn, entry in self._entries.items():
+                    if entry.uuid not in self._present:
+                        self._remove(ndn)
+            self._present = None
+
+    def sync_refreshdone(self):
+        """ The refresh phase is over, changes are now sent as they happen """
+        with self._lock:
+            self.refreshed = True
+            self.loaded = True
+        LOG.debug("Refreshed mirror of %s", self.base_dn)
+
+    def _check_attrs(self, names):
+        """ Check that every attribute of names is mirrored, "*" standing
+        for all the user attributes """
+        mirrored = set(a.lower() for a in self.attrs or ["*"])
+        missing = set(n.lower() for n in names) - mirrored
+        if "*" in mirrored:
+            # Every user attribute is mirrored, along with the others named
+            missing &= OPERATIONAL_ATTRS
+        return not missing
+
+    def _project(self, entry, attrs):
+        if attrs is None or "*" in attrs:
+            return (entry.dn,
+                    dict((k, v[:]) for k, v in entry.attrs.iteritems()))
+
+        wanted = set(a.lower() for a in attrs)
+        return (entry.dn, dict((k, v[:]) for k, v in entry.attrs.iteritems()
+                               if k.lower() in wanted))
+
+    def _scope(self, nbase, scope):
+        """ The normalized dns in scope of nbase, must hold the lock """
+        if scope == ldap.SCOPE_BASE:
+            return [nbase]
+        if scope == ldap.SCOPE_ONELEVEL:
+            return sorted(self._children.get(nbase, ()))
+
+        res = [nbase]
+        pos = 0
+        while pos < len(res):
+            res.extend(sorted(self._children.get(res[pos], ())))
+            pos += 1
+        return res
+
+    def lookup(self,
+               base_dn=None,
+               scope=ldap.SCOPE_SUBTREE,
+               filterstr='(objectClass=*)',
+               attrs=None):
+        """ Same as search(), but returns None instead of searching the
+        server when the mirror can not answer """
+        try:
+            res = self._lookup(base_dn, scope, filterstr, attrs)
+        except ldap.NO_SUCH_OBJECT:
+            self.hits += 1
+            raise
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def _lookup(self, base_dn, scope, filterstr, attrs):
+        if not self.loaded:
+            return None
+
+        nbase = self.la.normalize_dn(base_dn or self.la.base_dn)
+        if nbase != self._base and not nbase.endswith("," + self._base):
+            return None
+
+        try:
+            tree = parse_filter(filterstr)
+        except UnsupportedFilter, e:
+            LOG.debug("Mirror can't evaluate %s: %s", filterstr, str(e))
+            return None
+
+        # No attrs, as "*", asks for all the user attributes
+        requested = [a for a in attrs or ["*"] if a != "1.1"]
+        if not self._check_attrs(filter_attributes(tree) | set(requested)):
+            return None
+        if not implies(tree, self._filter):
+            # The entries matching the query might not be mirrored
+            return None
+
+        with self._lock:
+            if nbase not in self._entries:
+                if self._filter != ("present", "objectclass"):
+                    # It may exist without being mirrored
+                    return None
+                raise ldap.NO_SUCH_OBJECT({"desc": "No such object",
+                                           "matched": self.base_dn})
+
+            res = []
+            for ndn in self._scope(nbase, scope):
+                entry = self._entries.get(ndn)
+                if entry is not None and match_filter(tree, entry.values,
+                                                      self._normalize):
+                    res.append(self._project(entry, attrs))
+        return res
+
+    def search(self,
+               base_dn=None,
+               scope=ldap.SCOPE_SUBTREE,
+               filterstr='(objectClass=*)',
+               attrs=None):
+        """ Search the mirror, see LdapAdaptor.search() """
+        res = self.lookup(base_dn, scope, filterstr, attrs)
+        if res is None:
+            return self.la.search(base_dn, scope, filterstr, attrs)
+        return res
@@ -0,0 +1,278 @@
+""" the pool module shares a bounded set of LDAP connections between threads """
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+
+from plow.errors import LdapAdaptorError
+from plow.ldapadaptor import LdapAdaptor
+
+
+class PooledConnection(object):
+    """ A connection of the pool, with its own connection state """
+    def __init__(self):
+        self.ldap = None
+        self.connected = False
+        self.last_used = time.time()
+
+    def close(self):
+        if self.ldap is not None:
+            try:
+                self.ldap.unbind()
+            except ldap.LDAPError, e:
+                LOG.debug("Error closing pooled connection: %s", str(e))
+        self.ldap = None
+        self.connected = False
+
+
+def pooled(f):
+    """ Utility decorator to run a method with a connection from the pool """
+    @wraps(f)
+    def _pooled_(self, *args, **kwargs):
+        if self._current is not None:
+            # We already hold a connection in this thread
+            return f(self, *args, **kwargs)
+
+        with self.connection():
+            return f(self, *args, **kwargs)
+    return _pooled_
+
+
+class PooledLdapAdaptor(LdapAdaptor):
+    """ An LdapAdaptor sharing a pool of bound connections between threads
+
+    Every operation checks out a connection for its duration, creating one if
+    less than pool_size connections exist, or waiting for one to be returned
+    otherwise. Connections idle for more than max_idle seconds are closed, and
+    connections idle for more than check_idle seconds are checked with a root
+    DSE search before being handed out.
+
+    A generator returned by iter_search holds its connection until it is
+    exhausted or closed, so operations made while iterating use another
+    connection: pool_size must allow for it.
+    """
+    def __init__(self,
+                 server_uri,
+                 base_dn,
+                 pool_size=10,
+                 max_idle=300,
+                 check_idle=30,
+                 checkout_timeout=None,
+                 **kwargs):
+        """
+        Creates the pool, with a first connection bound to the LDAP server
+        unless lazy is set. The other arguments are the same as
+        LdapAdaptor's.
+        """
+        self._local = threading.local()
+        self._lock = threading.Condition()
+        self._idle = []
+        self._size = 1
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self.checkout_timeout = checkout_timeout
+
+        conn = PooledConnection()
+        try:
+            with self._using(conn):
+                LdapAdaptor.__init__(self, server_uri, base_dn, **kwargs)
+        finally:
+            self._checkin(conn)
+
+    def __del__(self):
+        if hasattr(self, "_lock"):
+            self.unbind()
+
+    @property
+    def _current(self):
+        """ The connection used by the current thread, if any """
+        return getattr(self._local, "conn", None)
+
+    @contextmanager
+    def _using(self, conn):
+        """ Use conn for operations in the current thread """
+        previous = self._current
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = previous
+
+    @contextmanager
+    def connection(self):
+        """ Hold a connection of the pool for the operations of the current
+        thread in this block """
+        if self._current is not None:
+            yield self._current
+            return
+
+        conn = self._checkout()
+        try:
+            with self._using(conn):
+                yield conn
+        finally:
+            self._checkin(conn)
+
+    def _get_ldap(self):
+        conn = self._current
+        return conn and conn.ldap
+    def _set_ldap(self, value):
+        self._current.ldap = value
+    _ldap = property(fget=_get_ldap, fset=_set_ldap)
+
+    def _get_connected(self):
+        conn = self._current
+        return conn is not None and conn.connected
+    def _set_connected(self, value):
+        self._current.connected = value
+    is_connected = property(fget=_get_connected, fset=_set_connected)
+
+    def _evict_idle(self):
+        """ Remove connections idle for too long, must hold the lock """
+        limit = time.time() - self.max_idle
+        stale = [conn for conn in self._idle if conn.last_used < limit]
+        if stale:
+            self._idle = [conn for conn in self._idle if conn.last_used >= limit]
+            self._size -= len(stale)
+            self._lock.notify(len(stale))
+        return stale
+
+    def _is_healthy(self, conn):
+        if time.time() - conn.last_used < self.check_idle:
+            return True
+
+        try:
+            conn.ldap.search_s("", ldap.SCOPE_BASE, "(objectClass=*)", ["1.1"])
+        except ldap.LDAPError, e:
+            LOG.info("Dropping unhealthy pooled connection: %s", str(e))
+            return False
+        return True
+
+    def _checkout(self):
+        """ Get a connection from the pool, creating it if needed """
+        start = time.time()
+        if self.checkout_timeout is not None:
+            deadline = start + self.checkout_timeout
+
+        conn = None
+        with self._lock:
+            stale = self._evict_idle()
+            while conn is None:
+                if self._idle:
+                    # Most recently used first, the others may expire
+                    conn = self._idle.pop()
+                elif self._size < self.pool_size:
+                    self._size += 1
+                    conn = PooledConnection()
+                elif self.checkout_timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise LdapAdaptorError(
+                            "No connection available in the pool after "
+                            "{0}s".format(self.checkout_timeout))
+                    self._lock.wait(remaining)
+
+        if self.metrics is not None:
+            self.metrics.timing("pool.checkout", time.time() - start)
+
+        for old in stale:
+            old.close()
+
+        if conn.connected:
+            if self._is_healthy(conn):
+                return conn
+            conn.close()
+
+        try:
+            with self._using(conn):
+                self.connect()
+        except:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        return conn
+
+    def _checkin(self, conn):
+        """ Return a connection to the pool """
+        with self._lock:
+            if conn.connected:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+            self._lock.notify()
+
+    def unbind(self):
+        """
+        Unbinds and closes the idle connections of the pool.
+        """
+        LOG.info("Closing pooled connections")
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._lock.notify(len(idle))
+
+        for conn in idle:
+            conn.close()
+
+    def iter_search(self, *args, **kwargs):
+        """
+        Same as LdapAdaptor.iter_search(), holding a connection from the pool
+        until the search is done.
+        """
+        conn = self._current
+        owned = conn is None
+        if owned:
+            conn = self._checkout()
+
+        entries = None
+        try:
+            with self._using(conn):
+                entries = LdapAdaptor.iter_search(self, *args, **kwargs)
+
+            while True:
+                with self._using(conn):
+                    try:
+                        res = entries.next()
+                    except StopIteration:
+                        break
+                yield res
+
+        finally:
+            if entries is not None:
+                # Abandons the search if it was interrupted
+                with self._using(conn):
+                    entries.close()
+            if owned:
+                self._checkin(conn)
+
+    @contextmanager
+    def batch(self, window=64):
+        """
+        Same as LdapAdaptor.batch(), holding a connection of the pool for the
+        block. It can only be used as a context manager.
+        """
+        with self.connection():
+            with LdapAdaptor.batch(self, window) as b:
+                yield b
+
+    add = pooled(LdapAdaptor.add)
+    delete = pooled(LdapAdaptor.delete)
+    modify = pooled(LdapAdaptor.modify)
+    rename = pooled(LdapAdaptor.rename)
+    _search = pooled(LdapAdaptor._search)
+    _search_window = pooled(LdapAdaptor._search_window)
+    read_entries = pooled(LdapAdaptor.read_entries)
+    compare = pooled(LdapAdaptor.compare)
+    passwd = pooled(LdapAdaptor.passwd)
+    ping = pooled(LdapAdaptor.ping)
+    root_dse = pooled(LdapAdaptor.root_dse)
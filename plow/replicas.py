@@ -0,0 +1,256 @@
+""" the replicas module routes reads to replicas and writes to the primary """
+
+from contextlib import contextmanager
+from functools import wraps
+import time
+import logging
+LOG = logging.getLogger(__name__)
+
+import ldap
+
+from plow.ldapadaptor import LdapAdaptor
+
+
+class ServerState(object):
+    """ A server of a ReplicatedLdapAdaptor, and what we know of it """
+    def __init__(self, la):
+        self.la = la
+        # Moving average of round trip times, in seconds
+        self.latency = None
+        self.last_check = 0
+        self.ejected_until = 0
+
+    def record(self, elapsed, decay):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = decay * elapsed + (1 - decay) * self.latency
+
+    def __repr__(self):
+        return "<ServerState: {0} latency={1}>".format(self.la, self.latency)
+
+
+def write(f):
+    """ Utility decorator sending an operation to the primary """
+    name = f.__name__
+    @wraps(f)
+    def _write_(self, *args, **kwargs):
+        try:
+            return getattr(self.primary.la, name)(*args, **kwargs)
+        finally:
+            self._last_write = time.time()
+    return _write_
+
+
+def read(f):
+    """ Utility decorator sending a single request to a reader, trying the
+    next one when a replica is down """
+    name = f.__name__
+    @wraps(f)
+    def _read_(self, *args, **kwargs):
+        while True:
+            server = self._reader()
+            try:
+                return getattr(server.la, name)(*args, **kwargs)
+            except ldap.SERVER_DOWN, e:
+                if server is self.primary:
+                    raise
+                self._eject(server, e)
+    return _read_
+
+
+class ReplicatedLdapAdaptor(LdapAdaptor):
+    """ An LdapAdaptor sending writes to a primary server and reads to
+    replicas
+
+    Searches and compares go to the replica with the lowest latency, measured
+    with root DSE searches every check_interval seconds and with compares.
+    A replica that fails a check or goes down is ejected for eject_time
+    seconds. When no replica is available, the primary is used.
+
+    For read_your_writes seconds after a write made through this adaptor,
+    reads go to the primary, so they see the write even if the replicas
+    have not caught up.
+
+    A cache is shared by every server, and invalidated by the writes made
+    on the primary.
+    """
+    server_class = LdapAdaptor
+
+    def __init__(self,
+                 server_uri,
+                 base_dn,
+                 replicas=(),
+                 read_your_writes=5,
+                 check_interval=30,
+                 eject_time=30,
+                 latency_decay=0.3,
+                 **kwargs):
+        """
+        Creates the adaptor for the primary server_uri and the replicas URIs.
+        The other arguments are the same as LdapAdaptor's, and are used for
+        every server. Replicas are connected when first used.
+        """
+        self.primary = ServerState(
+            self.server_class(server_uri, base_dn, **kwargs))
+
+        kwargs["lazy"] = True
+        self.replicas = [
+            ServerState(self.server_class(uri, base_dn, **kwargs))
+            for uri in replicas
+        ]
+        LdapAdaptor.__init__(self, server_uri, base_dn, **kwargs)
+
+        self.read_your_writes = read_your_writes
+        self.check_interval = check_interval
+        self.eject_time = eject_time
+        self.latency_decay = latency_decay
+        self._last_write = 0
+
+    def __str__(self):
+        return "<ReplicatedLdapAdaptor: {0} {1}>".format(
+            self._server_url,
+            " ".join(server.la._server_url for server in self.replicas))
+
+    def _check(self, server):
+        """ Measure the latency of a server, ejecting it if it fails """
+        try:
+            server.record(server.la.ping(), self.latency_decay)
+        except ldap.LDAPError, e:
+            self._eject(server, e)
+            return False
+        finally:
+            server.last_check = time.time()
+        return True
+
+    def _eject(self, server, error):
+        LOG.warn("Ejecting replica %s for %ss: %s",
+                 server.la, self.eject_time, str(error))
+        server.ejected_until = time.time() + self.eject_time
+        server.latency = None
+        server.la.is_connected = False
+
+    def _reader(self):
+        """ Select the server to send a read to """
+        now = time.time()
+        if now - self._last_write < self.read_your_writes:
+            return self.primary
+
+        candidates = []
+        for server in self.replicas:
+            if server.ejected_until > now:
+                continue
+            # A replica back from an ejection is measured before use
+            if (server.latency is None or
+                    now - server.last_check >= self.check_interval):
+                if not self._check(server):
+                    continue
+            candidates.append(server)
+
+        if not candidates:
+            return self.primary
+        return min(candidates, key=lambda server: server.latency)
+
+    @property
+    def is_connected(self):
+        return self.primary.la.is_connected
+
+    def connect(self):
+        self.primary.la.connect()
+
+    def unbind(self):
+        """
+        Unbinds and closes the connections to every server.
+        """
+        for server in [self.primary] + self.replicas:
+            server.la.unbind()
+
+    def compare(self, dn, attr_name, attr_value):
+        """ See LdapAdaptor.compare() """
+        while True:
+            server = self._reader()
+            start = time.time()
+            try:
+                res = server.la.compare(dn, attr_name, attr_value)
+            except ldap.SERVER_DOWN, e:
+                if server is self.primary:
+                    raise
+                self._eject(server, e)
+                continue
+
+            server.record(time.time() - start, self.latency_decay)
+            return res
+
+    def iter_search(self, *args, **kwargs):
+        """ See LdapAdaptor.iter_search() """
+        while True:
+            server = self._reader()
+            entries = server.la.iter_search(*args, **kwargs)
+            try:
+                first = entries.next()
+            except StopIteration:
+                return
+            except ldap.SERVER_DOWN, e:
+                if server is self.primary:
+                    raise
+                self._eject(server, e)
+                continue
+            break
+
+        yield first
+        for res in entries:
+            yield res
+
+    @read
+    def read_entries(self, dns, filterstr='(objectClass=*)', attrs=None,
+                     window=64):
+        """ See LdapAdaptor.read_entries() """
+
+    @read
+    def root_dse(self, attrs=None):
+        """ See LdapAdaptor.root_dse() """
+
+    @read
+    def _search(self, *args, **kwargs):
+        """ See LdapAdaptor._search() """
+
+    @read
+    def _search_window(self, *args, **kwargs):
+        """ See LdapAdaptor._search_window() """
+
+    def ping(self):
+        """ See LdapAdaptor.ping(), on the primary """
+        return self.primary.la.ping()
+
+    @contextmanager
+    def batch(self, window=64):
+        """
+        Same as LdapAdaptor.batch(), on the primary. It can only be used as a
+        context manager.
+        """
+        self._last_write = time.time()
+        try:
+            with self.primary.la.batch(window) as b:
+                yield b
+        finally:
+            self._last_write = time.time()
+
+    @write
+    def add(self, dn, add_record):
+        """ See LdapAdaptor.add() """
+
+    @write
+    def delete(self, dn):
+        """ See LdapAdaptor.delete() """
+
+    @write
+    def modify(self, dn, mod_attrs):
+        """ See LdapAdaptor.modify() """
+
+    @write
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        """ See LdapAdaptor.rename() """
+
+    @write
+    def passwd(self, dn, newpass, oldpass=None):
+        """ See LdapAdaptor.passwd() """
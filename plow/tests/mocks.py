@@ -1,10 +1,16 @@
+import os
+import re
+import time
 import ldap
 import logging
 log = logging.getLogger("plow.tests.mocks")
 
 def add(d, key, val):
     log.debug("++ add %s %s %s", d, key, val)
-    d.setdefault(key, []).append(val)
+    if isinstance(val, list):
+        d.setdefault(key, []).extend(val)
+    else:
+        d.setdefault(key, []).append(val)
 
 def delete(d, key, val):
     log.debug("++ delete %s %s %s", d, key, val)
@@ -12,6 +18,10 @@ def delete(d, key, val):
         if val is None:
             del d[key]
 
+        elif isinstance(val, list):
+            for v in val:
+                d[key].remove(v)
+
         else:
             d[key].remove(val)
 
@@ -28,34 +38,140 @@ OPS = {
     ldap.MOD_REPLACE : replace,
 }
 
-from plow.ldapadaptor import LdapAdaptor as BaseAdaptor
+from ldap.controls.sss import SSSRequestControl
+from ldap.controls.vlv import VLVRequestControl, VLVResponseControl
+
+from plow.ldapadaptor import (
+    LdapAdaptor as BaseAdaptor,
+    make_page_control,
+    PagedCtrl,
+)
+from plow.pool import PooledLdapAdaptor as BasePooledAdaptor
+from plow.replicas import ReplicatedLdapAdaptor as BaseReplicatedAdaptor
+from plow.delta import DirSyncControl
+from plow.errors import UnsupportedFilter
+from plow.ldapfilter import parse_filter, match_filter
+
+RANGE_REQ = re.compile(r"(?P<name>.*);range=(?P<start>\d+)-\*$")
+
+def in_scope(dn, base, scope):
+    """ Check if dn is within scope of base. Only exact DNs are handled """
+    dnparts = ldap.dn.str2dn(dn)
+    baseparts = ldap.dn.str2dn(base)
+    depth = len(dnparts) - len(baseparts)
+    if depth < 0 or (baseparts and dnparts[-len(baseparts):] != baseparts):
+        return False
+
+    if scope == ldap.SCOPE_BASE:
+        return depth == 0
+    elif scope == ldap.SCOPE_ONELEVEL:
+        return depth == 1
+    else:
+        return True
+
+def lower_entry(attrs):
+    """ The attributes of an entry as match_filter() takes them """
+    return dict(
+        (name.lower(), [value.lower() for value in values])
+        for name, values in attrs.iteritems()
+    )
 
 class FakeLDAPSrv(object):
-    def __init__(self):
-        self._data = {}
+    """ An in-memory stand-in for the LDAPObject of a server
+
+    Filters are evaluated with plow.ldapfilter, ignoring the case of values.
+    The ones it can't evaluate, like extensible matches, match every entry.
+    Results of requests are delivered after latency seconds, and errors can
+    be injected with fail().
+    """
+    def __init__(self, latency=0, max_val_range=0, data=None):
+        self._data = {} if data is None else data
+        # Set to make every request fail with SERVER_DOWN
+        self.down = False
+        # operation -> [exception, remaining count] injected by fail()
+        self.faults = {}
+        # Maximum number of values of an attribute returned at once
+        self.max_val_range = max_val_range
+        # Maximum number of entries of a result page, whatever is asked for
+        self.max_page_size = 0
+        self._msgid = 0
+        self._pending = {}
+        self.searches = []
+        self.abandoned = []
+        # Round trip time, in seconds, of every request
+        self.latency = latency
+        self._pipe = None
+        # Attributes of the root DSE
+        self.root_dse = {}
 
     @property
     def data(self):
         log.debug("DB: %r",  self._data)
         return self._data
 
+    def _check_down(self):
+        if self.down:
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+
+    def fail(self, operation, exception, count=1):
+        """ Make the next count requests of an operation (bind, search, add,
+        delete, modify, rename, compare or passwd) fail with exception, or
+        every one of them when count is None """
+        self.faults[operation] = [exception, count]
+
+    def _check_fault(self, operation):
+        fault = self.faults.get(operation)
+        if fault is None:
+            return
+        exception, count = fault
+        if count is not None:
+            fault[1] -= 1
+            if fault[1] <= 0:
+                del self.faults[operation]
+        raise exception
+
     def unbind(self):
         log.info("Unbound")
+        self.down = True
+        if self._pipe is not None:
+            map(os.close, self._pipe)
+            self._pipe = None
+
+    def fileno(self):
+        """ A file descriptor that is always readable """
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            os.write(self._pipe[1], "x")
+        return self._pipe[0]
+
+    def simple_bind(self, user, passwd):
+        return self._async("bind", self._bind, user, passwd)
 
     def simple_bind_s(self, user, passwd):
+        return self.result(self.simple_bind(user, passwd))
+
+    def _bind(self, user, passwd):
         log.info("Bound as %s", user)
         return (ldap.RES_BIND, [])
 
-    def rename_s(self, dn, newrdn, newsuperior=None, delold=1, *ctrls):
+    def _rename(self, dn, newrdn, newsuperior=None, delold=1):
         log.info("rename: dn=%r newrdn=%r newsuperior=%r delold=%r",
                  dn, newrdn, newsuperior, delold)
+        newparts = ldap.dn.str2dn(newrdn)
+        dnparts = ldap.dn.str2dn(dn)
+        dnparts[:1] = newparts
+        if newsuperior:
+            dnparts[1:] = ldap.dn.str2dn(newsuperior)
+        newdn = ldap.dn.dn2str(dnparts)
+        if newdn != dn and newdn in self.data:
+            raise ldap.ALREADY_EXISTS(newdn)
+
         try:
             dat = self.data.pop(dn)
         except KeyError:
             raise ldap.NO_SUCH_OBJECT(dn)
 
         log.debug("Current data: %s", dat)
-        newparts = ldap.dn.str2dn(newrdn)
         for key, val, _ in newparts[0]:
             attrval = dat.setdefault(key, [])
             if val not in attrval:
@@ -76,18 +192,264 @@ class FakeLDAPSrv(object):
                         del dat[key]
 
 
-        dnparts = ldap.dn.str2dn(dn)
-        dnparts[:1] = newparts
-        if newsuperior:
-            dnparts[1:] = ldap.dn.str2dn(newsuperior)
-
-        newdn = ldap.dn.dn2str(dnparts)
         self.data[newdn] = dat
         log.debug("New data: %s", dat)
 
         return (ldap.RES_MODRDN, [])
 
+    def search_ext(self, base, scope, filterstr="(objectClass=*)",
+                   attrlist=None, attrsonly=0, serverctrls=None, *args):
+        self._check_down()
+        log.info("search: %s %s %s", base, scope, filterstr)
+        self.searches.append((base, scope, filterstr, attrlist))
+        try:
+            self._check_fault("search")
+            return self._queue(self._search(base, scope, filterstr, attrlist,
+                                            serverctrls))
+        except ldap.LDAPError, e:
+            return self._queue(e)
+
+    def _search(self, base, scope, filterstr, attrlist, serverctrls):
+        try:
+            tree = parse_filter(filterstr)
+        except UnsupportedFilter:
+            if ":" not in filterstr:
+                raise ldap.FILTER_ERROR(filterstr)
+            # Extensible matches
+            tree = None
+        if tree == ("present", "objectclass"):
+            tree = None
+
+        if base == "" and scope == ldap.SCOPE_BASE:
+            # Root DSE
+            res = [("", self.root_dse)]
+        elif not base in self.data and scope == ldap.SCOPE_BASE:
+            raise ldap.NO_SUCH_OBJECT(base)
+        else:
+            res = [
+                (dn, attrs) for dn, attrs in self._entries(base, scope)
+                if tree is None or match_filter(tree, lower_entry(attrs))
+            ]
+
+        ctrls = []
+        for ctrl in serverctrls or []:
+            if isinstance(ctrl, SSSRequestControl):
+                # Sort by the last rule first, the sort is stable
+                for rule in reversed(ctrl.ordering_rules):
+                    name = rule.lstrip("-").split(":")[0]
+                    res.sort(key=lambda (dn, attrs): self._sort_key(dn, name),
+                             reverse=rule.startswith("-"))
+
+        for ctrl in serverctrls or []:
+            if isinstance(ctrl, VLVRequestControl):
+                count = len(res)
+                target = min(max(ctrl.offset, 1), count or 1)
+                res = res[max(target - 1 - ctrl.before_count, 0):
+                          target + ctrl.after_count]
+                resp = VLVResponseControl()
+                resp.target_position = target
+                resp.content_count = count
+                resp.result = 0
+                resp.context_id = None
+                ctrls.append(resp)
+            elif isinstance(ctrl, PagedCtrl):
+                size, cookie = ctrl.size, ctrl.cookie
+                size = min(size, self.max_page_size or size)
+                start = int(cookie or 0)
+                end = start + size
+                if end < len(res):
+                    cookie = str(end)
+                else:
+                    cookie = ''
+                res = res[start:end]
+                ctrls.append(make_page_control(False, size, cookie))
+            elif isinstance(ctrl, DirSyncControl):
+                # Entries with a uSNChanged after the one in the cookie
+                since = int(ctrl.cookie or 0)
+                res = [(dn, attrs) for dn, attrs in res
+                       if int(self.data[dn]["uSNChanged"][0]) > since]
+                usns = [int(attrs["uSNChanged"][0])
+                        for attrs in self.data.values()]
+                ctrls.append(DirSyncControl(
+                    cookie=str(max(usns + [since]))))
+
+        # Only the attributes of the entries of the page are copied
+        res = [(dn, self._select_attrs(attrs, attrlist)) for dn, attrs in res]
+        return (ldap.RES_SEARCH_RESULT, res, ctrls)
+
+    def _entries(self, base, scope):
+        """ The (dn, attrs) of the entries in scope, sorted by DN """
+        return [
+            (dn, attrs) for dn, attrs in sorted(self.data.iteritems())
+            if in_scope(dn, base, scope)
+        ]
+
+    def _sort_key(self, dn, name):
+        """ Entries without the attribute go last """
+        values = self.data[dn].get(name)
+        if not values:
+            return (1, None)
+        return (0, values[0].lower())
+
+    def _queue(self, outcome):
+        """ Queue the result tuple or exception of a request """
+        self._msgid += 1
+        self._pending[self._msgid] = (time.time() + self.latency, outcome)
+        return self._msgid
+
+    def _async(self, operation, func, *args):
+        """ Run an operation, queuing its outcome """
+        self._check_down()
+        try:
+            self._check_fault(operation)
+            rtype, res = func(*args)
+        except ldap.LDAPError, e:
+            return self._queue(e)
+        return self._queue((rtype, res, []))
+
+    def _range(self, name, values, start=0):
+        """ Return the range of values starting at start """
+        end = start + self.max_val_range
+        if not self.max_val_range or (start == 0 and end >= len(values)):
+            return name, values[:]
+
+        if end >= len(values):
+            return "{0};range={1}-*".format(name, start), values[start:]
+        else:
+            return ("{0};range={1}-{2}".format(name, start, end - 1),
+                    values[start:end])
+
+    def _select_attrs(self, attrs, attrlist):
+        """ The requested attributes, named as they are stored """
+        if attrlist is None:
+            return dict(self._range(k, v) for k, v in attrs.iteritems())
+
+        res = {}
+        if "*" in attrlist:
+            res.update(self._range(k, v) for k, v in attrs.iteritems())
+        names = dict((name.lower(), name) for name in attrs)
+        for name in attrlist:
+            start = 0
+            m = RANGE_REQ.match(name)
+            if m is not None:
+                name, start = m.group("name"), int(m.group("start"))
+            name = names.get(name.lower())
+            if name is not None:
+                key, values = self._range(name, attrs[name], start)
+                res[key] = values
+        return res
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        if msgid == ldap.RES_ANY:
+            msgid = min(self._pending, key=lambda m: self._pending[m][0])
+        ready, outcome = self._pending[msgid]
+        wait = ready - time.time()
+        if wait > 0:
+            if timeout == 0:
+                return None, None, None, None
+            time.sleep(wait)
+
+        del self._pending[msgid]
+        if isinstance(outcome, Exception):
+            raise outcome
+        rtype, res, ctrls = outcome
+        return rtype, res, msgid, ctrls
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:2]
+
+    def abandon(self, msgid):
+        self.abandoned.append(msgid)
+        self._pending.pop(msgid, None)
+
+    def search_s(self, base, scope, filterstr="(objectClass=*)",
+                 attrlist=None, attrsonly=0):
+        return self.result3(self.search_ext(base, scope, filterstr,
+                                            attrlist, attrsonly))[1]
+
+    def _add(self, dn, modlist):
+        log.info("add: %s %r", dn, modlist)
+        if dn in self.data:
+            raise ldap.ALREADY_EXISTS(dn)
+
+        self.data[dn] = dict(
+            (key, val[:] if isinstance(val, list) else [val])
+            for key, val in modlist
+        )
+        return (ldap.RES_ADD, [])
+
+    def _delete(self, dn):
+        log.info("delete: %s", dn)
+        try:
+            del self.data[dn]
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT(dn)
+        return (ldap.RES_DELETE, [])
+
+    def _compare(self, dn, attr, value):
+        try:
+            values = self.data[dn].get(attr, [])
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT(dn)
+        if value in values:
+            raise ldap.COMPARE_TRUE(dn)
+        raise ldap.COMPARE_FALSE(dn)
+
+    def _passwd(self, dn, oldpw, newpw):
+        try:
+            attrs = self.data[dn]
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT(dn)
+        if oldpw is not None and oldpw not in attrs.get("userPassword", []):
+            raise ldap.UNWILLING_TO_PERFORM(dn)
+        attrs["userPassword"] = [newpw]
+        return (ldap.RES_EXTENDED, [])
+
+    def add(self, dn, modlist):
+        return self._async("add", self._add, dn, modlist)
+
+    def delete(self, dn):
+        return self._async("delete", self._delete, dn)
+
+    def modify(self, dn, modlist):
+        return self._async("modify", self._modify, dn, modlist)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        return self._async("rename", self._rename, dn, newrdn, newsuperior,
+                           delold)
+
+    def compare(self, dn, attr, value):
+        return self._async("compare", self._compare, dn, attr, value)
+
+    def passwd(self, dn, oldpw, newpw):
+        return self._async("passwd", self._passwd, dn, oldpw, newpw)
+
+    # The synchronous operations wait for the result of the asynchronous ones
+
+    def add_s(self, dn, modlist):
+        return self.result(self.add(dn, modlist))
+
+    def delete_s(self, dn):
+        return self.result(self.delete(dn))
+
     def modify_s(self, dn, modlist):
+        return self.result(self.modify(dn, modlist))
+
+    def rename_s(self, dn, newrdn, newsuperior=None, delold=1, *ctrls):
+        return self.result(self.rename(dn, newrdn, newsuperior, delold))
+
+    def compare_s(self, dn, attr, value):
+        try:
+            self.result(self.compare(dn, attr, value))
+        except ldap.COMPARE_TRUE:
+            return True
+        except ldap.COMPARE_FALSE:
+            return False
+
+    def passwd_s(self, dn, oldpw, newpw):
+        return self.result(self.passwd(dn, oldpw, newpw))
+
+    def _modify(self, dn, modlist):
         log.info("modify: %s %r", dn, modlist)
         try:
             dat = self.data[dn]
@@ -107,7 +469,27 @@ class FakeLDAPSrv(object):
         return (ldap.RES_MODIFY, [])
 
 class LdapAdaptor(BaseAdaptor):
+    # Number of upcoming connections that will find the server down
+    connect_failures = 0
+
+    def initialize(self, server):
+        # Keep the data across reconnections
+        self._ldap = FakeLDAPSrv(data=self._ldap and self._ldap.data)
+        if self.connect_failures:
+            self.connect_failures -= 1
+            self._ldap.down = True
+        self.is_connected = True
+
+class PooledLdapAdaptor(BasePooledAdaptor):
+    """ Pooled connections to a shared fake server data """
     def initialize(self, server):
-        self._ldap = FakeLDAPSrv()
+        if not hasattr(self, "srv_data"):
+            self.srv_data = {}
+            self.servers = []
+        self._ldap = FakeLDAPSrv(data=self.srv_data)
+        self.servers.append(self._ldap)
         self.is_connected = True
 
+class ReplicatedLdapAdaptor(BaseReplicatedAdaptor):
+    """ Every server has its own fake server data """
+    server_class = LdapAdaptor
@@ -0,0 +1,95 @@
+import unittest
+
+import ldap
+
+from plow.asyncadaptor import AsyncLdapAdaptor
+from plow.errors import DNConflict
+from plow.ldapclass import LdapType
+from .mocks import LdapAdaptor
+
+
+class TestAsyncAdaptor(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        self.ala = AsyncLdapAdaptor(self.la)
+        for i in range(25):
+            self.srv.data["uid=user{0:02d},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0:02d}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+            }
+
+        self.User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {
+                "name" : {
+                    "attribute" : "givenName",
+                },
+            },
+        })
+
+    def test_search(self):
+        future = self.ala.search(page_size=10)
+        self.assertFalse(future.done())
+        self.assertEquals(self.ala.run(future), self.la.search())
+
+    def test_pages(self):
+        pages = self.ala.iter_search(page_size=10)
+        sizes = []
+        while True:
+            page = self.ala.run(pages.next_page())
+            if page is None:
+                break
+            sizes.append(len(page))
+        self.assertEquals(sizes, [10, 10, 5])
+
+    def test_concurrent(self):
+        futures = [
+            self.ala.compare("uid=user01,dc=example,dc=com", "uid", "user01"),
+            self.ala.compare("uid=user01,dc=example,dc=com", "uid", "other"),
+            self.ala.delete("uid=user02,dc=example,dc=com"),
+            self.ala.delete("uid=missing,dc=example,dc=com"),
+        ]
+        self.assertEquals(self.ala.pending, 4)
+        self.ala.process()
+        self.assertEquals(self.ala.pending, 0)
+
+        self.assertEquals(futures[0].result(), True)
+        self.assertEquals(futures[1].result(), False)
+        self.assertEquals(futures[2].result(), None)
+        self.assertRaises(ldap.NO_SUCH_OBJECT, futures[3].result)
+
+    def test_class_get(self):
+        user = self.ala.run(self.User.get_async(
+            dn="uid=user03,dc=example,dc=com", la=self.ala))
+        self.assertEquals(user.dn, "uid=user03,dc=example,dc=com")
+        self.assertEquals(user._ldap, self.la)
+
+        self.assertEquals(
+            self.ala.run(self.User.get_async(dn="uid=missing,dc=example,dc=com",
+                                             la=self.ala)),
+            None)
+
+    def test_class_search(self):
+        users = self.ala.run(self.User.search_async(la=self.ala))
+        self.assertEquals(len(users), 25)
+
+    def test_save(self):
+        user = self.User.get("uid=user04,dc=example,dc=com", la=self.la)
+        user.name = "Four"
+        user.set_attr("uid", "four")
+        self.ala.run(user.save_async(self.ala))
+
+        self.assertEquals(user.dn, "uid=four,dc=example,dc=com")
+        self.assertEquals(self.srv.data[user.dn]["givenName"], ["Four"])
+
+    def test_save_conflict(self):
+        user = self.User.get("uid=user04,dc=example,dc=com", la=self.la)
+        user.set_attr("uid", "user05")
+        self.assertRaises(DNConflict, self.ala.run, user.save_async(self.ala))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import unittest
+
+import ldap
+
+from plow.errors import PartialModification
+from .mocks import LdapAdaptor, PooledLdapAdaptor, ReplicatedLdapAdaptor
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+
+    def test_writes(self):
+        with self.la.batch(window=4) as b:
+            for i in range(10):
+                b.add("uid=user{0},dc=example,dc=com".format(i),
+                      [("uid", ["user{0}".format(i)])])
+            b.modify("uid=user0,dc=example,dc=com",
+                     [(ldap.MOD_REPLACE, "sn", ["Zero"])])
+            b.rename("uid=user1,dc=example,dc=com", "uid=one")
+            b.delete("uid=user2,dc=example,dc=com")
+            # Never more than window operations in flight
+            self.assertTrue(len(self.srv._pending) <= 4)
+
+        self.assertEquals(b.count, 13)
+        self.assertEquals(b.failures, [])
+        self.assertEquals(self.srv._pending, {})
+        self.assertEquals(len(self.srv.data), 9)
+        self.assertEquals(self.srv.data["uid=user0,dc=example,dc=com"]["sn"],
+                          ["Zero"])
+        self.assertTrue("uid=one,dc=example,dc=com" in self.srv.data)
+
+    def test_failures(self):
+        self.srv.data["uid=exists,dc=example,dc=com"] = {"uid": ["exists"]}
+        with self.la.batch() as b:
+            dup = b.add("uid=exists,dc=example,dc=com", [("uid", ["exists"])])
+            missing = b.delete("uid=missing,dc=example,dc=com")
+            ok = b.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+
+        self.assertEquals(b.failures, [dup, missing])
+        self.assertTrue(isinstance(dup.error, ldap.ALREADY_EXISTS))
+        self.assertTrue(isinstance(missing.error, ldap.NO_SUCH_OBJECT))
+        self.assertTrue(ok.ok)
+        self.assertTrue("uid=new,dc=example,dc=com" in self.srv.data)
+
+    def test_server_down(self):
+        self.la.reconnect_delay = 0.001
+        with self.la.batch() as b:
+            lost = b.add("uid=lost,dc=example,dc=com", [("uid", ["lost"])])
+            self.la._ldap.down = True
+            ok = b.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+
+        self.assertEquals(b.failures, [lost])
+        self.assertTrue(isinstance(lost.error, ldap.SERVER_DOWN))
+        self.assertTrue(ok.ok)
+
+    def test_dry_run(self):
+        self.la._dry_run = True
+        with self.la.batch() as b:
+            op = b.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+        self.assertTrue(op.ok)
+        self.assertEquals(self.srv.data, {})
+
+    def test_pooled(self):
+        la = PooledLdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        with la.batch() as b:
+            b.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+            self.assertEquals(la._size, 1)
+        self.assertEquals(b.failures, [])
+        self.assertTrue("uid=new,dc=example,dc=com" in la.srv_data)
+
+
+class TestChunkedModify(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                              modify_chunk_size=10, modify_window=2)
+        self.srv = self.la._ldap
+        self.dn = "cn=group,dc=example,dc=com"
+        self.srv.data[self.dn] = {"cn": ["group"], "member": []}
+        self.members = ["uid=user{0},dc=example,dc=com".format(i)
+                        for i in range(45)]
+
+    def test_chunks(self):
+        progress = []
+        self.la.modify(self.dn, [
+            (ldap.MOD_ADD, "member", member) for member in self.members
+        ], progress=lambda done, total: progress.append((done, total)))
+        self.assertEquals(self.srv.data[self.dn]["member"], self.members)
+        self.assertEquals(progress, [(i, 5) for i in range(1, 6)])
+
+        # Replaces are applied before the adds of their other values
+        self.la.modify(self.dn, [
+            (ldap.MOD_REPLACE, "member", self.members[:25]),
+            (ldap.MOD_ADD, "description", ["Chunked"]),
+        ])
+        self.assertEquals(self.srv.data[self.dn]["member"],
+                          self.members[:25])
+        self.assertEquals(self.srv.data[self.dn]["description"], ["Chunked"])
+
+    def test_failure(self):
+        mod = [(ldap.MOD_DELETE, "member", member)
+               for member in self.members[:20]]
+        mod.insert(12, (ldap.MOD_REPLACE, "description", ["Chunked"]))
+        self.srv.data[self.dn]["member"] = self.members[5:]
+        try:
+            self.la.modify(self.dn, mod)
+        except PartialModification, e:
+            # The first chunk deletes missing values, the replace is not sent
+            self.assertEquals(len(e.failed), 1)
+            self.assertEquals(e.failed[0][0], mod[:10])
+            self.assertTrue(isinstance(e.failed[0][1], ldap.NO_SUCH_ATTRIBUTE))
+            self.assertEquals(e.applied, [])
+            self.assertEquals(e.unsent, [mod[10:20], mod[20:]])
+        else:
+            self.fail("PartialModification not raised")
+
+    def test_server_down(self):
+        self.la.reconnect_delay = 0.001
+        mod = [(ldap.MOD_ADD, "member", member) for member in self.members]
+        sent = []
+        modify = self.srv.modify
+
+        def failing_modify(dn, mod_attrs):
+            sent.append(mod_attrs)
+            if len(sent) == 3:
+                # Down until the reconnection of the batch gives up
+                self.srv.down = True
+                self.la.connect_failures = self.la.reconnect_tries
+            return modify(dn, mod_attrs)
+        self.srv.modify = failing_modify
+
+        try:
+            self.la.modify(self.dn, mod)
+        except PartialModification, e:
+            self.assertEquals(e.applied, [mod[:10]])
+            # The chunk in flight is lost, the one being sent not sent
+            self.assertEquals([chunk for chunk, error in e.failed],
+                              [mod[10:20], mod[20:30]])
+            self.assertTrue(isinstance(e.failed[1][1], ldap.SERVER_DOWN))
+            self.assertEquals(e.unsent, [mod[30:40], mod[40:]])
+        else:
+            self.fail("PartialModification not raised")
+        # Not sent again
+        self.assertEquals(len(sent), 3)
+
+
+class TestChunkedModifyAdaptors(unittest.TestCase):
+    def setUp(self):
+        self.dn = "cn=group,dc=example,dc=com"
+        self.mod = [(ldap.MOD_ADD, "member", "uid=user{0},dc=example,dc=com"
+                     .format(i)) for i in range(45)]
+
+    def check(self, la, srv, data, writer):
+        """ Modify through la, which sends the writes to srv through the
+        adaptor writer """
+        data[self.dn] = {"cn": ["group"], "member": []}
+        la.modify(self.dn, self.mod)
+        self.assertEquals(len(data[self.dn]["member"]), 45)
+
+        data[self.dn]["member"] = []
+        sent = []
+        modify = srv.modify
+
+        def failing_modify(dn, mod_attrs):
+            sent.append(mod_attrs)
+            if len(sent) == 3:
+                srv.down = True
+            return modify(dn, mod_attrs)
+        srv.modify = failing_modify
+
+        def failing_reconnect():
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        writer.reconnect = failing_reconnect
+
+        try:
+            la.modify(self.dn, self.mod)
+        except PartialModification, e:
+            self.assertEquals(e.applied, [self.mod[:10]])
+            self.assertEquals(len(e.failed), 2)
+            self.assertEquals(e.unsent, [self.mod[30:40], self.mod[40:]])
+        else:
+            self.fail("PartialModification not raised")
+        self.assertEquals(len(sent), 3)
+
+    def test_pooled(self):
+        la = PooledLdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                               modify_chunk_size=10, modify_window=2)
+        self.check(la, la.servers[0], la.srv_data, la)
+        self.assertEquals(len(la.servers), 1)
+
+    def test_replicated(self):
+        la = ReplicatedLdapAdaptor("ldap://primary", "dc=example,dc=com",
+                                   replicas=["ldap://replica"],
+                                   modify_chunk_size=10, modify_window=2)
+        primary = la.primary.la
+        self.check(la, primary._ldap, primary._ldap.data, primary)
+
+
+if __name__ == '__main__':
+    unittest.main()
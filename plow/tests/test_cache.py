@@ -0,0 +1,116 @@
+import time
+import unittest
+
+import ldap
+
+from plow.cache import SearchCache
+from plow.ldapclass import LdapType
+from .mocks import LdapAdaptor
+
+
+class TestSearchCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = SearchCache()
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                              cache=self.cache)
+        self.srv = self.la._ldap
+        self.srv.data["ou=people,dc=example,dc=com"] = {"ou": ["people"]}
+        for i in range(5):
+            self.srv.data["uid=user{0},ou=people,dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+            }
+
+    def test_hits(self):
+        res = self.la.search("ou=people,dc=example,dc=com")
+        self.assertEquals(len(res), 6)
+        res[0][1]["ou"].append("changed")
+
+        self.assertEquals(self.la.search("OU=people,DC=example,dc=com"),
+                          self.la.search("ou=people,dc=example,dc=com"))
+        self.assertEquals(len(self.srv.searches), 1)
+        self.assertEquals(self.la.search()[0][1]["ou"], ["people"])
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 2)
+
+    def test_negative(self):
+        User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {},
+        })
+        for i in range(2):
+            self.assertEquals(
+                User.get("uid=missing,dc=example,dc=com", la=self.la), None)
+        self.assertEquals(len(self.srv.searches), 1)
+
+        self.la.add("uid=missing,dc=example,dc=com",
+                    [("uid", ["missing"]), ("objectClass", ["inetOrgPerson"])])
+        self.assertNotEquals(
+            User.get("uid=missing,dc=example,dc=com", la=self.la), None)
+
+    def test_invalidation(self):
+        dn = "uid=user1,ou=people,dc=example,dc=com"
+        self.la.search("ou=people,dc=example,dc=com")
+        self.la.search("ou=people,dc=example,dc=com", ldap.SCOPE_ONELEVEL)
+        self.la.search(dn, ldap.SCOPE_BASE)
+        self.la.search("uid=user2,ou=people,dc=example,dc=com",
+                       ldap.SCOPE_BASE)
+        self.la.search("dc=example,dc=com", ldap.SCOPE_ONELEVEL)
+        self.assertEquals(len(self.cache), 5)
+
+        self.la.modify(dn, [(ldap.MOD_REPLACE, "sn", ["One"])])
+        # Only the other user and the one level search above remain
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(
+            self.la.search(dn, ldap.SCOPE_BASE)[0][1]["sn"], ["One"])
+
+    def test_concurrent_search(self):
+        dn = "uid=user0,ou=people,dc=example,dc=com"
+        for name in ("modify_s", "modify"):
+            modify = getattr(self.srv, name)
+
+            def searching_modify(dn, mod_attrs, modify=modify):
+                # Made on another connection before the server has the write
+                self.la.search(dn, ldap.SCOPE_BASE)
+                return modify(dn, mod_attrs)
+            setattr(self.srv, name, searching_modify)
+
+        self.la.modify(dn, [(ldap.MOD_REPLACE, "sn", ["One"])])
+        self.assertEquals(
+            self.la.search(dn, ldap.SCOPE_BASE)[0][1]["sn"], ["One"])
+
+        with self.la.batch() as batch:
+            batch.modify(dn, [(ldap.MOD_REPLACE, "sn", ["Two"])])
+        self.assertEquals(
+            self.la.search(dn, ldap.SCOPE_BASE)[0][1]["sn"], ["Two"])
+
+    def test_rename_subtree(self):
+        self.la.search("uid=user2,ou=people,dc=example,dc=com",
+                       ldap.SCOPE_BASE)
+        self.la.rename("ou=people,dc=example,dc=com", "ou=staff")
+        self.assertEquals(len(self.cache), 0)
+
+    def test_eviction(self):
+        self.cache.max_entries = 2
+        for i in range(4):
+            self.la.search("uid=user{0},ou=people,dc=example,dc=com".format(i),
+                           ldap.SCOPE_BASE)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.evictions, 2)
+
+        # Too large to be cached
+        self.cache.max_bytes = self.cache.size + 10
+        self.la.search()
+        self.assertEquals(len(self.cache), 2)
+
+    def test_ttl(self):
+        self.cache.ttl = 0
+        self.la.search()
+        time.sleep(0.001)
+        self.la.search()
+        self.assertEquals(len(self.srv.searches), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
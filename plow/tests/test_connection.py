@@ -0,0 +1,45 @@
+import unittest
+
+import ldap
+
+from .mocks import LdapAdaptor
+
+
+class TestConnection(unittest.TestCase):
+    def test_lazy(self):
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com", lazy=True)
+        self.assertEquals(la._ldap, None)
+        self.assertEquals(la.connect_count, 0)
+
+        self.assertEquals(la.search(), [])
+        self.assertNotEquals(la._ldap, None)
+        self.assertEquals(la.connect_count, 1)
+        self.assertTrue(la.connect_time > 0)
+
+    def test_eager(self):
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.assertNotEquals(la._ldap, None)
+        self.assertEquals(la.connect_count, 1)
+
+    def test_reconnect(self):
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                         reconnect_delay=0.001)
+        la._ldap.data["dc=example,dc=com"] = {"dc": ["example"]}
+        la._ldap.down = True
+        la.connect_failures = 2
+
+        self.assertEquals(len(la.search()), 1)
+        self.assertEquals(la.connect_count, 4)
+
+    def test_reconnect_gives_up(self):
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                         reconnect_delay=0.001, reconnect_tries=2)
+        la._ldap.down = True
+        la.connect_failures = 2
+
+        self.assertRaises(ldap.SERVER_DOWN, la.search)
+        self.assertEquals(la.connect_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from plow.cache import SearchCache
+from plow.delta import (
+    DeltaReader,
+    DirSyncControl,
+    DirSyncSource,
+    FileMarkStore,
+    MemoryMarkStore,
+    TimestampSource,
+    USNSource,
+)
+from .mocks import LdapAdaptor, PooledLdapAdaptor, ReplicatedLdapAdaptor
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        for i in range(3):
+            self.srv.data["uid=user{0},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+                "modifyTimestamp": ["2014010100000{0}Z".format(i)],
+                "uSNChanged": [str(100 + i)],
+            }
+        self.srv.root_dse["highestCommittedUSN"] = ["102"]
+
+    def test_timestamp(self):
+        store = MemoryMarkStore()
+        reader = DeltaReader(self.la, TimestampSource(), store)
+        delta = reader.fetch()
+        self.assertTrue(delta.full)
+        self.assertEquals(len(delta.changed), 3)
+        self.assertEquals(delta.mark, "20140101000002Z")
+        # Nothing is stored before the changes are committed
+        self.assertEquals(reader.fetch().previous, None)
+
+        reader.commit(delta)
+        delta = reader.fetch(commit=True)
+        self.assertEquals(delta.previous, "20140101000002Z")
+        self.assertEquals(
+            self.srv.searches[-1][2],
+            "(&(objectClass=*)(modifyTimestamp>=20140101000002Z))")
+        self.assertEquals(self.srv.searches[-1][3],
+                          ["*", "modifyTimestamp"])
+
+    def test_bypasses_cache(self):
+        self.la.cache = SearchCache()
+        reader = DeltaReader(self.la, TimestampSource())
+        reader.fetch()
+        reader.fetch()
+        self.assertEquals(len(self.srv.searches), 2)
+
+    def test_usn(self):
+        reader = DeltaReader(self.la, USNSource())
+        delta = reader.fetch(commit=True)
+        self.assertEquals(delta.mark, "102")
+        self.assertEquals(delta.deleted, [])
+
+        self.srv.root_dse["highestCommittedUSN"] = ["110"]
+        delta = reader.fetch()
+        self.assertEquals(delta.mark, "110")
+        changes, deletes = self.srv.searches[-2:]
+        self.assertEquals(
+            changes[2],
+            "(&(objectClass=*)(&(uSNChanged>=103)(uSNChanged<=110)))")
+        self.assertEquals(
+            deletes[2],
+            "(&(isDeleted=TRUE)(&(uSNChanged>=103)(uSNChanged<=110)))")
+
+    def test_dirsync(self):
+        reader = DeltaReader(self.la, DirSyncSource())
+        delta = reader.fetch(commit=True)
+        self.assertEquals(len(delta.changed), 3)
+
+        self.srv.data["uid=user3,dc=example,dc=com"] = {
+            "uid": ["user3"],
+            "uSNChanged": ["103"],
+        }
+        self.srv.data["uid=user1,dc=example,dc=com"].update({
+            "isDeleted": ["TRUE"],
+            "uSNChanged": ["104"],
+        })
+        delta = reader.fetch()
+        self.assertEquals([dn for dn, attrs in delta.changed],
+                          ["uid=user3,dc=example,dc=com"])
+        self.assertEquals([dn for dn, attrs in delta.deleted],
+                          ["uid=user1,dc=example,dc=com"])
+
+    def test_pooled_adaptor(self):
+        la = PooledLdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        la.srv_data.update(self.srv.data)
+        for source in (TimestampSource(), DirSyncSource()):
+            delta = DeltaReader(la, source).fetch()
+            self.assertEquals(len(delta.changed), 3)
+        self.assertEquals(la._ldap, None)
+        self.assertEquals(len(la.servers), 1)
+
+    def test_replicated_adaptor(self):
+        la = ReplicatedLdapAdaptor("ldap://primary", "dc=example,dc=com",
+                                   replicas=["ldap://replica"])
+        srv = la.primary.la._ldap
+        srv.data.update(self.srv.data)
+        srv.root_dse["highestCommittedUSN"] = ["102"]
+        delta = DeltaReader(la, USNSource()).fetch()
+        self.assertEquals(delta.mark, "102")
+        self.assertEquals(len(srv.searches), 2)
+
+    def test_dirsync_control(self):
+        ctrl = DirSyncControl(cookie="\x01\x02cookie")
+        value = ctrl.encodeControlValue()
+        resp = DirSyncControl()
+        resp.decodeControlValue(value)
+        self.assertEquals(resp.cookie, "\x01\x02cookie")
+        self.assertEquals(resp.more_results, False)
+
+    def test_file_store(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "marks.json")
+            store = FileMarkStore(path)
+            self.assertEquals(store.get("key"), None)
+            store.set("key", "mark")
+            store.set("other", "mark2")
+            self.assertEquals(FileMarkStore(path).get("key"), "mark")
+            self.assertEquals(os.listdir(tmp), ["marks.json"])
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+
+from plow.dit import DITIndex
+from plow.ldapclass import LdapType
+from .mocks import LdapAdaptor
+
+BASE = "dc=example,dc=com"
+
+OU = LdapType.from_config("OU", {
+    "rdn" : "ou",
+    "uid" : "ou",
+    "objectClass" : "organizationalUnit",
+    "structural" : True,
+    "attributes" : {},
+})
+
+
+class TestDITIndex(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", BASE,
+                              case_insensitive_dn=True)
+        self.srv = self.la._ldap
+        self.srv.data[BASE] = {"objectClass": ["domain"]}
+        for ou in ["ou=people", "ou=staff,ou=people", "ou=groups"]:
+            self.srv.data["{0},{1}".format(ou, BASE)] = {
+                "ou": [ou.split(",")[0][3:]],
+                "objectClass": ["organizationalUnit"],
+            }
+        for i, ou in enumerate(["ou=people", "ou=staff,ou=people"]):
+            self.srv.data["uid=user{0},{1},{2}".format(i, ou, BASE)] = {
+                "uid": ["user{0}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+            }
+        self.dit = DITIndex(self.la)
+        self.dit.load()
+        self.la.dit = self.dit
+
+    def test_load(self):
+        self.assertEquals(len(self.dit), 6)
+        self.assertTrue("UID=user1,ou=Staff,ou=people," + BASE in self.dit)
+        self.assertFalse("uid=user1,ou=people," + BASE in self.dit)
+        self.assertTrue(self.dit.covers("uid=nobody," + BASE))
+        self.assertFalse(self.dit.covers("dc=other,dc=com"))
+
+    def test_navigation(self):
+        user = "uid=user1,ou=staff,ou=people," + BASE
+        self.assertTrue(self.dit.is_under(user, "OU=People," + BASE))
+        self.assertTrue(self.dit.is_under(user, BASE))
+        self.assertFalse(self.dit.is_under(user, "ou=groups," + BASE))
+        self.assertFalse(self.dit.is_under(BASE, BASE))
+        # Unknown DNs are compared
+        self.assertTrue(self.dit.is_under("uid=x,ou=new," + BASE, BASE))
+
+        self.assertEquals(self.dit.ancestors(user), [
+            "ou=staff,ou=people," + BASE, "ou=people," + BASE, BASE])
+        self.assertEquals(self.dit.parent(user), "ou=staff,ou=people," + BASE)
+        self.assertEquals(self.dit.parent(BASE), None)
+        self.assertEquals(sorted(self.dit.children("ou=people," + BASE)), [
+            "ou=staff,ou=people," + BASE, "uid=user0,ou=people," + BASE])
+        self.assertEquals(len(self.dit.subtree("ou=people," + BASE)), 3)
+
+    def test_writes(self):
+        people = "ou=people," + BASE
+        self.la.add("uid=new," + people, [("uid", ["new"]),
+                                          ("objectClass", ["inetOrgPerson"])])
+        self.assertTrue("uid=new," + people in self.dit)
+
+        self.la.rename("ou=staff," + people, "ou=team", "ou=groups," + BASE)
+        self.assertFalse("ou=staff," + people in self.dit)
+        self.assertTrue("uid=user1,ou=team,ou=groups," + BASE in self.dit)
+        self.assertEquals(
+            self.dit.parent("uid=user1,ou=team,ou=groups," + BASE),
+            "ou=team,ou=groups," + BASE)
+
+        self.la.delete("uid=user0," + people)
+        self.assertFalse("uid=user0," + people in self.dit)
+
+        # The entries outside of the loaded subtrees are not indexed
+        self.la.add("dc=other,dc=com", [("objectClass", ["domain"])])
+        self.assertFalse("dc=other,dc=com" in self.dit)
+
+    def test_rename_unindexed(self):
+        # Outside of the loaded subtrees
+        self.srv.data["ou=x,dc=other,dc=com"] = {"ou": ["x"]}
+        self.la.rename("ou=x,dc=other,dc=com", "ou=y")
+        self.assertFalse("ou=y,dc=other,dc=com" in self.dit)
+
+        # Moved into them, with children the index does not know about
+        self.la.rename("ou=y,dc=other,dc=com", "ou=y", "ou=groups," + BASE)
+        self.srv.data["cn=child,ou=y,ou=groups," + BASE] = {"cn": ["child"]}
+        moved = "ou=y,ou=groups," + BASE
+        self.assertFalse(moved in self.dit)
+        self.assertFalse(self.dit.covers(moved))
+        self.assertFalse(self.dit.covers("cn=child," + moved))
+        self.assertTrue(self.dit.covers("ou=groups," + BASE))
+        ou = OU(self.la, moved, {"ou": ["y"]})
+        self.assertEquals(ou.childdns, ["cn=child," + moved])
+
+        # Until loaded again
+        self.dit.load()
+        self.assertTrue(self.dit.covers(moved))
+        self.assertTrue("cn=child," + moved in self.dit)
+
+    def test_discard_path(self):
+        count = len(self.dit._nodes)
+        self.dit.add("uid=x,ou=a,ou=b,ou=people," + BASE)
+        self.dit.discard("uid=x,ou=a,ou=b,ou=people," + BASE)
+        self.assertEquals(len(self.dit._nodes), count)
+        self.assertEquals(len(self.dit.children("ou=people," + BASE)), 2)
+
+    def test_batch(self):
+        with self.la.batch() as batch:
+            batch.delete("uid=user0,ou=people," + BASE)
+        self.assertFalse("uid=user0,ou=people," + BASE in self.dit)
+
+    def test_ldapclass(self):
+        staff = OU(self.la, "ou=staff,ou=people," + BASE, {"ou": ["staff"]})
+        searches = []
+        search_ext = self.srv.search_ext
+
+        def counting_search_ext(*args, **kwargs):
+            searches.append(args)
+            return search_ext(*args, **kwargs)
+        self.srv.search_ext = counting_search_ext
+
+        self.assertTrue("uid=user1,ou=staff,ou=people," + BASE in staff)
+        self.assertEquals(staff.childdns,
+                          ["uid=user1,ou=staff,ou=people," + BASE])
+        self.assertEquals(staff.ancestordns, ["ou=people," + BASE, BASE])
+        self.assertEquals(searches, [])
+
+        # Without the index, the server is asked
+        self.la.dit = None
+        self.assertEquals(staff.childdns,
+                          ["uid=user1,ou=staff,ou=people," + BASE])
+        self.assertEquals(len(searches), 1)
+        self.assertEquals(staff.ancestordns, ["ou=people," + BASE, BASE])
+
+    def test_ancestordns_form(self):
+        # The DN as given, not as indexed
+        staff = OU(self.la, "ou=Staff,ou=People," + BASE, {"ou": ["Staff"]})
+        self.assertEquals(staff.ancestordns, [staff.parentdn, BASE])
+        self.assertEquals(staff.parentdn, "ou=People," + BASE)
+
+
+if __name__ == '__main__':
+    unittest.main()
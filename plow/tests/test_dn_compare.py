@@ -1,5 +1,7 @@
 import unittest
 
+import ldap.dn
+
 from plow.ldapadaptor import LdapAdaptor
 
 class FakeLA(LdapAdaptor):
@@ -38,6 +40,30 @@ class Test_Ldap_DN_Compare(unittest.TestCase):
         self._do_compare("CN=Test, OU=Base", "CN=Test,OU=Base", True)
         self._do_compare(" CN = Test,OU  =  Base    ", "CN=Test,OU=Base", True)
         self._do_compare(" CN = Te   st   ", "CN=Te   st", True)
+    def test_normalize(self):
+        for dn in ("uid=test,ou=people,dc=example,dc=com",
+                   "cn=Test User,dc=example",
+                   "UID=test,OU=people",
+                   "cn=a\\,b,dc=example",
+                   "cn=#1,dc=example",
+                   "cn= x,dc=example",
+                   ""):
+            slow = ldap.dn.dn2str(
+                [(a.lower(), v, t) for a, v, t in rdn]
+                for rdn in ldap.dn.str2dn(dn))
+            self.assertEquals(self.ldap_case_s.normalize_dn(dn), slow)
+            self.assertEquals(self.ldap_case_i.normalize_dn(dn), slow.lower())
+
+    def test_normalize_cache(self):
+        first = self.ldap_case_i.normalize_dn("CN=Test,DC=example")
+        # Normalized DNs are shared
+        self.assertTrue(
+            self.ldap_case_i.normalize_dn("cn=TEST,dc=Example") is first)
+        self.assertTrue(
+            self.ldap_case_i.normalize_dn("CN=Test,DC=example") is first)
+        self.assertEquals(self.ldap_case_s.normalize_dn("CN=Test,DC=example"),
+                          "cn=Test,dc=example")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,10 @@
 import unittest
+
+import ldap
+
+from plow.errors import UnfetchedAttribute
 from plow.ldapclass import LdapType, CaseInsensitiveDict
+from plow.utils import ModlistCost
 from .mocks import LdapAdaptor, FakeLDAPSrv
 
 
@@ -152,3 +157,292 @@ class TestLdapClass(unittest.TestCase):
         newdat = self.srv.data[u.dn]
         self.assertEquals(newdat["uid"], ["test2"])
         self.assertEquals(newdat["cn"], ["Test User"])
+
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        self.srv.data["uid=test,dc=example,dc=com"] = {
+            "uid": ["test"],
+            "objectClass": ["inetOrgPerson"],
+            "givenName": ["Hello"],
+            "thumbnailPhoto": ["x" * 1000],
+            "modifyTimestamp": ["20140101000000Z"],
+        }
+        self.cfg = {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "projection" : True,
+            "attributes" : {
+                "name" : {
+                    "attribute" : "givenName",
+                },
+                "sn" : {},
+                "groups" : {
+                    "relation" : "member",
+                    "attribute" : "memberOf",
+                },
+            },
+        }
+
+    def test_default_attrs(self):
+        User = LdapType.from_config("User", self.cfg)
+        self.assertEquals(User.get_default_attrs(),
+                          ["objectClass", "uid", "memberOf", "givenName",
+                           "sn"])
+
+        self.cfg["extra_attributes"] = ["entryUUID", "UID"]
+        Other = LdapType.from_config("Other", self.cfg)
+        self.assertEquals(Other.get_default_attrs()[-1], "entryUUID")
+        self.assertEquals(len(Other.get_default_attrs()), 6)
+
+    def test_projection(self):
+        User = LdapType.from_config("User", self.cfg)
+        u = User.get(uid="test", la=self.la)
+        self.assertEquals(self.srv.searches[-1][3], User.get_default_attrs())
+        self.assertEquals(u.name, "Hello")
+        # Fetched, but not set on the server
+        self.assertEquals(u.sn, None)
+        self.assertRaises(UnfetchedAttribute, u.get_attr, "thumbnailPhoto")
+
+        # Set attributes can be read back
+        u.set_attr("description", ["Test"])
+        self.assertEquals(u.get_attr("description"), ["Test"])
+
+        users = User.search(la=self.la, extra_attrs=["modifyTimestamp"])
+        self.assertEquals(users[0].get_attr("modifyTimestamp"),
+                          ["20140101000000Z"])
+        self.assertRaises(UnfetchedAttribute, users[0].get_attr,
+                          "thumbnailPhoto")
+
+        # Explicit attributes are used as they are
+        u = User.get(uid="test", la=self.la, attrs=["*"])
+        self.assertEquals(len(u.get_attr("thumbnailPhoto")[0]), 1000)
+
+    def test_no_projection(self):
+        del self.cfg["projection"]
+        User = LdapType.from_config("User", self.cfg)
+        u = User.get(uid="test", la=self.la)
+        self.assertEquals(self.srv.searches[-1][3], None)
+        self.assertEquals(u.get_attr("modifyTimestamp"), ["20140101000000Z"])
+
+        u = User.get(uid="test", la=self.la, extra_attrs=["entryUUID"])
+        self.assertEquals(self.srv.searches[-1][3], ["*", "entryUUID"])
+        self.assertEquals(u.get_attr("missing"), None)
+
+
+class TestChangeJournal(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        self.Group = LdapType.from_config("Group", {
+            "rdn" : "cn",
+            "uid" : "cn",
+            "objectClass" : "groupOfNames",
+            "attributes" : {
+                "members" : {
+                    "relation" : "member",
+                    "attribute" : "member",
+                },
+                "description" : {},
+            },
+        })
+        self.dn = "cn=test,dc=example,dc=com"
+        self.srv.data[self.dn] = {
+            "cn": ["test"],
+            "objectClass": ["groupOfNames"],
+            "member": ["uid=user{0},dc=example,dc=com".format(i)
+                       for i in range(5)],
+        }
+        self.mods = []
+        modify = self.la.modify
+
+        def recording_modify(dn, mod_attrs):
+            self.mods.append(mod_attrs)
+            return modify(dn, mod_attrs)
+        self.la.modify = recording_modify
+
+    def test_member_changes(self):
+        group = self.Group.get(self.dn, la=self.la)
+        group.members.add("uid=new,dc=example,dc=com")
+        group.members.remove("uid=user1,dc=example,dc=com")
+        group.members.add("uid=user1,dc=example,dc=com")
+        group.members.remove("uid=user2,dc=example,dc=com")
+        group.save()
+
+        self.assertEquals(self.mods, [[
+            (ldap.MOD_DELETE, "member", "uid=user2,dc=example,dc=com"),
+            (ldap.MOD_ADD, "member", "uid=new,dc=example,dc=com"),
+        ]])
+        self.assertEquals(len(self.srv.data[self.dn]["member"]), 5)
+
+        # Nothing left to save
+        group.save()
+        self.assertEquals(len(self.mods), 1)
+
+    def test_set_attr(self):
+        group = self.Group.get(self.dn, la=self.la)
+        group.members.add("uid=new,dc=example,dc=com")
+        group.set_attr("member", ["uid=user0,dc=example,dc=com"])
+        group.members.add("uid=other,dc=example,dc=com")
+        group.description = "Test"
+        group.save()
+
+        self.assertEquals(sorted(self.mods[0]), [
+            (ldap.MOD_ADD, "description", "Test"),
+            (ldap.MOD_REPLACE, "member", ["uid=user0,dc=example,dc=com",
+                                          "uid=other,dc=example,dc=com"]),
+        ])
+
+    def test_mark_changed(self):
+        group = self.Group.get(self.dn, la=self.la)
+        group.get_attr("member").pop()
+        group.save()
+        self.assertEquals(self.mods, [])
+
+        group.get_attr("member").pop()
+        group.mark_changed()
+        group.save()
+        self.assertEquals(len(self.mods), 1)
+        self.assertEquals(self.mods[0][0][0], ldap.MOD_REPLACE)
+
+    def test_equality(self):
+        group = self.Group.get(self.dn, la=self.la)
+        self.assertEquals(group.get_equality_rules(),
+                          {"objectclass": "case_ignore", "member": "dn"})
+        group.set_attr("member", [
+            "UID=user{0},DC=example,DC=com".format(i) for i in range(5)])
+        group.set_attr("objectClass", ["GroupOfNames"])
+        group.save()
+        self.assertEquals(self.mods, [])
+
+        group.members.remove("uid=user0,dc=example,dc=com")
+        group.members.add("UID=user0,dc=example,dc=com")
+        group.save()
+        self.assertEquals(self.mods, [])
+
+    def test_modlist_cost(self):
+        self.la.modlist_cost = ModlistCost()
+        group = self.Group.get(self.dn, la=self.la)
+        group.members.add("uid=new,dc=example,dc=com")
+        group.save()
+        self.assertEquals(self.mods[-1], [
+            (ldap.MOD_ADD, "member", "uid=new,dc=example,dc=com")])
+
+        for i in range(5):
+            group.members.remove("uid=user{0},dc=example,dc=com".format(i))
+        group.members.add("uid=other,dc=example,dc=com")
+        group.save()
+        self.assertEquals(self.mods[-1], [
+            (ldap.MOD_REPLACE, "member", ["uid=new,dc=example,dc=com",
+                                          "uid=other,dc=example,dc=com"])])
+        self.assertEquals(self.srv.data[self.dn]["member"],
+                          group.get_attr("member"))
+
+    def test_member_view_bulk(self):
+        group = self.Group.get(self.dn, la=self.la)
+        member = "uid=user{0},dc=example,dc=com".format
+        group.members.update([member(5), member(6),
+                              "UID=user0,dc=example,dc=com"])
+        group.members.difference_update([member(1), member(6)])
+        self.assertEquals(list(group.members),
+                          [member(0), member(2), member(3), member(4),
+                           member(5)])
+        self.assertTrue("UID=user5,dc=example,dc=com" in group.members)
+        self.assertEquals(group.get_attr("member"), list(group.members))
+
+        group.save()
+        self.assertEquals(self.mods, [[
+            (ldap.MOD_DELETE, "member", member(1)),
+            (ldap.MOD_ADD, "member", member(5)),
+        ]])
+
+        group.members = [member(7), member(3)]
+        self.assertEquals(list(group.members), [member(3), member(7)])
+        group.save()
+        self.assertEquals(sorted(self.mods[-1]), sorted(
+            [(ldap.MOD_DELETE, "member", member(i)) for i in (0, 2, 4, 5)] +
+            [(ldap.MOD_ADD, "member", member(7))]))
+        self.assertEquals(self.srv.data[self.dn]["member"],
+                          [member(3), member(7)])
+
+        group.members.clear()
+        self.assertEquals(group.get_attr("member"), [])
+        self.assertEquals(len(group.members), 0)
+
+
+class TestResolveMembers(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        self.User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {},
+        })
+        self.Group = LdapType.from_config("Group", {
+            "rdn" : "cn",
+            "uid" : "cn",
+            "objectClass" : "groupOfNames",
+            "attributes" : {
+                "members" : {
+                    "relation" : "member",
+                    "attribute" : "member",
+                },
+                "uids" : {
+                    "relation" : "member",
+                    "attribute" : "memberUid",
+                    "remote_attribute" : "uid",
+                },
+            },
+        })
+        for i in range(10):
+            self.srv.data["uid=user{0},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+                "sn": ["User {0}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+            }
+        self.srv.data["cn=other,dc=example,dc=com"] = {
+            "cn": ["other"],
+            "objectClass": ["groupOfNames"],
+        }
+        order = [7, 2, 9, 0, 4, 1]
+        self.srv.data["cn=test,dc=example,dc=com"] = {
+            "cn": ["test"],
+            "objectClass": ["groupOfNames"],
+            "member": ["uid=user{0},dc=example,dc=com".format(i)
+                       for i in order] + [
+                "uid=gone,dc=example,dc=com", "cn=other,dc=example,dc=com"],
+            "memberUid": ["user{0}".format(i) for i in order] + ["gone"],
+        }
+        self.group = self.Group.get("cn=test,dc=example,dc=com", la=self.la)
+        self.dns = ["uid=user{0},dc=example,dc=com".format(i) for i in order]
+        self.srv.searches = []
+
+    def test_dn_members(self):
+        users = self.group.members.resolve(self.User, attrs=["sn"])
+        self.assertEquals([user.dn for user in users], self.dns)
+        self.assertEquals(users[0].get_attr("sn"), ["User 7"])
+        self.assertEquals(users.missing, ["uid=gone,dc=example,dc=com",
+                                          "cn=other,dc=example,dc=com"])
+        # One base search per member, sent without waiting on each other
+        self.assertEquals(len(self.srv.searches), 8)
+        self.assertEquals(set(s[1] for s in self.srv.searches),
+                          set([ldap.SCOPE_BASE]))
+
+    def test_window(self):
+        users = self.group.members.resolve(self.User, window=3)
+        self.assertEquals([user.dn for user in users], self.dns)
+        self.assertEquals(self.srv._pending, {})
+
+    def test_value_members(self):
+        users = self.group.uids.resolve(self.User, attrs=["sn"],
+                                        chunk_size=4)
+        self.assertEquals([user.dn for user in users], self.dns)
+        self.assertEquals(users.missing, ["gone"])
+        self.assertEquals(len(self.srv.searches), 2)
+        # The attribute needed to match the objects is fetched
+        self.assertEquals(self.srv.searches[0][3], ["sn", "uid"])
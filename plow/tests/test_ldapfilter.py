@@ -0,0 +1,50 @@
+import unittest
+
+from plow.errors import UnsupportedFilter
+from plow.ldapfilter import parse_filter, match_filter, implies
+
+
+ENTRY = {
+    "objectclass": ["top", "inetorgperson"],
+    "uid": ["jdoe"],
+    "cn": ["john doe"],
+    "uidnumber": ["1000"],
+}
+
+
+class TestLdapFilter(unittest.TestCase):
+    def match(self, filterstr):
+        return match_filter(parse_filter(filterstr), ENTRY)
+
+    def test_parse(self):
+        self.assertEquals(
+            parse_filter("(&(objectClass=person)(!(cn=a\\2ab*c*)))"),
+            ("&", [("=", "objectclass", "person"),
+                   ("!", ("substrings", "cn", "a*b", ["c"], ""))]))
+        self.assertRaises(UnsupportedFilter, parse_filter, "(cn:dn:=x)")
+        self.assertRaises(UnsupportedFilter, parse_filter, "(cn=x")
+        self.assertRaises(UnsupportedFilter, parse_filter, "cn=x")
+
+    def test_match(self):
+        self.assertTrue(self.match("(objectClass=inetOrgPerson)"))
+        self.assertTrue(self.match("(&(uid=JDOE)(cn=*))"))
+        self.assertFalse(self.match("(|(uid=other)(mail=*))"))
+        self.assertTrue(self.match("(!(mail=*))"))
+        self.assertTrue(self.match("(cn=jo*do*)"))
+        self.assertTrue(self.match("(cn=*doe)"))
+        self.assertFalse(self.match("(cn=*john*john*)"))
+        self.assertTrue(self.match("(uidNumber>=999)"))
+        self.assertFalse(self.match("(uidNumber<=999)"))
+
+    def test_implies(self):
+        base = parse_filter("(objectClass=person)")
+        self.assertTrue(implies(parse_filter("(uid=x)"),
+                                parse_filter("(objectClass=*)")))
+        self.assertTrue(implies(
+            parse_filter("(&(objectClass=person)(uid=x))"), base))
+        self.assertFalse(implies(
+            parse_filter("(|(objectClass=person)(uid=x))"), base))
+
+
+if __name__ == '__main__':
+    unittest.main()
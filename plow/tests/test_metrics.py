@@ -0,0 +1,83 @@
+import logging
+import unittest
+
+import ldap
+
+from plow.metrics import Histogram, MetricsCollector
+from .mocks import LdapAdaptor
+
+
+class Unprintable(object):
+    def __repr__(self):
+        raise AssertionError("Formatted while logging is disabled")
+    __str__ = __repr__
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.metrics = MetricsCollector(
+            hooks=[lambda *event: self.events.append(event)])
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                              metrics=self.metrics)
+        self.srv = self.la._ldap
+        self.srv.max_val_range = 2
+        for i in range(5):
+            self.srv.data["cn=group{0},dc=example,dc=com".format(i)] = {
+                "cn": ["group{0}".format(i)],
+                "member": ["uid=a", "uid=b", "uid=c"],
+            }
+
+    def test_histogram(self):
+        hist = Histogram()
+        for i in range(100):
+            hist.add(0.001 * i)
+        self.assertEquals(hist.count, 100)
+        self.assertEquals(hist.min, 0)
+        self.assertEquals(hist.max, 0.099)
+        self.assertEquals(hist.percentile(50), 0.05)
+        self.assertEquals(hist.percentile(100), 0.099)
+
+    def test_search(self):
+        self.la.search(scope=ldap.SCOPE_ONELEVEL, page_size=2)
+        stats = self.metrics.stats()
+        self.assertEquals(stats["search"]["count"], 1)
+        self.assertEquals(stats["search.pages"], 3)
+        self.assertEquals(stats["search.entries"], 5)
+        self.assertEquals(stats["search.range_requests"], 5)
+        # The first range of 2 members and the cn
+        self.assertEquals(stats["search.values"], 15)
+        self.assertEquals(stats["search.bytes"], 5 * (6 + 2 * 5))
+
+    def test_operations(self):
+        self.la.modify("cn=group0,dc=example,dc=com",
+                       [(ldap.MOD_ADD, "member", ["uid=d"])])
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.la.delete,
+                          "cn=missing,dc=example,dc=com")
+        stats = self.metrics.stats()
+        self.assertEquals(stats["modify"]["count"], 1)
+        self.assertEquals(stats["delete"]["count"], 1)
+        self.assertEquals(stats["delete.errors"], 1)
+        self.assertTrue(("count", "delete.errors", 1) in self.events)
+
+        self.srv.down = True
+        self.la.reconnect_delay = 0
+        self.la.compare("cn=group0,dc=example,dc=com", "cn", "group0")
+        self.assertEquals(self.metrics.stats()["reconnects"], 1)
+
+    def test_lazy_logging(self):
+        adaptor_log = logging.getLogger("plow.ldapadaptor")
+        # The mock server logs the records it is sent
+        mock_log = logging.getLogger("plow.tests.mocks")
+        adaptor_log.setLevel(logging.INFO)
+        mock_log.setLevel(logging.WARNING)
+        try:
+            self.la.add("cn=new,dc=example,dc=com",
+                        [("description", [Unprintable()])])
+        finally:
+            adaptor_log.setLevel(logging.NOTSET)
+            mock_log.setLevel(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+
+import ldap
+
+from plow.ldapclass import LdapType
+from plow.mirror import DirectoryMirror
+from .mocks import LdapAdaptor, PooledLdapAdaptor
+
+
+class TestDirectoryMirror(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        self.srv.data["ou=people,dc=example,dc=com"] = {
+            "ou": ["people"],
+            "objectClass": ["organizationalUnit"],
+            "entryUUID": ["uuid-people"],
+        }
+        for i in range(5):
+            self.srv.data["uid=user{0},ou=people,dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+                "entryUUID": ["uuid-{0}".format(i)],
+            }
+
+        self.mirror = DirectoryMirror(self.la, "ou=people,dc=example,dc=com")
+        self.mirror.load()
+        self.srv.searches[:] = []
+        self.User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {},
+        })
+
+    def test_load(self):
+        self.assertEquals(len(self.mirror), 6)
+        self.assertEquals(
+            self.mirror.search("uid=user1,ou=people,dc=example,dc=com",
+                               ldap.SCOPE_BASE),
+            [("uid=user1,ou=people,dc=example,dc=com",
+              {"uid": ["user1"], "objectClass": ["inetOrgPerson"]})])
+        self.assertEquals(len(self.srv.searches), 0)
+
+    def test_search(self):
+        m = self.mirror
+        self.assertEquals(len(m.search("ou=people,dc=example,dc=com")), 6)
+        self.assertEquals(len(m.search("ou=people,dc=example,dc=com",
+                                       ldap.SCOPE_ONELEVEL)), 5)
+        res = m.search("ou=people,dc=example,dc=com",
+                       filterstr="(&(objectClass=inetOrgPerson)(uid=USER3))",
+                       attrs=["uid"])
+        self.assertEquals(res, [("uid=user3,ou=people,dc=example,dc=com",
+                                 {"uid": ["user3"]})])
+        self.assertRaises(ldap.NO_SUCH_OBJECT, m.search,
+                          "uid=missing,ou=people,dc=example,dc=com",
+                          ldap.SCOPE_BASE)
+        self.assertEquals(len(self.srv.searches), 0)
+        self.assertEquals(m.hits, 4)
+
+    def test_fallback(self):
+        m = self.mirror
+        # Outside of the mirror
+        m.search("dc=example,dc=com", ldap.SCOPE_ONELEVEL)
+        # Extensible match
+        m.search(m.base_dn, filterstr="(uid:caseExactMatch:=user1)")
+        # Operational attribute
+        m.search(m.base_dn, filterstr="(modifyTimestamp>=20140101000000Z)")
+        self.assertEquals(len(self.srv.searches), 3)
+        self.assertEquals(m.misses, 3)
+
+    def test_sync(self):
+        m = self.mirror
+        consumer = m._consumer
+        m.start()
+        # The refresh sends every entry but user4, which was deleted
+        consumer.syncrepl_entry(
+            "uid=user0,ou=people,dc=example,dc=com",
+            {"uid": ["user0"], "objectClass": ["inetOrgPerson"],
+             "sn": ["Zero"]}, "uuid-0")
+        consumer.syncrepl_present(["uuid-people", "uuid-1", "uuid-2",
+                                   "uuid-3"])
+        consumer.syncrepl_present(None, refreshDeletes=False)
+        consumer.syncrepl_refreshdone()
+        self.assertTrue(m.refreshed)
+        self.assertEquals(len(m), 5)
+
+        # Then changes as they happen
+        consumer.syncrepl_entry(
+            "uid=renamed,ou=people,dc=example,dc=com",
+            {"uid": ["renamed"], "objectClass": ["inetOrgPerson"]}, "uuid-1")
+        consumer.syncrepl_delete(["uuid-2"])
+        consumer.syncrepl_set_cookie("rid=000,csn=1")
+
+        self.assertEquals(
+            [dn for dn, attrs in m.search("ou=people,dc=example,dc=com",
+                                          filterstr="(uid=*)")],
+            ["uid=renamed,ou=people,dc=example,dc=com",
+             "uid=user0,ou=people,dc=example,dc=com",
+             "uid=user3,ou=people,dc=example,dc=com"])
+        self.assertEquals(m.search("ou=people,dc=example,dc=com",
+                                   filterstr="(sn=zero)")[0][1]["sn"],
+                          ["Zero"])
+        self.assertEquals(m.cookie, "rid=000,csn=1")
+
+    def test_adaptor(self):
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                         mirror=self.mirror)
+        user = self.User.get("uid=user2,ou=people,dc=example,dc=com", la=la)
+        self.assertEquals(user.dn, "uid=user2,ou=people,dc=example,dc=com")
+        users = self.User.search("ou=people,dc=example,dc=com",
+                                 filterstr="uid=user*", la=la)
+        self.assertEquals(len(users), 5)
+        self.assertEquals(len(la._ldap.searches), 0)
+
+    def test_pooled_adaptor(self):
+        la = PooledLdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                               mirror=self.mirror)
+        users = self.User.search("ou=people,dc=example,dc=com",
+                                 filterstr="uid=user*", la=la)
+        self.assertEquals(len(users), 5)
+        entries = la.iter_search("ou=people,dc=example,dc=com")
+        entries.next()
+        entries.close()
+        # The connection is back in the pool
+        self.assertEquals(len(la._idle), 1)
+        self.assertEquals(la.servers[0].searches, [])
+
+    def test_star_attrs(self):
+        self.srv.data["uid=user1,ou=people,dc=example,dc=com"][
+            "modifyTimestamp"] = ["20140101000000Z"]
+        m = DirectoryMirror(self.la, "ou=people,dc=example,dc=com",
+                            attrs=["*", "modifyTimestamp"])
+        m.load()
+        la = LdapAdaptor("ldap://localhost", "dc=example,dc=com", mirror=m)
+        users = self.User.search("ou=people,dc=example,dc=com",
+                                 filterstr="(modifyTimestamp=*)", la=la,
+                                 attrs=["*", "modifyTimestamp"])
+        self.assertEquals(m.hits, 1)
+        self.assertEquals(users[0].get_attr("uid"), ["user1"])
+
+        # Only some of the user attributes
+        m = DirectoryMirror(self.la, "ou=people,dc=example,dc=com",
+                            attrs=["uid"])
+        m.load()
+        m.search(m.base_dn, filterstr="(uid=user1)", attrs=["uid"])
+        m.search(m.base_dn, filterstr="(uid=user1)")
+        m.search(m.base_dn, filterstr="(uid=user1)", attrs=["*"])
+        self.assertEquals((m.hits, m.misses), (1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import time
+import unittest
+
+import ldap
+
+from plow.ldapclass import LdapType
+from .mocks import LdapAdaptor
+
+
+class TestFakeLDAPSrv(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        for i in range(5):
+            self.srv.data["uid=user{0},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+                "employeeNumber": [str(i * 10)],
+            }
+
+    def dns(self, filterstr):
+        return sorted(dn for dn, attrs in self.la.search(filterstr=filterstr))
+
+    def test_filters(self):
+        self.assertEquals(self.dns("(uid=USER1)"),
+                          ["uid=user1,dc=example,dc=com"])
+        self.assertEquals(len(self.dns("(&(objectClass=inetOrgPerson)"
+                                       "(!(uid=user1)))")), 4)
+        self.assertEquals(len(self.dns("(employeeNumber>=20)")), 3)
+        self.assertEquals(self.dns("(uid=*4)"),
+                          ["uid=user4,dc=example,dc=com"])
+        self.assertEquals(self.dns("(sn=*)"), [])
+        self.assertRaises(ldap.FILTER_ERROR, self.la.search,
+                          filterstr="(uid=user1")
+
+    def test_get_by_uid(self):
+        User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {},
+        })
+        self.assertEquals(User.get(uid="user3", la=self.la).dn,
+                          "uid=user3,dc=example,dc=com")
+        self.assertEquals(User.get(uid="nobody", la=self.la), None)
+
+    def test_attribute_names(self):
+        res = self.la.search("uid=user2,dc=example,dc=com", ldap.SCOPE_BASE,
+                             attrs=["EMPLOYEENUMBER"])
+        self.assertEquals(res[0][1], {"employeeNumber": ["20"]})
+
+    def test_faults(self):
+        self.srv.fail("modify", ldap.BUSY("busy"), count=2)
+        mod = [(ldap.MOD_REPLACE, "sn", ["Doe"])]
+        for i in range(2):
+            self.assertRaises(ldap.BUSY, self.srv.modify_s,
+                              "uid=user1,dc=example,dc=com", mod)
+        self.srv.modify_s("uid=user1,dc=example,dc=com", mod)
+        self.assertEquals(
+            self.srv.data["uid=user1,dc=example,dc=com"]["sn"], ["Doe"])
+
+        # Asynchronous requests get the error with their result
+        self.srv.fail("search", ldap.ADMINLIMIT_EXCEEDED("limit"), None)
+        msgid = self.srv.search_ext("dc=example,dc=com", ldap.SCOPE_SUBTREE)
+        self.assertRaises(ldap.ADMINLIMIT_EXCEEDED, self.srv.result3, msgid)
+        self.assertRaises(ldap.ADMINLIMIT_EXCEEDED, self.la.search)
+
+    def test_latency(self):
+        self.srv.latency = 0.02
+        start = time.time()
+        self.srv.delete_s("uid=user1,dc=example,dc=com")
+        self.assertTrue(time.time() - start >= 0.02)
+
+        # Asynchronous requests are answered in parallel
+        start = time.time()
+        msgids = [self.srv.delete("uid=user{0},dc=example,dc=com".format(i))
+                  for i in range(2, 5)]
+        for msgid in msgids:
+            self.srv.result(msgid)
+        self.assertTrue(time.time() - start < 0.05)
+
+    def test_compare_passwd(self):
+        dn = "uid=user1,dc=example,dc=com"
+        self.assertTrue(self.srv.compare_s(dn, "uid", "user1"))
+        self.assertFalse(self.srv.compare_s(dn, "uid", "user2"))
+        self.assertRaises(ldap.COMPARE_TRUE, self.srv.result,
+                          self.srv.compare(dn, "uid", "user1"))
+
+        self.srv.passwd_s(dn, None, "secret")
+        self.assertRaises(ldap.UNWILLING_TO_PERFORM, self.srv.passwd_s,
+                          dn, "wrong", "other")
+        self.srv.passwd_s(dn, "secret", "other")
+        self.assertEquals(self.srv.data[dn]["userPassword"], ["other"])
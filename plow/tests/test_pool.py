@@ -0,0 +1,77 @@
+import threading
+import time
+import unittest
+
+from plow.errors import LdapAdaptorError
+from .mocks import PooledLdapAdaptor
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.la = PooledLdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                                    pool_size=3)
+        for i in range(10):
+            self.la.srv_data["uid=user{0},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+            }
+
+    def test_reuse(self):
+        for i in range(5):
+            self.assertEquals(len(self.la.search()), 10)
+        self.assertEquals(len(self.la.servers), 1)
+        self.assertEquals(self.la._ldap, None)
+
+    def test_threads(self):
+        for srv in self.la.servers:
+            srv.latency = 0.01
+        results = []
+        active = []
+
+        def work():
+            for i in range(5):
+                results.append(len(self.la.search()))
+                active.append(self.la._size)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals(results, [10] * 40)
+        self.assertTrue(max(active) <= 3)
+        self.assertTrue(len(self.la.servers) <= 3)
+
+    def test_iter_search_holds_connection(self):
+        self.la.pool_size = 1
+        self.la.checkout_timeout = 0.01
+        res = self.la.iter_search()
+        res.next()
+        self.assertRaises(LdapAdaptorError, self.la.search)
+        res.close()
+        self.assertEquals(len(self.la.search()), 10)
+        self.assertEquals(len(self.la.servers), 1)
+
+    def test_idle_eviction(self):
+        self.la.max_idle = 0
+        time.sleep(0.01)
+        self.la.search()
+        self.assertEquals(len(self.la.servers), 2)
+        self.assertTrue(self.la.servers[0].down)
+
+    def test_health_check(self):
+        self.la.check_idle = 0
+        self.la.servers[0].down = True
+        self.assertEquals(len(self.la.search()), 10)
+        self.assertEquals(len(self.la.servers), 2)
+
+    def test_read_entries(self):
+        res = self.la.read_entries(["uid=user3,dc=example,dc=com",
+                                    "uid=missing,dc=example,dc=com"])
+        self.assertEquals(res[0][0], "uid=user3,dc=example,dc=com")
+        self.assertEquals(res[1], None)
+        self.assertEquals(self.la._ldap, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
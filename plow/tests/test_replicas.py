@@ -0,0 +1,122 @@
+import time
+import unittest
+
+from plow.cache import SearchCache
+from plow.metrics import MetricsCollector
+from .mocks import ReplicatedLdapAdaptor
+
+
+class TestReplicas(unittest.TestCase):
+    def setUp(self):
+        self.la = ReplicatedLdapAdaptor(
+            "ldap://primary", "dc=example,dc=com",
+            replicas=["ldap://replica1", "ldap://replica2"],
+            reconnect_delay=0.001,
+        )
+        self.primary = self.la.primary.la
+        self.replica1 = self.la.replicas[0].la
+        self.replica2 = self.la.replicas[1].la
+        # Connect the replicas to set up their data
+        for la in (self.primary, self.replica1, self.replica2):
+            la.connect()
+            la._ldap.data["dc=example,dc=com"] = {"dc": ["example"]}
+
+    def test_lowest_latency(self):
+        self.replica1._ldap.latency = 0.02
+        self.replica2._ldap.latency = 0.001
+        self.assertEquals(len(self.la.search()), 1)
+        self.assertEquals(len(self.replica2._ldap.searches), 2)
+        self.assertEquals(len(self.replica1._ldap.searches), 1)
+        self.assertEquals(len(self.primary._ldap.searches), 0)
+
+    def test_unmeasured_replica(self):
+        self.replica1._ldap.latency = 0.02
+        self.replica2._ldap.latency = 0.001
+        self.la.search()
+        # Back from an ejection, before its next check
+        self.la.replicas[0].latency = None
+        self.la.replicas[0].last_check = time.time()
+        self.la.search()
+        self.assertEquals(len(self.replica2._ldap.searches), 3)
+        self.assertEquals(len(self.replica1._ldap.searches), 2)
+        self.assertNotEquals(self.la.replicas[0].latency, None)
+
+    def test_forwarded_reads(self):
+        self.replica1._ldap.root_dse["vendorName"] = ["replica"]
+        self.replica2._ldap.latency = 0.02
+        self.assertTrue(self.la.ping() >= 0)
+        self.assertEquals(len(self.primary._ldap.searches), 1)
+        self.assertEquals(self.la.root_dse(["vendorName"]),
+                          {"vendorName": ["replica"]})
+        self.assertEquals(
+            len(self.la._search("dc=example,dc=com", 0, "(objectClass=*)",
+                                None, 1000, None)), 1)
+
+    def test_writes(self):
+        self.la.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+        self.assertTrue("uid=new,dc=example,dc=com" in self.primary._ldap.data)
+        self.assertFalse("uid=new,dc=example,dc=com" in self.replica1._ldap.data)
+
+        # Read our own writes
+        self.assertEquals(len(self.la.search()), 2)
+        self.assertTrue(self.la.compare("uid=new,dc=example,dc=com",
+                                        "uid", "new"))
+
+        self.la._last_write = 0
+        self.assertEquals(len(self.la.search()), 1)
+
+    def test_ejection(self):
+        self.la.search()
+        self.replica1._ldap.down = True
+        self.replica2._ldap.down = True
+        self.replica1.connect_failures = 10
+        self.replica2.connect_failures = 10
+
+        self.assertEquals(len(self.la.search()), 1)
+        self.assertEquals(len(self.primary._ldap.searches), 1)
+        for server in self.la.replicas:
+            self.assertTrue(server.ejected_until > 0)
+
+    def test_read_entries(self):
+        self.replica1._ldap.latency = 0.001
+        self.replica2._ldap.latency = 0.02
+        self.replica1._ldap.data["uid=user,dc=example,dc=com"] = {
+            "uid": ["user"]}
+        res = self.la.read_entries(["uid=user,dc=example,dc=com",
+                                    "uid=missing,dc=example,dc=com"])
+        self.assertEquals(res[0][0], "uid=user,dc=example,dc=com")
+        self.assertEquals(res[1], None)
+
+        self.replica1._ldap.down = True
+        self.replica1.connect_failures = 10
+        res = self.la.read_entries(["uid=user,dc=example,dc=com"])
+        self.assertEquals(res, [None])
+        self.assertTrue(self.la.replicas[0].ejected_until > 0)
+
+    def test_cache_and_metrics(self):
+        metrics = MetricsCollector()
+        la = ReplicatedLdapAdaptor("ldap://primary", "dc=example,dc=com",
+                                   replicas=["ldap://replica"],
+                                   cache=SearchCache(), metrics=metrics)
+        replica = la.replicas[0].la
+        replica.connect()
+        replica._ldap.data["dc=example,dc=com"] = {"dc": ["example"]}
+        for i in range(2):
+            self.assertEquals(len(la.search()), 1)
+        # A ping, and a single search
+        self.assertEquals(len(replica._ldap.searches), 2)
+        self.assertEquals(metrics.stats()["search"]["count"], 2)
+
+        # Invalidated by the writes on the primary
+        la.add("uid=new,dc=example,dc=com", [("uid", ["new"])])
+        self.assertEquals(len(la.search()), 1)
+        self.assertEquals(len(la.primary.la._ldap.searches), 1)
+
+    def test_no_replicas(self):
+        la = ReplicatedLdapAdaptor("ldap://primary", "dc=example,dc=com")
+        self.assertEquals(la.search(), [])
+        self.assertEquals(len(la.primary.la._ldap.searches), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+
+import ldap
+
+from plow.ldapadaptor import AdaptivePageSize, PagedSearch
+from plow.ldapclass import LdapType
+from plow.metrics import MetricsCollector
+from .mocks import LdapAdaptor
+
+
+class TestIterSearch(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        for i in range(25):
+            self.srv.data["uid=user{0:02d},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0:02d}".format(i)],
+                "objectClass": ["inetOrgPerson"],
+            }
+
+        self.User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {},
+        })
+
+    def test_pages(self):
+        res = self.la.iter_search(scope=ldap.SCOPE_ONELEVEL, page_size=10)
+        # Nothing is sent before the first result is requested
+        self.assertEquals(len(self.srv.searches), 0)
+
+        first = res.next()
+        self.assertEquals(first[0], "uid=user00,dc=example,dc=com")
+        self.assertEquals(len(self.srv.searches), 1)
+
+        rest = list(res)
+        self.assertEquals(len(rest), 24)
+        self.assertEquals(len(self.srv.searches), 3)
+
+    def test_same_as_search(self):
+        self.assertEquals(
+            list(self.la.iter_search(page_size=7)),
+            self.la.search(page_size=7),
+        )
+
+    def test_read_ahead(self):
+        res = self.la.iter_search(scope=ldap.SCOPE_ONELEVEL, page_size=10,
+                                  read_ahead=1)
+        res.next()
+        # The second page is requested while the first is processed
+        self.assertEquals(len(self.srv.searches), 2)
+
+        self.assertEquals(len(list(res)), 24)
+        self.assertEquals(len(self.srv.searches), 3)
+
+    def test_read_ahead_polls(self):
+        polls = []
+        result3 = self.srv.result3
+
+        def counting_result3(*args, **kwargs):
+            polls.append(kwargs.get("timeout"))
+            return result3(*args, **kwargs)
+        self.srv.result3 = counting_result3
+
+        self.srv.latency = 0.01
+        res = self.la.iter_search(scope=ldap.SCOPE_ONELEVEL, page_size=20,
+                                  read_ahead=1)
+        self.assertEquals(len(list(res)), 25)
+        # A wait for each page, not a poll for every entry while the second
+        # one is on its way
+        self.assertEquals(polls, [None, None])
+
+    def test_read_ahead_capped(self):
+        # The cookie of the third page only comes with the second one
+        search = PagedSearch(self.la, "dc=example,dc=com", ldap.SCOPE_ONELEVEL,
+                             "(objectClass=*)", None, read_ahead=3)
+        self.assertEquals(search.read_ahead, 1)
+
+    def test_read_ahead_same_results(self):
+        self.la.read_ahead = 2
+        self.assertEquals(
+            self.la.search(page_size=4),
+            self.la.search(page_size=4, read_ahead=0),
+        )
+
+    def test_abandon(self):
+        res = self.la.iter_search(scope=ldap.SCOPE_ONELEVEL, page_size=10,
+                                  read_ahead=1)
+        res.next()
+        res.close()
+        self.assertEquals(len(self.srv.abandoned), 1)
+        self.assertEquals(self.srv._pending, {})
+
+    def test_ranges(self):
+        self.srv.max_val_range = 10
+        for i in range(3):
+            self.srv.data["cn=group{0},dc=example,dc=com".format(i)] = {
+                "cn": ["group{0}".format(i)],
+                "member": ["uid=user{0:02d},dc=example,dc=com".format(m)
+                           for m in range(25)],
+            }
+
+        res = self.la.search(filterstr="(cn=*)", scope=ldap.SCOPE_ONELEVEL)
+        Group = LdapType.from_config("Group", {
+            "rdn" : "cn",
+            "uid" : "cn",
+            "objectClass" : "top",
+            "attributes" : {},
+        })
+        for dn, attrs in res:
+            if dn.startswith("cn="):
+                group = Group(self.la, dn, attrs)
+                self.assertEquals(len(group.get_attr("member")), 25)
+                self.assertEquals(group.get_attr("member"),
+                                  self.srv.data[dn]["member"])
+
+        # The range requests of all groups are sent before the next ones
+        self.assertEquals(
+            [attrlist for base, scope, filterstr, attrlist
+             in self.srv.searches[1:]],
+            [["member;range=10-*"]] * 3 + [["member;range=20-*"]] * 3,
+        )
+
+    def test_class_iter_search(self):
+        users = list(self.User.iter_search(la=self.la))
+        self.assertEquals(len(users), 25)
+        self.assertTrue(all(isinstance(u, self.User) for u in users))
+        self.assertEquals(users[3].get_attr("uid"), ["user03"])
+
+
+class TestAdaptivePageSize(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsCollector()
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com",
+                              metrics=self.metrics)
+        self.srv = self.la._ldap
+        for i in range(25):
+            self.srv.data["uid=user{0:02d},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0:02d}".format(i)],
+            }
+
+    def test_observe(self):
+        sizer = AdaptivePageSize(initial=100, min_size=10, max_size=1000,
+                                 target_time=1.0, target_bytes=1000)
+        self.assertEquals(sizer.size(None), 100)
+        # Grows by a factor of 2 at most
+        self.assertEquals(sizer.observe(None, 100, 100, 0.001, 100, True), 200)
+        # Kept under target_time
+        self.assertEquals(sizer.observe(None, 200, 200, 1.0, 200, True), 200)
+        # Shrinks at once under target_bytes
+        self.assertEquals(sizer.observe(None, 200, 200, 0.01, 20000, True), 10)
+        self.assertEquals(sizer.size(None), 10)
+        # Other attributes are tuned separately
+        self.assertEquals(sizer.size(["uid"]), 100)
+        self.assertEquals(sizer.shrink(["UID"], 100), 50)
+        self.assertEquals(sizer.size(["uid"]), 50)
+        self.assertEquals(sizer.shrink(None, 10), None)
+
+    def test_grows(self):
+        sizer = AdaptivePageSize(initial=2, min_size=1)
+        self.assertEquals(len(self.la.search(page_size=sizer)), 25)
+        # Pages of 2, 4, 8 and 16 entries
+        self.assertEquals(len(self.srv.searches), 4)
+        self.assertEquals(self.metrics.stats()["search.page_size"], 16)
+
+        self.la.page_size = sizer
+        self.la.search()
+        self.assertEquals(len(self.srv.searches), 6)
+
+    def test_server_limit(self):
+        self.srv.max_page_size = 5
+        sizer = AdaptivePageSize(initial=10, min_size=1)
+        self.assertEquals(len(self.la.search(page_size=sizer)), 25)
+        self.assertEquals(sizer.server_limit, 5)
+        self.assertEquals(sizer.size(None), 5)
+
+    def test_limit_exceeded(self):
+        self.srv.fail("search", ldap.TIMELIMIT_EXCEEDED("too long"))
+        sizer = AdaptivePageSize(initial=10, min_size=1)
+        self.assertEquals(len(self.la.search(page_size=sizer)), 25)
+        # The failed request, then pages of 5, 10 and 20 entries
+        self.assertEquals(len(self.srv.searches), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import ldap
+
+from plow.errors import LdapAdaptorError
+from plow.ldapadaptor import ResultWindow
+from plow.ldapclass import LdapType
+from .mocks import LdapAdaptor
+
+
+class TestSortedSearch(unittest.TestCase):
+    def setUp(self):
+        self.la = LdapAdaptor("ldap://localhost", "dc=example,dc=com")
+        self.srv = self.la._ldap
+        for i, name in enumerate(["Delta", "alpha", "Charlie", "bravo",
+                                  "echo"]):
+            self.srv.data["uid=user{0},dc=example,dc=com".format(i)] = {
+                "uid": ["user{0}".format(i)],
+                "sn": [name],
+                "objectClass": ["inetOrgPerson"],
+            }
+
+        self.User = LdapType.from_config("User", {
+            "rdn" : "uid",
+            "uid" : "uid",
+            "objectClass" : "inetOrgPerson",
+            "attributes" : {
+                "surname" : {
+                    "attribute" : "sn",
+                },
+            },
+        })
+
+    def test_sort(self):
+        res = self.la.search(scope=ldap.SCOPE_ONELEVEL, sort="-sn",
+                             page_size=2)
+        self.assertEquals([attrs["sn"][0] for dn, attrs in res],
+                          ["echo", "Delta", "Charlie", "bravo", "alpha"])
+        self.assertFalse(isinstance(res, ResultWindow))
+
+    def test_window(self):
+        res = self.la.search(scope=ldap.SCOPE_ONELEVEL, sort=["sn"],
+                             window=(1, 2))
+        self.assertEquals([attrs["sn"][0] for dn, attrs in res],
+                          ["bravo", "Charlie"])
+        self.assertEquals(res.offset, 1)
+        self.assertEquals(res.content_count, 5)
+        # A single request, without paging
+        self.assertEquals(len(self.srv.searches), 1)
+
+        self.assertRaises(LdapAdaptorError, self.la.search, window=(0, 10))
+
+    def test_ldapclass(self):
+        users = self.User.search(sort="surname", window=(3, 10), la=self.la)
+        self.assertEquals([u.surname for u in users], ["Delta", "echo"])
+        self.assertEquals(users.content_count, 5)
+        self.assertEquals(
+            self.srv.searches[0][2], "(&(objectClass=inetOrgPerson))")
+
+        users = self.User.search(sort="-surname", la=self.la)
+        self.assertEquals(users[0].surname, "echo")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,14 @@ import unittest
 
 from ldap import MOD_ADD, MOD_DELETE, MOD_REPLACE
 
-from plow.utils import modify_modlist
+from plow.metrics import MetricsCollector
+from plow.utils import (
+    modify_modlist,
+    BoundedCache,
+    chunk_modlist,
+    ModlistCost,
+    parse_dn,
+)
 
 class Test_ModifyModList(unittest.TestCase):
     def test_atomic_update(self):
@@ -27,6 +34,89 @@ class Test_ModifyModList(unittest.TestCase):
                            {"a":["val2", "val3"]}),
             [(MOD_REPLACE, "a", ["val2", "val3"])])
 
+    def test_equality(self):
+        equality = {"member": lambda dn: dn.lower()}
+        old = {"member": ["CN=Bob,OU=People", "cn=alice,ou=people"]}
+        new = {"member": ["cn=bob,ou=people", "cn=alice,ou=people"]}
+        self.assertEquals(modify_modlist(old, new, equality=equality), [])
+        self.assertEquals(modify_modlist(old, new, True, equality), [])
+
+        new["member"].append("CN=Eve,OU=People")
+        self.assertEquals(modify_modlist(old, new, True, equality),
+                          [(MOD_ADD, "member", "CN=Eve,OU=People")])
+        # Without equality, the values are compared as they are
+        self.assertEquals(len(modify_modlist(old, new, True)), 3)
+
+class Test_ModlistCost(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsCollector()
+        self.cost = ModlistCost(metrics=self.metrics)
+        self.old = {"member": ["uid=user{0}".format(i) for i in range(100)]}
+
+    def test_delta(self):
+        new = {"member": self.old["member"][1:] + ["uid=new"]}
+        self.assertEquals(
+            modify_modlist(self.old, new, cost=self.cost),
+            [(MOD_DELETE, "member", "uid=user0"),
+             (MOD_ADD, "member", "uid=new")])
+        self.assertEquals(self.metrics.counters["modlist.delta"], 1)
+
+    def test_replace(self):
+        new = {"member": ["uid=new{0}".format(i) for i in range(50)]}
+        self.assertEquals(
+            modify_modlist(self.old, new, cost=self.cost),
+            [(MOD_REPLACE, "member", new["member"])])
+        self.assertEquals(self.metrics.counters["modlist.replace"], 1)
+
+        # Small attributes can always be replaced
+        self.cost.min_values = 200
+        new = {"member": self.old["member"][1:]}
+        self.assertEquals(
+            modify_modlist(self.old, new, cost=self.cost),
+            [(MOD_REPLACE, "member", new["member"])])
+
+        # Atomic changes never are
+        self.assertEquals(len(modify_modlist(self.old, new, True)), 1)
+
+
+class Test_ChunkModlist(unittest.TestCase):
+    def test_chunks(self):
+        mod = [(MOD_DELETE, "a", None), (MOD_ADD, "b", "val1"),
+               (MOD_REPLACE, "c", ["val2", "val3", "val4", "val5"])]
+        self.assertEquals(chunk_modlist(mod, 3), [
+            [(MOD_DELETE, "a", None), (MOD_ADD, "b", "val1")],
+            [(MOD_REPLACE, "c", ["val2", "val3", "val4"])],
+            [(MOD_ADD, "c", ["val5"])],
+        ])
+        self.assertEquals(chunk_modlist(mod, 10), [
+            [(MOD_DELETE, "a", None), (MOD_ADD, "b", "val1"),
+             (MOD_REPLACE, "c", ["val2", "val3", "val4", "val5"])],
+        ])
+
+
+class Test_BoundedCache(unittest.TestCase):
+    def test_bounded(self):
+        cache = BoundedCache(10)
+        for i in range(6):
+            cache[i] = str(i)
+        self.assertEquals(len(cache), 6)
+        # 0 is used again, it stays when the oldest ones are dropped
+        self.assertEquals(cache.get(0), "0")
+        for i in range(6, 10):
+            cache[i] = str(i)
+        self.assertTrue(len(cache) <= 10)
+        self.assertEquals(cache.get(0), "0")
+        self.assertEquals(cache.get(1), None)
+        self.assertEquals(cache.get(9), "9")
+
+    def test_parse_dn(self):
+        parts = parse_dn("uid=test,dc=example")
+        self.assertEquals(parts, (
+            (("uid", "test", 1), ),
+            (("dc", "example", 1), ),
+        ))
+        self.assertTrue(parse_dn("uid=test,dc=example") is parts)
+
 
 if __name__ == '__main__':
     unittest.main()
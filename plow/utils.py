@@ -1,4 +1,80 @@
+import re
+
 import ldap
+import ldap.dn
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6
+    from ordereddict import OrderedDict
+
+# A value that ldap.dn.dn2str() writes as it is: no special characters, and
+# no leading or trailing spaces
+_DN_VALUE = (r'[^,=+"\\<>;#\s\x00]'
+             r'(?:[^,=+"\\<>;\x00\t\r\n]*[^,=+"\\<>;\s\x00])?')
+# A DN of single valued RDNs with lowercase attribute types, which
+# normalization would leave as it is, but for the case of values
+CANONICAL_DN = re.compile(r'^[a-z][a-z0-9-]*={0}(?:,[a-z][a-z0-9-]*={0})*$'
+                          .format(_DN_VALUE))
+
+
+class BoundedCache(object):
+    """ A mapping of at most max_size items, forgetting the least recently
+    used ones in bulk
+
+    Items are stored in a new generation. When it holds max_size / 2 items,
+    it replaces the old generation, which is dropped. Items found in the
+    old generation move to the new one. This costs a lot less than keeping
+    the exact order of use, and is safe to share between threads.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._new = {}
+        self._old = {}
+
+    def get(self, key, default=None):
+        try:
+            return self._new[key]
+        except KeyError:
+            pass
+        try:
+            value = self._old[key]
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self._new) >= self.max_size // 2:
+            self._old = self._new
+            self._new = {}
+        self._new[key] = value
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    def clear(self):
+        self._new = {}
+        self._old = {}
+
+
+_parsed_dns = BoundedCache()
+
+def parse_dn(dn):
+    """ ldap.dn.str2dn(dn) as a tuple of RDN tuples, which are cached so
+    that DNs are not parsed again and again. """
+    parts = _parsed_dns.get(dn)
+    if parts is None:
+        parts = tuple(tuple(rdn) for rdn in ldap.dn.str2dn(dn))
+        _parsed_dns[dn] = parts
+    return parts
+
+def intern_dn(dn):
+    """ The shared copy of dn, when it is a str """
+    if type(dn) is str:
+        return intern(dn)
+    return dn
 
 def smart_str_to_unicode(s):
     """ Convert to unicode if applicable; else leave as str.
@@ -111,40 +187,134 @@ def prepare_str_for_ldap(s):
 
     return str(s)
 
-def dict_diff(old, new):
+def _compared(values, key=None):
+    """ The set of values, or of what key gives for them """
+    if key is None:
+        return set(values)
+    return set(key(value) for value in values)
+
+def _missing(values, others, key=None):
+    """ The values which are not in others, compared with key when given """
+    if key is None:
+        return set(values) - set(others)
+    others = _compared(others, key)
+    return set(value for value in values if key(value) not in others)
+
+def dict_diff(old, new, equality=None):
+    """ (added, updated, removed) attribute names of new compared to old
+
+    equality maps lowercase attribute names to a function giving what is
+    compared of their values, for the attributes whose values are not
+    compared as they are, such as DNs.
+    """
+    equality = equality or {}
     orig = set(old)
     curr = set(new)
     return (
         curr - orig,
-        set([k for k in orig & curr if set(old[k]) != set(new[k])]),
+        set([k for k in orig & curr
+             if _compared(old[k], equality.get(k.lower()))
+                != _compared(new[k], equality.get(k.lower()))]),
         orig - curr,
     )
 
 
-def modify_modlist(old, new, atomic=False):
-    newattrs, upd, rem = dict_diff(old, new)
+class ModlistCost(object):
+    """ Picks, for each changed attribute, between a MOD_REPLACE of all its
+    values and a MOD_DELETE and MOD_ADD of each value removed and added,
+    by the size of the modifications
+
+    Pass it as the cost of modify_modlist(), or as the modlist_cost of an
+    LdapAdaptor for the saves of LdapClass objects. Each value counts for
+    its length plus value_overhead bytes, and each modification for
+    op_overhead bytes, roughly as they are encoded in requests.
+
+    Value changes are sent when they are smaller than ratio times the
+    replace, a ratio under 1 favoring replaces, which do not depend on the
+    values the server has. Attributes of at most min_values values are
+    always replaced.
+
+    metrics can be a plow.metrics.MetricsCollector, counting the choices
+    made as modlist.replace and modlist.delta.
+    """
+    def __init__(self, ratio=1.0, min_values=0, op_overhead=16,
+                 value_overhead=4, metrics=None):
+        self.ratio = ratio
+        self.min_values = min_values
+        self.op_overhead = op_overhead
+        self.value_overhead = value_overhead
+        self.metrics = metrics
+
+    def _size(self, values):
+        return sum(len(value) for value in values) + \
+            self.value_overhead * len(values)
+
+    def choose(self, values, removed, added):
+        """ "replace" to replace an attribute by values, or "delta" to send
+        the removed and added values """
+        strategy = "replace"
+        if len(values) > self.min_values:
+            delta = (self._size(removed) + self._size(added) +
+                     self.op_overhead * (len(removed) + len(added)))
+            # Values take at least value_overhead bytes, which saves
+            # measuring the large attributes changing a little
+            replace = self.op_overhead + self.value_overhead * len(values)
+            if delta < self.ratio * replace or delta < self.ratio * (
+                    self.op_overhead + self._size(values)):
+                strategy = "delta"
+
+        if self.metrics is not None:
+            self.metrics.incr("modlist." + strategy)
+        return strategy
+
+    def __repr__(self):
+        return "<ModlistCost: ratio={0}>".format(self.ratio)
+
+
+def modify_modlist(old, new, atomic=False, equality=None, cost=None):
+    """ The modlist changing the attributes old into new, see dict_diff()
+    about equality
+
+    The values of updated attributes are replaced, unless atomic is set, in
+    which case the values removed and added are sent, or cost is a
+    ModlistCost to choose between both for each attribute.
+    """
+    equality = equality or {}
+    newattrs, upd, rem = dict_diff(old, new, equality)
     if atomic:
         # in atomic mode, we remove all existing values to replace them
         # with new values in update ops
         mod = [
             (ldap.MOD_DELETE, attrname, value)
             for attrname in (upd | rem)
-            for value in set(old[attrname]) - set(new.get(attrname, []))
+            for value in _missing(old[attrname], new.get(attrname, []),
+                                  equality.get(attrname.lower()))
         ] + [
             (ldap.MOD_ADD, attrname, value)
             for attrname in (newattrs | upd)
-            for value in set(new[attrname]) - set(old.get(attrname, []))
+            for value in _missing(new[attrname], old.get(attrname, []),
+                                  equality.get(attrname.lower()))
         ]
     else:
         mod = [
             # Delete attributes that are to be removed
             (ldap.MOD_DELETE, attrname, None)
             for attrname in rem
-        ] + [
+        ]
+        for attrname in upd:
+            if cost is not None:
+                key = equality.get(attrname.lower())
+                removed = _missing(old[attrname], new[attrname], key)
+                added = _missing(new[attrname], old[attrname], key)
+                if cost.choose(new[attrname], removed, added) == "delta":
+                    mod.extend((ldap.MOD_DELETE, attrname, value)
+                               for value in sorted(removed))
+                    mod.extend((ldap.MOD_ADD, attrname, value)
+                               for value in sorted(added))
+                    continue
             # For updates, replace by new values
-            (ldap.MOD_REPLACE, attrname, new[attrname])
-            for attrname in upd
-        ] + [
+            mod.append((ldap.MOD_REPLACE, attrname, new[attrname]))
+        mod += [
             # Add new attribute values
             (ldap.MOD_ADD, attrname, value)
             for attrname in newattrs
@@ -152,3 +322,48 @@ def modify_modlist(old, new, atomic=False):
         ]
 
     return mod
+
+
+def _is_single(values):
+    return values is None or isinstance(values, basestring)
+
+def count_values(mod_attrs):
+    """ The number of values carried by a modlist """
+    return sum(1 if _is_single(values) else max(len(values), 1)
+               for op, attr, values in mod_attrs)
+
+def chunk_modlist(mod_attrs, size):
+    """ Split a modlist in modlists carrying at most size values, which
+    applied in order make the same changes
+
+    The values of a replace are split in a replace of the first ones,
+    followed by adds of the others.
+    """
+    chunks, chunk, count = [], [], 0
+    for op, attr, values in mod_attrs:
+        if _is_single(values):
+            parts = [values]
+        else:
+            values = list(values)
+            parts = [values[i:i + size]
+                     for i in range(0, len(values), size)] or [values]
+
+        for i, part in enumerate(parts):
+            n = 1 if _is_single(part) else max(len(part), 1)
+            if chunk and count + n > size:
+                chunks.append(chunk)
+                chunk, count = [], 0
+            chunk.append((ldap.MOD_ADD if op == ldap.MOD_REPLACE and i else op,
+                          attr, part))
+            count += n
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def is_ordered(mod_attrs):
+    """ Check if a modlist replaces or deletes whole attributes, in which
+    case it must be applied after and before the ones around it """
+    return any(op == ldap.MOD_REPLACE or (op == ldap.MOD_DELETE
+                                          and values is None)
+               for op, attr, values in mod_attrs)